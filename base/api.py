@@ -0,0 +1,618 @@
+import contextlib
+import json
+import os
+import pickle as pkl
+import signal
+import sys
+import threading
+import time
+
+# the command line starts with this module, so whatever is slow to import and
+# only needed by some calls (the store and multiprocessing under it, the
+# dispatcher and what it drags in, the loader, psutil, subprocess) gets
+# imported by the calls that need it. See bench_startup.py.
+
+__all__ = [
+    'Maestro',
+    'load_settings',
+    'save_settings',
+    'make_dispatcher',
+    'run_dispatcher',
+    'make_agent',
+]
+
+SYS_DIR = 'maestro_sys'
+
+#### settings ####
+
+def load_settings(sys_dir = SYS_DIR):
+    """ what's in [sys_dir]/settings.pkl, {} if there's nothing yet """
+    try:
+        with open(os.path.join(sys_dir, 'settings.pkl'), 'rb') as f:
+            return pkl.load(f)
+    except FileNotFoundError:
+        return {}
+
+def save_settings(settings, sys_dir = SYS_DIR):
+    os.makedirs(sys_dir, exist_ok = True)
+    path = os.path.join(sys_dir, 'settings.pkl')
+    with open(path + '.tmp', 'wb') as f:
+        pkl.dump(settings, f)
+    os.replace(path + '.tmp', path)
+
+def authkey(sys_dir = SYS_DIR, name = 'state.key'):
+    """
+        the key to the state service (or with [name] = 'cluster.key', the one
+        agents need, see cluster.py), made the first time (only we can read it)
+    """
+    path = os.path.join(sys_dir, name)
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+    os.makedirs(sys_dir, exist_ok = True)
+    key = os.urandom(32)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(key)
+    return key
+
+@contextlib.contextmanager
+def state_lock(sys_dir = SYS_DIR):
+    """
+        Held (maestro_sys/state.lock) while deciding who serves the state and
+        while whoever serves it goes away. So two commands started at once
+        (cron, a sweep script) can't both end up serving the same journal,
+        and nobody connects to a state service that's on its way out.
+    """
+    import fcntl
+
+    os.makedirs(sys_dir, exist_ok = True)
+    with open(os.path.join(sys_dir, 'state.lock'), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            # a state service started in the meantime has a copy of the
+            # file, closing ours wouldn't let go of the lock
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def alive(pid):
+    """ whether [pid] is still around, and not just waiting to be reaped """
+    import psutil
+
+    try:
+        return psutil.Process(pid).status() != psutil.STATUS_ZOMBIE
+    except psutil.NoSuchProcess:
+        return False
+
+#### the API ####
+
+class Cold():
+    """
+        What the loader needs of the state (adding a batch, and taking it
+        back if the files can't go in), for a Maestro that isn't talking to
+        the state yet: with nobody serving it, the batch goes straight on
+        the journal (see Maestro.add_cold) and the history isn't loaded at
+        all. Otherwise it goes through the state like it always did.
+    """
+    def __init__(self, m):
+        self.m = m
+        self.cold = set() # the batches that went on the journal
+
+    def add_batch(self, label, filenames, options = None):
+        filenames = list(filenames)
+        id = self.m.add_cold('add_batch', label, filenames, options)
+        if id is None:
+            return self.m.state.add_batch(label, filenames, options)
+        self.cold.add(id)
+        return id
+
+    def add_sweep(self, label, template, size, options = None):
+        id = self.m.add_cold('add_sweep', label, template, size, options)
+        if id is None:
+            return self.m.state.add_sweep(label, template, size, options)
+        self.cold.add(id)
+        return id
+
+    def delete_batch(self, bid):
+        if bid in self.cold and self.m.delete_cold(bid):
+            return True
+        # somebody started serving the state since, and has it
+        return self.m.state.delete_batch(bid)
+
+class Maestro():
+    """
+        Everything the menus do, as plain calls, for scripts and the command
+        line (see `maestro.py --help`):
+
+            with api.Maestro() as m:
+                bid, count, skipped, method = m.load(['sweep/*.sh'], 'lr')
+                m.set_options(bid, priority = 2)
+                print(m.status(bid))
+
+        The state service is shared: if maestro (the menus, `maestro.py
+        server` or a dispatcher) is already running in [sys_dir] we talk to
+        its state service through maestro_sys/state.sock, otherwise we serve
+        the state ourselves until close().
+
+        Nothing happens until the state is first asked for, so whatever
+        doesn't need it (settings, the dispatcher's pid) doesn't pay for it.
+    """
+    def __init__(self, sys_dir = SYS_DIR):
+        self.sys_dir = sys_dir
+        self.settings = load_settings(sys_dir)
+        self.manager = None
+        self.saver = None
+        self._state = None
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        """ a proxy to the store, see store.py """
+        with self.lock:
+            if self._state is None:
+                self._state = self.open()
+        return self._state
+
+    def open(self):
+        """
+            Connect to the state service, or serve it ourselves if nobody
+            is. That gets decided holding maestro_sys/state.lock, so two
+            commands started at once (cron, a sweep script) can't both end
+            up serving the same journal.
+        """
+        from multiprocessing import AuthenticationError
+        from base import store
+
+        path = os.path.abspath(os.path.join(self.sys_dir, 'manager_state.pkl'))
+        address = os.path.abspath(os.path.join(self.sys_dir, 'state.sock'))
+        with state_lock(self.sys_dir):
+            key = authkey(self.sys_dir)
+            try:
+                state = store.connect(path, address, key)
+                state.attach()
+                return state
+            except (OSError, EOFError, AuthenticationError):
+                # nobody's home (or they left the socket behind)
+                try:
+                    os.remove(address)
+                except FileNotFoundError:
+                    pass
+            # the socket is up by the time this returns, whoever's waiting
+            # on the lock connects to it
+            self.manager, state = store.serve(path, address, key)
+        self.stopped = threading.Event()
+        self.saver = threading.Thread(target = self.save, args = (state,),
+                                      daemon = True)
+        self.saver.start()
+        return state
+
+    def peek(self):
+        """
+            The batch summaries the last state service left behind (see
+            StateStore.write_summary), if nobody is serving the state now and
+            nothing changed since. None if that's not the case, then the
+            state has to be loaded after all.
+        """
+        with state_lock(self.sys_dir):
+            found = self.summary()
+        return found and found[0]
+
+    def summary(self):
+        """
+            peek(), with the journal's last sequence number: (batches, seq).
+            Only call with state_lock held.
+        """
+        from base import journal
+
+        if os.path.exists(os.path.join(self.sys_dir, 'state.sock')):
+            return None
+        try:
+            with open(os.path.join(self.sys_dir, 'manager_state.summary'),
+                      'rb') as f:
+                stamp, batches, seq = pkl.load(f)
+        except (OSError, EOFError, pkl.UnpicklingError, ValueError):
+            return None
+        if stamp != journal.stamp(*self.journal_paths()):
+            return None
+        return batches, seq
+
+    def journal_paths(self):
+        """ the snapshot and the journal """
+        return (os.path.join(self.sys_dir, 'manager_state.pkl'),
+                os.path.join(self.sys_dir, 'manager_state.journal'))
+
+    def add_cold(self, op, *args):
+        """
+            Add a batch ([op] is add_batch or add_sweep, [args] what the
+            State takes after the id) without loading the history: if nobody
+            is serving the state and the summary is good (see peek), it goes
+            straight on the end of the journal, and in the summary. Whoever
+            loads the state next replays it like any other change.
+
+            Returns the batch's id, None if it has to go through the state
+            after all.
+        """
+        from base import base
+
+        with state_lock(self.sys_dir):
+            found = self.summary()
+            if found is None:
+                return None
+            batches, seq = found
+            id = max((b['id'] for b in batches), default = -1) + 1
+            self.journal_cold(seq, op, id, *args)
+            # what the state service would have summed up
+            state = base.State()
+            getattr(state, op)(id, *args)
+            self.write_summary(batches + [state.batches[id].summary(False)],
+                               seq + 1)
+        return id
+
+    def delete_cold(self, bid):
+        """ take back a batch add_cold added, False if that can't be done """
+        with state_lock(self.sys_dir):
+            found = self.summary()
+            if found is None:
+                return False
+            batches, seq = found
+            self.journal_cold(seq, 'delete_batch', bid)
+            self.write_summary([b for b in batches if b['id'] != bid], seq + 1)
+        return True
+
+    def journal_cold(self, seq, op, *args):
+        from base import journal
+
+        j = journal.Journal(self.journal_paths()[1])
+        j.seq = seq
+        j.open()
+        try:
+            j.append(op, *args)
+        finally:
+            j.close()
+
+    def write_summary(self, batches, seq):
+        """ the summary, as StateStore.write_summary leaves it """
+        from base import journal
+
+        path = os.path.join(self.sys_dir, 'manager_state.summary')
+        with open(path + '.tmp', 'wb') as f:
+            pkl.dump((journal.stamp(*self.journal_paths()), batches, seq), f)
+        os.replace(path + '.tmp', path)
+
+    def warm(self):
+        """
+            Get the state ready in the background (the menus do this while
+            they draw themselves, a big history takes a while to load).
+        """
+        threading.Thread(target = lambda: self.state, daemon = True).start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    @property
+    def hosting(self):
+        """ True if the state service is ours (and goes away with us) """
+        return self.manager is not None
+
+    def save(self, state):
+        # flushes the journal, the whole state only gets written once the
+        # journal is big enough to be worth compacting
+        while not self.stopped.wait(1):
+            try:
+                state.sync()
+            except (EOFError, OSError):
+                return
+
+    def close(self, grace = 10):
+        """
+            Let go of the state service. If it's ours, whoever connected to
+            it gets [grace] seconds to finish up before it goes away with us.
+        """
+        with self.lock:
+            if self.manager is None:
+                if self._state is not None:
+                    try:
+                        self._state.attach(-1)
+                    except (EOFError, OSError):
+                        pass
+                    self._state = None
+                return
+        self.stopped.set()
+        self.saver.join()
+        # nobody new connects while we're on our way out, see open
+        with state_lock(self.sys_dir):
+            end = time.monotonic() + grace
+            try:
+                while self._state.clients() and time.monotonic() < end:
+                    time.sleep(0.05)
+                # the journal has everything, no need to rewrite the whole
+                # history on the way out (the next one to load it compacts
+                # it if it got big, see StateStore)
+                self._state.close(save = False)
+            except (EOFError, OSError):
+                # the whole process group got the signal, the state service
+                # is gone already (with whatever it had journaled)
+                pass
+            self.manager.shutdown()
+            self.manager = None
+
+    def require(self, *keys):
+        missing = [k for k in keys if k not in self.settings]
+        if missing:
+            raise RuntimeError('No %s in the settings yet, run `maestro.py '
+                               'init` (or maestro.py once) first'
+                               % ', '.join(missing))
+        return [self.settings[k] for k in keys]
+
+    def setup(self, queue_root, run_dir):
+        """ where the queue (in [queue_root]/queue) and the run directory are """
+        self.settings['queue_dir'] = os.path.join(
+                            os.path.expanduser(queue_root), 'queue')
+        self.settings['run_dir'] = os.path.expanduser(run_dir)
+        for d in ['queue_dir', 'run_dir']:
+            os.makedirs(self.settings[d], exist_ok = True)
+        save_settings(self.settings, self.sys_dir)
+
+    #### batches ####
+
+    def load(self, patterns, label, options = None, mode = 'auto',
+             workers = 8):
+        """
+            Load the files matching [patterns] (paths, ~ and * allowed) as one
+            batch. Returns (batch id, how many files, skipped files, method),
+            see loader.load.
+        """
+        from base import loader
+
+        queue_dir, = self.require('queue_dir')
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        files = [f for p in patterns for f in loader.matches(p)]
+        return loader.load(self.adder(), queue_dir, files, label, options,
+                           mode = mode, workers = workers)
+
+    def load_sweep(self, template, params, label, options = None,
+                   via = 'env', mode = 'auto'):
+        """ see loader.load_sweep, returns (batch id, points, method) """
+        from base import loader
+
+        queue_dir, = self.require('queue_dir')
+        return loader.load_sweep(self.adder(), queue_dir,
+                                 os.path.expanduser(template), params, label,
+                                 options, via = via, mode = mode)
+
+    def adder(self):
+        """ what the loader adds batches through, see Cold """
+        return self._state if self._state is not None else Cold(self)
+
+    def status(self, bid = None, processes = False):
+        """
+            Every batch (or just [bid]) as a dict (see Batch.summary), with
+            its processes if [processes] or if it's just the one batch.
+        """
+        batches = None
+        if bid is None and not processes and self._state is None:
+            # nobody's serving the state? don't load it just for the counts
+            batches = self.peek()
+        if batches is None:
+            batches = self.state.summary(bid, processes or bid is not None)
+        if bid is not None and not batches:
+            raise KeyError('No batch %d' % bid)
+        return batches
+
+    def set_options(self, bid, **options):
+        """ change some of [bid]'s options (priority, weight, ...) """
+        current = self.state.options(bid)
+        if current is None and self.state.batch(bid)[0] is None:
+            raise KeyError('No batch %d' % bid)
+        current = dict(current or {})
+        current.update(options)
+        self.state.set_options(bid, current)
+        return current
+
+    def kill(self, bid):
+        """ kill a batch: its running processes and whatever's still queued """
+        import shutil
+
+        queue_dir, = self.require('queue_dir')
+        if self.state.batch(bid)[0] is None:
+            raise KeyError('No batch %d' % bid)
+        self.state.kill_batch(bid)
+        shutil.rmtree(os.path.join(queue_dir, 'batch-%d' % bid),
+                      ignore_errors = True)
+
+    def kill_pid(self, pid):
+        """ False if no process of ours has [pid] """
+        return self.state.kill_pid(pid)
+
+    def delete(self, bid):
+        """ forget a batch (and drop whatever's still queued of it) """
+        import shutil
+
+        queue_dir, = self.require('queue_dir')
+        if not self.state.delete_batch(bid):
+            raise KeyError('No batch %d' % bid)
+        shutil.rmtree(os.path.join(queue_dir, 'batch-%d' % bid),
+                      ignore_errors = True)
+
+    #### the dispatcher ####
+
+    def dispatcher_pid(self):
+        """ the pid of the dispatcher, None if there isn't one running """
+        # someone else might have started or stopped it since
+        self.settings.clear()
+        self.settings.update(load_settings(self.sys_dir))
+        pid = self.settings.get('dispatcher')
+        if pid is None or not alive(pid):
+            return None
+        return pid
+
+    def start_dispatcher(self, config):
+        """
+            Start a dispatcher in the background, on its own (it outlives
+            us, and serves the state itself if nobody else does). [config] is
+            what make_dispatcher takes. Returns its pid, None if there's one
+            running already.
+        """
+        import subprocess
+
+        if self.dispatcher_pid() is not None:
+            return None
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+                filter(None, [root, env.get('PYTHONPATH')]))
+        out = open(os.path.join(self.sys_dir, 'dispatcher.out'), 'ab')
+        with out:
+            p = subprocess.Popen([sys.executable, '-m', 'base.api',
+                                  'dispatcher', self.sys_dir,
+                                  json.dumps(config)],
+                                 env = env, stdin = subprocess.DEVNULL,
+                                 stdout = out, stderr = out,
+                                 start_new_session = True)
+        self.settings['dispatcher'] = p.pid
+        save_settings(self.settings, self.sys_dir)
+        return p.pid
+
+    def stop_dispatcher(self, deadline = None, wait = True):
+        """
+            Shut the dispatcher down (see Dispatcher.command): it stops
+            launching and exits once its running jobs are done. With a
+            [deadline] it only waits that many seconds for them, and leaves
+            whatever's still running to the next one. With [wait], returns
+            once it's gone, otherwise once it's told (dispatcher_pid() has it
+            until it's gone). One that doesn't take commands gets terminated.
+            False if there wasn't one running.
+        """
+        pid = self.dispatcher_pid()
+        if pid is None:
+            return False
+        import psutil
+        try:
+            reply = self.control('shutdown', deadline = deadline)
+            if reply is None or not reply['ok']:
+                # not kill(), it might be serving the state and has to save it
+                psutil.Process(pid).terminate()
+            elif wait:
+                # not psutil's wait(), it isn't our child and whoever reaps
+                # it can take their time about it
+                end = None if deadline is None else \
+                    time.monotonic() + deadline + 60
+                while alive(pid) and (end is None or time.monotonic() < end):
+                    time.sleep(0.05)
+                if alive(pid):
+                    psutil.Process(pid).terminate()
+            else:
+                # still stopping, nobody should start another one meanwhile
+                return True
+        except psutil.NoSuchProcess:
+            pass
+        del self.settings['dispatcher']
+        save_settings(self.settings, self.sys_dir)
+        return True
+
+    def control(self, op, **args):
+        """
+            Tell the dispatcher to [op] (pause, resume, drain, shutdown or
+            just status, see Dispatcher.command). Returns its answer (ok,
+            the state it's in now, how many jobs are running and queued),
+            None if there's no dispatcher listening.
+        """
+        from base import control
+
+        queue_dir, = self.require('queue_dir')
+        path = os.path.join(os.path.dirname(queue_dir), 'control.sock')
+        try:
+            return control.send(path, op, **args)
+        except OSError:
+            return None
+
+#### running a dispatcher ####
+
+def make_dispatcher(state, config):
+    """
+        A dispatcher for [state] (a store proxy) from [config], a plain dict
+        (so it can go on a command line): the Dispatcher's arguments, plus
+
+            engine      : 'sync' | 'async'
+            gpu_backend : 'smi' | 'nvml' | 'fake'
+            gpu_ttl     : seconds to reuse an nvidia-smi answer for
+            fake_gpus   : how many GPUs the fake backend has
+            listen      : coordinate agents on other nodes instead of using
+                          this node's GPUs (see cluster.py), at this address
+            key_file    : the key they need, with listen
+    """
+    from base import dispatcher
+
+    config = dict(config)
+    engine = config.pop('engine', 'sync')
+    listen = config.pop('listen', None)
+    key_file = config.pop('key_file', None)
+    if listen is not None:
+        from base import cluster
+
+        if engine != 'sync':
+            raise ValueError('A coordinator only runs with the sync engine')
+        # the GPUs are the agents'
+        for k in ['gpu_backend', 'gpu_ttl', 'fake_gpus']:
+            config.pop(k, None)
+        with open(key_file, 'rb') as f:
+            key = f.read()
+        return cluster.Coordinator(store = state, listen = listen, key = key,
+                                   **config)
+
+    gpus = gpu_provider(config, memory = config.get('schedule') == 'pack')
+    engine = {'sync': dispatcher.Dispatcher,
+              'async': dispatcher.AsyncDispatcher}[engine]
+    return engine(store = state, gpus = gpus, **config)
+
+def gpu_provider(config, memory = False):
+    """ takes gpu_backend, gpu_ttl and fake_gpus out of [config] """
+    from base import gpu
+
+    backend = config.pop('gpu_backend', 'smi')
+    ttl = config.pop('gpu_ttl', 0)
+    count = config.pop('fake_gpus', 4)
+    if backend == 'smi':
+        return gpu.make_provider('smi', ttl = ttl, memory = memory)
+    if backend == 'fake':
+        return gpu.make_provider('fake', count = count)
+    return gpu.make_provider(backend)
+
+def run_dispatcher(m, config):
+    """
+        Run a dispatcher on [m]'s state (a Maestro) in this process, until
+        it's terminated.
+    """
+    def stop(signum, frame):
+        raise SystemExit
+    signal.signal(signal.SIGTERM, stop)
+
+    d = make_dispatcher(m.state, config)
+    d.dispatch(m.state)
+
+def make_agent(config):
+    """
+        An agent (see cluster.Agent) from [config]: its arguments, plus
+        key_file instead of the key and the GPU bits make_dispatcher takes.
+    """
+    from base import cluster
+
+    config = dict(config)
+    gpus = gpu_provider(config, memory = True)
+    with open(config.pop('key_file'), 'rb') as f:
+        key = f.read()
+    return cluster.Agent(key = key, gpus = gpus, **config)
+
+if __name__ == '__main__':
+    # what start_dispatcher runs
+    if sys.argv[1] == 'dispatcher':
+        with Maestro(sys.argv[2]) as m:
+            run_dispatcher(m, json.loads(sys.argv[3]))
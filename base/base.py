@@ -1,7 +1,8 @@
 import json
-import psutil
 import os
-import time
+import sys
+
+from base import running
 
 class Process():
     """
@@ -17,38 +18,75 @@ class Process():
         filename: file to be run
         log_dir: log directory (if applicable)
         status: 'completed' | 'killed' | 'failed' | 'queued' | 'running'
+        attempts: the earlier tries of a job that got retried (see
+                  Dispatcher.retry), oldest first, None if there weren't any
+
+        There can be tens of thousands of these in a sweep, so they're kept
+        small: no __dict__, just the five slots, statuses are interned (every
+        'running' is the same string) and they pickle as a plain tuple.
 
     """
-    def __init__(self, pid, filename, log_dir, status):
+    __slots__ = ('pid', 'filename', 'log_dir', '_status', 'attempts')
+
+    def __init__(self, pid, filename, log_dir, status, attempts = None):
         #super(Process, self).__init__()
         self.pid = pid
         self.filename = filename
         self.log_dir = log_dir
         self.status = status
+        self.attempts = attempts
 
-    def __repr__(self):
-        info_dict = {
+    @property
+    def status(self):
+        return self._status
+
+    @status.setter
+    def status(self, status):
+        self._status = sys.intern(status) if isinstance(status, str) else status
+
+    def __reduce__(self):
+        if self.attempts is None:
+            return (Process, (self.pid, self.filename, self.log_dir,
+                              self.status))
+        return (Process, (self.pid, self.filename, self.log_dir, self.status,
+                          self.attempts))
+
+    def __setstate__(self, state):
+        # pickles from before __slots__ come with the old __dict__
+        if isinstance(state, tuple):
+            state = state[1] or state[0]
+        self.pid = state.get('pid')
+        self.filename = state.get('filename')
+        self.log_dir = state.get('log_dir')
+        self.status = state.get('status')
+        self.attempts = state.get('attempts')
+
+    def to_dict(self):
+        info = {
             'pid': self.pid,
             'filename': self.filename,
             'log_dir': self.log_dir,
             'status': self.status
         }
-        return info_dict.__repr__()
+        if self.attempts:
+            info['attempts'] = self.attempts
+        return info
+
+    def __repr__(self):
+        return self.to_dict().__repr__()
 
     def kill(self):
         if self.status == 'running' and self.pid is not None:
             try:
-                psutil.Process(self.pid).kill()
+                # the shell it runs under and whatever the script started too
+                running.kill_group(self.pid)
                 self.status = 'killed'
 
-            except psutil.NoSuchProcess:
-                print('whoa there, something is off... '
-                            'maybe it\'s actually completed?')
-                time.sleep(20) # inner delay
-                if self.status == 'killed':
-                    print('Process was already killed, aborting...')
-                elif self.status != 'completed':
-                    print('k, something is off...')
+            except ProcessLookupError:
+                # it exited already, the dispatcher reaps it and marks it
+                # however it went. Nothing to wait around for here (this runs
+                # in the state service, with the state locked)
+                pass
         elif self.status == 'queued':
             self.status = 'killed'
         else:
@@ -61,6 +99,10 @@ class Batch():
         this as is for now. But, what I can do is give a general description of what this file will do:
 
         this is a class that will be a list of either running processes or files to be run that are queued
+
+        Processes are also indexed by file name, pid and status so finding one
+        doesn't mean going through all of them (sweeps can have 10k scripts).
+        Change them through mark/kill so the indexes stay right.
     """
 
     def __init__(self, label, id, processes, options = None):
@@ -69,6 +111,7 @@ class Batch():
         self.id = id
         self.processes = processes
         self.options = options # don't know what to do with this yet
+        self.index()
 
     def __repr__(self):
         info_dict = {
@@ -79,22 +122,161 @@ class Batch():
         }
         return info_dict.__repr__()
 
+    #### indexes ####
+
+    def index(self):
+        # the dispatcher only knows the name of the file in the batch folder,
+        # the process remembers where it was loaded from
+        self.by_name = {}
+        self.by_pid = {}
+        self.by_status = {}
+        for p in self.processes:
+            self.by_name[os.path.basename(p.filename)] = p
+            self.add(p)
+
+    def add(self, p):
+        if p.pid is not None:
+            self.by_pid[p.pid] = p
+        self.by_status.setdefault(p.status, set()).add(p)
+
+    def remove(self, p):
+        if self.by_pid.get(p.pid) is p:
+            del self.by_pid[p.pid]
+        self.by_status.get(p.status, set()).discard(p)
+
+    def moved(self, p, pid, status):
+        """ [p] used to have [pid] and [status], fix the indexes """
+        if self.by_pid.get(pid) is p:
+            del self.by_pid[pid]
+        self.by_status.get(status, set()).discard(p)
+        self.add(p)
+
+    def __getstate__(self):
+        # the indexes are rebuilt on load, no need to pickle them
+        state = self.__dict__.copy()
+        for k in ['by_name', 'by_pid', 'by_status']:
+            state.pop(k, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.index()
+
+    #### methods ####
+
     def kill(self):
         """
             kills a batch's processes without hesitation
             * blows smoke from gun *
+
+            returns the (process, old pid, old status) of whatever it killed
         """
-        for p in self.processes:
+        changed = []
+        for p in self.with_status('running') | self.with_status('queued'):
+            pid, status = p.pid, p.status
             p.kill()
+            if (p.pid, p.status) != (pid, status):
+                self.moved(p, pid, status)
+                changed.append((p, pid, status))
+        return changed
+
+    def summary(self, processes = True):
+        """ what the batch looks like from outside, as plain data """
+        info = {
+            'id': self.id,
+            'label': self.label,
+            'options': self.options,
+            'counts': {s: len(ps) for s, ps in self.by_status.items() if ps},
+        }
+        if processes:
+            info['processes'] = [p.to_dict() for p in self.processes]
+        return info
 
     def get_all_id(self):
         return [p.pid for p in self.processes]
 
-    def mark(self, fname, pid, status):
-        for p in self.processes:
-            if p.filename == fname:
-                p.status = status
-                p.pid = pid
+    def find(self, fname):
+        return self.by_name.get(fname)
+
+    def find_pid(self, pid):
+        return self.by_pid.get(pid)
+
+    def with_status(self, status):
+        return set(self.by_status.get(status, ()))
+
+    def mark(self, fname, pid, status, log_dir = None):
+        """ returns the process and its old pid and status (None if no such file) """
+        p = self.by_name.get(fname)
+        if p is None:
+            return None
+        old = (p, p.pid, p.status)
+        p.status = status
+        p.pid = pid
+        if log_dir is not None:
+            p.log_dir = log_dir
+        self.moved(*old)
+        return old
+
+    def retry(self, fname, attempt):
+        """
+            [fname] failed and gets another go: [attempt] (a dict, how that
+            went) goes in its history and it's queued again. Returns the
+            process and its old pid and status, like mark.
+        """
+        p = self.by_name.get(fname)
+        if p is None:
+            return None
+        old = (p, p.pid, p.status)
+        p.attempts = (p.attempts or []) + [attempt]
+        p.status = 'queued'
+        p.pid = None
+        self.moved(*old)
+        return old
+
+class Sweep(Batch):
+    """
+        A batch that's one template script run over a bunch of parameters
+        (see sweep.py), [size] points of it.
+
+        Points only get a Process once the dispatcher launches them, so a
+        100k point sweep costs nothing here until it starts running, and
+        the processes are the points that ran (or are running).
+    """
+
+    def __init__(self, label, id, template, size, options = None):
+        self.template = template
+        self.size = size
+        super().__init__(label, id, [], options)
+
+    def __repr__(self):
+        info_dict = {
+            'id': self.id,
+            'label': self.label,
+            'template': self.template,
+            'size': self.size,
+            'processes': self.processes,
+            'options': self.options
+        }
+        return info_dict.__repr__()
+
+    def mark(self, fname, pid, status, log_dir = None):
+        if fname not in self.by_name:
+            # first time we hear about this point
+            p = Process(pid = None, filename = fname, log_dir = None,
+                        status = 'queued')
+            self.processes.append(p)
+            self.by_name[fname] = p
+            self.add(p)
+        return super().mark(fname, pid, status, log_dir)
+
+    def summary(self, processes = True):
+        info = super().summary(processes)
+        info['sweep'] = {'template': self.template, 'size': self.size}
+        return info
+
+    def started(self):
+        """ names of the points that got launched (and aren't up for a retry) """
+        return [n for n, p in self.by_name.items() if p.status != 'queued']
 
 class State():
     """
@@ -105,16 +287,141 @@ class State():
         a daemon update it every so often (perhaps an argument when running the
         manager? something to think about...)
 
+        On top of each batch's own indexes, the state keeps every process by
+        pid (with its batch id) and by status, across batches.
+
     """
     #### initialization ####
 
     def __init__(self, batches = {}):
         #super(State, self).__init__()
         self.batches = self.to_dict(batches)
-        print(self.batches)
+        self.seq = 0 # last journal record this state has seen (journal.py)
+        self.index()
+
+    #### indexes ####
+
+    def index(self):
+        self.by_pid = {}
+        self.by_status = {}
+        for b in self.batches.values():
+            for p in b.processes:
+                self.add(b.id, p)
+
+    def add(self, bid, p):
+        if p.pid is not None:
+            self.by_pid[p.pid] = (bid, p)
+        self.by_status.setdefault(p.status, set()).add(p)
+
+    def remove(self, p):
+        found = self.by_pid.get(p.pid)
+        if found is not None and found[1] is p:
+            del self.by_pid[p.pid]
+        self.by_status.get(p.status, set()).discard(p)
+
+    def moved(self, bid, p, pid, status):
+        """ [p] used to have [pid] and [status], fix the indexes """
+        found = self.by_pid.get(pid)
+        if found is not None and found[1] is p:
+            del self.by_pid[pid]
+        self.by_status.get(status, set()).discard(p)
+        self.add(bid, p)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for k in ['by_pid', 'by_status']:
+            state.pop(k, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.index()
 
     #### methods ####
 
+    # these are the only ways the state changes, so they are also what the
+    # journal records and replays
+
+    def add_batch(self, id, label, filenames, options = None):
+        processes = [Process(
+                        pid = None,
+                        filename = f,
+                        log_dir = None,
+                        status = 'queued') for f in filenames]
+        self.batches[id] = Batch(
+            id = id,
+            label = label,
+            processes = processes,
+            options = options)
+        for p in processes:
+            self.add(id, p)
+
+    def add_sweep(self, id, label, template, size, options = None):
+        self.batches[id] = Sweep(
+            id = id,
+            label = label,
+            template = template,
+            size = size,
+            options = options)
+
+    def mark(self, bid, fname, pid, status, log_dir = None):
+        if bid not in self.batches:
+            # deleted while it was running, nothing left to mark
+            return
+        old = self.batches[bid].mark(fname, pid, status, log_dir)
+        if old is not None:
+            self.moved(bid, *old)
+
+    def retry(self, bid, fname, attempt):
+        if bid not in self.batches:
+            return
+        old = self.batches[bid].retry(fname, attempt)
+        if old is not None:
+            self.moved(bid, *old)
+
+    def set_options(self, bid, options):
+        if bid not in self.batches:
+            # deleted since, replaying the journal
+            return
+        self.batches[bid].options = options
+
+    def delete_batch(self, bid):
+        batch = self.batches.pop(bid, None)
+        if batch is None:
+            return False
+        for p in batch.processes:
+            self.remove(p)
+        return True
+
+    # killing has side effects, so it isn't journaled as such, the caller
+    # journals the marks it resulted in (see store.py)
+
+    def kill(self, bid):
+        """ kill a whole batch, returns (process, old pid, old status) per kill """
+        changed = self.batches[bid].kill()
+        for old in changed:
+            self.moved(bid, *old)
+        return changed
+
+    def kill_pid(self, pid):
+        """ returns (batch id, process) or None if we don't know [pid] """
+        found = self.by_pid.get(pid)
+        if found is None:
+            return None
+        bid, p = found
+        old = (p, p.pid, p.status)
+        p.kill()
+        self.batches[bid].moved(*old)
+        self.moved(bid, *old)
+        return found
+
+    def find_pid(self, pid):
+        """ (batch id, process) for [pid], or None """
+        return self.by_pid.get(pid)
+
+    def with_status(self, status):
+        return set(self.by_status.get(status, ()))
+
     #### representation stuff ####
 
     def to_dict(self, batches):
@@ -122,5 +429,7 @@ class State():
         return dict(zip(IDs, batches))
 
     def toJSON(self):
-        return json.dumps(self, default=lambda o: o.__dict__,
+        # no indexes in there, just what's pickled
+        return json.dumps(self, default=lambda o: o.to_dict()
+            if isinstance(o, Process) else o.__getstate__(),
             sort_keys=False, indent=4)
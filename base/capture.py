@@ -0,0 +1,125 @@
+import os
+
+__all__ = [
+    'Capture',
+    'open_files',
+]
+
+class Capture():
+    """
+        Copies what a job writes to one of its pipes into [path], reading
+        whenever the dispatcher's loop says there's something there (the pipe
+        is non-blocking, so reading never waits on the job).
+
+        Only [cap] bytes are kept:
+            keep = 'head'   the first [cap] bytes, the rest is read and
+                            thrown away
+            keep = 'tail'   the last [cap] bytes. New output is appended to
+                            the file and whenever the file gets to twice
+                            [cap] it's rewritten with just the last [cap],
+                            so it stays under twice [cap] while the job runs
+                            (and is cut down to [cap] when it's done), for
+                            work proportional to the output.
+
+        Either way the pipe is always drained, so a chatty job never blocks
+        on a full pipe and never makes the dispatcher wait either.
+
+        With keep = 'head' the last [end] bytes are also kept around in
+        memory (see ending), the end of stderr is where a job says why it
+        failed.
+    """
+    def __init__(self, fd, path, cap, keep = 'head', end = 0):
+        self.fd = fd
+        self.path = path
+        self.cap = cap
+        self.keep = keep
+        self.end = end
+        self.f = open(path, 'wb')
+        self.total = 0 # bytes the job wrote
+        self.kept = 0 # bytes in the file right now
+        self.tail = bytearray() # keep = 'tail': what's in the file
+        self.last = bytearray() # keep = 'head': at most 2 [end] of the end
+        os.set_blocking(fd, False)
+
+    def fileno(self):
+        return self.fd
+
+    def read(self, budget = 2**20):
+        """
+            Read what's there (up to [budget] bytes, so one job can't hog the
+            loop). Returns False once the job closed its end.
+        """
+        try:
+            while budget > 0:
+                try:
+                    data = os.read(self.fd, min(budget, 2**16))
+                except BlockingIOError:
+                    return True
+                if not data:
+                    return False
+                budget -= len(data)
+                self.write(data)
+            return True
+        finally:
+            # so whoever looks at the file sees what's there so far
+            self.f.flush()
+
+    def write(self, data):
+        self.total += len(data)
+        if self.keep == 'tail':
+            self.tail += data
+            if len(self.tail) >= 2 * self.cap:
+                del self.tail[:-self.cap]
+                self.f.seek(0)
+                self.f.write(self.tail)
+                self.f.truncate()
+            else:
+                self.f.write(data)
+            self.kept = len(self.tail)
+            return
+
+        if self.end:
+            self.last += data
+            if len(self.last) >= 2 * self.end:
+                del self.last[:-self.end]
+        room = self.cap - self.kept
+        if room > 0:
+            self.f.write(data[:room])
+            self.kept += min(room, len(data))
+
+    def dropped(self):
+        """ whether some of the output didn't make it to the file """
+        return self.total > self.cap
+
+    def ending(self):
+        """ the last [end] bytes the job wrote (up to [cap] for 'tail') """
+        if self.keep == 'tail':
+            return bytes(self.tail[-self.cap:])
+        return bytes(self.last[-self.end:]) if self.end else b''
+
+    def close(self):
+        """ read whatever's left, note what got dropped and close up """
+        # the job's gone but the pipe may still hold its last words. Something
+        # it left running in the background could keep writing forever, so
+        # only so much, and no waiting for EOF
+        self.read(budget = 16 * 2**20)
+        dropped = self.total - min(self.total, self.cap)
+        if self.keep == 'tail':
+            # the file has between [cap] and 2 [cap] of the end
+            self.f.seek(0)
+            if dropped:
+                self.f.write(b'[maestro: output capped, %d earlier bytes '
+                             b'dropped]\n' % dropped)
+            self.f.write(self.tail[-self.cap:])
+            self.f.truncate()
+        elif dropped:
+            self.f.write(b'\n[maestro: output capped, %d more bytes '
+                         b'dropped]\n' % dropped)
+        self.f.close()
+        os.close(self.fd)
+
+def open_files(log_dir):
+    """ stdout and stderr files for a job, written to directly by the job """
+    os.makedirs(log_dir, exist_ok = True)
+    return (open(os.path.join(log_dir, 'stdout'), 'wb'),
+            open(os.path.join(log_dir, 'stderr'), 'wb'))
@@ -0,0 +1,695 @@
+import functools
+import hmac
+import json
+import logging
+import os
+import selectors
+import shutil
+import socket
+import subprocess
+import time
+
+from base import capture, dispatcher, gpu, running
+
+__all__ = [
+    'Coordinator',
+    'Agent',
+    'Connection',
+    'RemoteJob',
+    'NodesProvider',
+    'parse_address',
+]
+
+# the protocol: JSON objects, one per line, each with an 'op'
+#
+#   coordinator -> agent    challenge {nonce}
+#   agent -> coordinator    hello {name, nonce, auth, devices, running, done}
+#   coordinator -> agent    welcome {auth}
+#   coordinator -> agent    run {job, batch, name, script, mode, env, args,
+#                                cpus, params}
+#                           kill {job}
+#                           ack {job}
+#   agent -> coordinator    started {job, pid, log_dir}
+#                           exit {job, rc, error}
+#                           devices {devices}
+#
+# Both ends prove they have the key (an HMAC of the other one's nonce) before
+# anything else goes through, an agent runs whatever it's sent after all.
+# Nothing is encrypted, keep it on a network you trust (or an ssh tunnel).
+
+MAX_LINE = 64 * 2**20
+
+def parse_address(address):
+    """ 'host:port', just a port (localhost) or 'unix:/some/path' -> (family, address) """
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[len('unix:'):]
+    host, _, port = address.rpartition(':')
+    return socket.AF_INET, (host or '127.0.0.1', int(port))
+
+def sign(key, nonce):
+    return hmac.new(key, nonce.encode(), 'sha256').hexdigest()
+
+class Connection():
+    """ JSON lines over a socket """
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = b''
+        self.node = None # the agent's name, once it said hello
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, **msg):
+        self.sock.sendall(json.dumps(msg).encode() + b'\n')
+
+    def receive(self):
+        """
+            Read what's there (once, so call it when the socket is readable)
+            and return the whole messages that came in. EOFError once the
+            other end is gone.
+        """
+        self.read()
+        return self.buffered()
+
+    def read(self):
+        data = self.sock.recv(2**16)
+        if not data:
+            raise EOFError('connection closed')
+        self.buf += data
+        if len(self.buf) > MAX_LINE and b'\n' not in self.buf:
+            raise ValueError('message too long')
+
+    def buffered(self):
+        """ the whole messages read so far """
+        *lines, self.buf = self.buf.split(b'\n')
+        return [json.loads(line) for line in lines if line.strip()]
+
+    def wait(self):
+        """ the next message, blocking (for the handshake) """
+        while b'\n' not in self.buf:
+            self.read()
+        line, self.buf = self.buf.split(b'\n', 1)
+        return json.loads(line)
+
+    def close(self):
+        self.sock.close()
+
+#### the coordinator's end ####
+
+class RemoteJob():
+    """
+        A job running on an agent. Looks enough like a Popen for check_jobs
+        and finish: poll() is None until the agent says it exited.
+
+        pid stays None, that's what goes in the state: the pid is only good on
+        the agent's node, killing it here (from the menus) would kill
+        something else. The agent's pid is remote_pid.
+    """
+    def __init__(self, node, remote_pid = None):
+        self.node = node
+        self.pid = None
+        self.remote_pid = remote_pid
+        self.returncode = None
+        self.error = None # why it couldn't start, if it couldn't
+        self.killed = False
+
+    def poll(self):
+        return self.returncode
+
+class Node():
+    """ an agent that's connected: its connection and its last inventory """
+    def __init__(self, name, conn, devices):
+        self.name = name
+        self.conn = conn
+        self.devices = devices
+
+class NodesProvider(gpu.GPUProvider):
+    """
+        The GPUs of every connected agent, as they last reported them, with
+        ids '<node>/<id>' (what --block takes for a coordinator too).
+    """
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    def devices(self):
+        return [d._replace(id = '%s/%s' % (name, d.id))
+                for name, node in sorted(self.nodes.items())
+                for d in node.devices]
+
+def split_id(g):
+    """ '<node>/<id>' -> (node, id) """
+    node, _, local = g.rpartition('/')
+    return node, local
+
+class Coordinator(dispatcher.Dispatcher):
+    """Coordinator.
+
+        A dispatcher for several GPU boxes: it owns the one queue and the
+        state like any dispatcher, but its GPUs are the ones the agents (see
+        Agent) report, and jobs are sent to the agent that has the GPUs
+        instead of being started here.
+
+        Agents connect to [listen] ('host:port', a port, or 'unix:/path') and
+        prove they have [key]. The scripts are sent over (the nodes don't
+        need to share a filesystem), the jobs' output stays on the node and
+        their log_dir in the state is '<node>:<path>'.
+
+        Killing a batch (maestro removes its queue folder) kills its jobs on
+        the agents. An agent that goes away keeps its jobs running, and we
+        pick them up again when it reconnects (also after a restart of the
+        coordinator, along with the ones that finished in between). Jobs an
+        agent doesn't know about anymore when it reconnects (it was
+        restarted) are marked failed. An exit is only acked once it's in the
+        state, until then the agent keeps it and says it again on reconnect.
+
+        Only the sync engine, everything here is non-blocking enough.
+    """
+    def __init__(self, *args, listen, key, **kwargs):
+        """
+            listen :   where the agents connect
+            key    :   the shared key (bytes) agents need to connect
+            the rest is the same as for the Dispatcher, except for gpus
+        """
+        self.nodes = {} # name -> Node, the agents that are connected
+        kwargs['gpus'] = NodesProvider(self.nodes)
+        super().__init__(*args, **kwargs)
+        self.listen_at = listen
+        self.key = key
+        self.server = None
+        self.remote = {} # job -> RemoteJob, everything running on agents
+        self.adopted = {} # job -> RemoteJob, picked up since the last tick
+        self.job_queue = None
+        self.metrics.gauge('agents', 'Agents connected to the coordinator')
+
+    #### connections ####
+
+    def listen(self):
+        super().listen()
+        family, address = parse_address(self.listen_at)
+        if family == socket.AF_UNIX:
+            try:
+                os.remove(address)
+            except FileNotFoundError:
+                pass
+        self.server = socket.socket(family, socket.SOCK_STREAM)
+        if family != socket.AF_UNIX:
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(address)
+        self.server.listen(64)
+        self.server.setblocking(False)
+        self.selector.register(self.server, selectors.EVENT_READ, self.accept)
+        logging.info('Waiting for agents at %s', self.listen_at)
+
+    def accept(self):
+        try:
+            sock, _ = self.server.accept()
+        except BlockingIOError:
+            return False
+        # a stuck agent gets dropped instead of stalling the dispatcher
+        sock.settimeout(10)
+        conn = Connection(sock)
+        conn.nonce = os.urandom(16).hex()
+        try:
+            conn.send(op = 'challenge', nonce = conn.nonce)
+        except OSError:
+            sock.close()
+            return False
+        self.selector.register(sock, selectors.EVENT_READ,
+                               functools.partial(self.receive, conn))
+        return False
+
+    def receive(self, conn):
+        """ conn is readable, returns True if that's worth a tick """
+        try:
+            messages = conn.receive()
+        except (OSError, EOFError, ValueError) as err:
+            self.drop(conn, err)
+            return True
+        woke = False
+        for msg in messages:
+            try:
+                woke = self.handle(conn, msg) or woke
+            except (KeyError, TypeError, ValueError) as err:
+                self.drop(conn, 'bad message %r: %s' % (msg, err))
+                return True
+            except OSError as err:
+                self.drop(conn, err)
+                return True
+        return woke
+
+    def drop(self, conn, why):
+        try:
+            self.selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        conn.close()
+        node = self.nodes.get(conn.node)
+        if node is None or node.conn is not conn:
+            return
+        del self.nodes[conn.node]
+        jobs = sum(1 for j in self.remote.values() if j.node == conn.node)
+        logging.warning("Agent %s disconnected (%s), its %d running job(s) "
+                        "are left to it until it's back", conn.node, why, jobs)
+
+    def handle(self, conn, msg):
+        op = msg['op']
+        if conn.node is None:
+            if op != 'hello' or not hmac.compare_digest(
+                    str(msg.get('auth')), sign(self.key, conn.nonce)):
+                raise ValueError('not a (known) agent')
+            self.hello(conn, msg)
+            return True
+
+        node = self.nodes[conn.node]
+        if op == 'devices':
+            node.devices = [gpu.Device(*d) for d in msg['devices']]
+            return True
+        if op == 'started':
+            job = self.remote.get(msg['job'])
+            if job is not None and job.node == node.name:
+                job.remote_pid = msg['pid']
+                logging.debug("Started %s as %d on %s", msg['job'],
+                              msg['pid'], node.name, extra =
+                              dispatcher.job_fields(msg['job'],
+                                                    status = 'running'))
+                log_dir = msg.get('log_dir')
+                if log_dir:
+                    self.mark(store = self.store, job = msg['job'],
+                              pid = None, status = 'running',
+                              log_dir = '%s:%s' % (node.name, log_dir))
+            return False
+        if op == 'exit':
+            job = self.remote.get(msg['job'])
+            if job is None or job.node != node.name:
+                # done with already (or never ours), nothing to record
+                conn.send(op = 'ack', job = msg['job'])
+                return False
+            # acked by finish, once it's marked
+            job.error = msg.get('error')
+            job.returncode = -1 if msg['rc'] is None else msg['rc']
+            return True
+        raise ValueError('unknown op')
+
+    def hello(self, conn, msg):
+        name = msg['name']
+        if not name or '/' in name or ':' in name:
+            raise ValueError('bad agent name %r' % name)
+        conn.send(op = 'welcome', auth = sign(self.key, msg['nonce']))
+
+        old = self.nodes.get(name)
+        if old is not None:
+            # it reconnected before we noticed it was gone
+            self.drop(old.conn, 'reconnected')
+        conn.node = name
+        self.nodes[name] = Node(name, conn,
+                                [gpu.Device(*d) for d in msg['devices']])
+        logging.info("Agent %s connected with %d GPU(s)", name,
+                     len(self.nodes[name].devices))
+
+        # whatever it's still running is ours, so is whatever exited while we
+        # were gone (restarted) and is still running as far as the state
+        # knows, whatever it should be running and doesn't know about is lost
+        running = {r['job']: r for r in msg['running']}
+        done = {d['job']: d for d in msg['done']}
+        for job, r in running.items():
+            if job in self.remote:
+                continue
+            self.remote[job] = self.adopted[job] = RemoteJob(name, r['pid'])
+            self.held[job] = ['%s/%s' % (name, g) for g in r['gpus']]
+            logging.info("Picked up %s, still running on %s", job, name,
+                         extra = dispatcher.job_fields(job))
+        for job, d in done.items():
+            bid, fname = dispatcher.job_key(job)
+            if job in self.remote or self.store.status(bid, fname) != 'running':
+                # its exit gets acked and that's that
+                continue
+            remote = self.remote[job] = self.adopted[job] = RemoteJob(name)
+            remote.error = d.get('error')
+            remote.returncode = -1 if d['rc'] is None else d['rc']
+            logging.info("Picked up %s, it finished on %s while we were gone",
+                         job, name, extra = dispatcher.job_fields(job))
+        for job, remote in self.remote.items():
+            if remote.node == name and job not in running and \
+                    job not in done and remote.returncode is None:
+                remote.error = 'lost, %s doesn\'t know about it' % name
+                remote.returncode = -1
+
+    #### scheduling ####
+
+    def gpu_groups(self, available_GPUs):
+        """ same as the Dispatcher's, but a job's GPUs are all on one node """
+        by_node = {}
+        for g in available_GPUs:
+            by_node.setdefault(split_id(g)[0], []).append(g)
+        groups = []
+        for gpus in by_node.values():
+            groups += [gpus[i:i + self.spread]
+                       for i in range(0, len(gpus) - self.spread + 1,
+                                      self.spread)]
+        if not groups and available_GPUs:
+            groups = [next(iter(by_node.values()))[:self.spread]]
+        return groups
+
+    def schedule_jobs(self, job_queue, running_jobs):
+        running_jobs.update(self.adopted)
+        self.adopted = {}
+        self.job_queue = job_queue
+        return super().schedule_jobs(job_queue, running_jobs)
+
+    def sync_queue(self, job_queue, in_queue = None, in_sweeps = None):
+        super().sync_queue(job_queue, in_queue, in_sweeps)
+
+        # the batch folder of a running job goes away when the batch gets
+        # killed (or deleted), so the agent has to kill it
+        for job, remote in self.remote.items():
+            if remote.killed or remote.returncode is not None or \
+                    os.path.isdir(os.path.dirname(job)):
+                continue
+            node = self.nodes.get(remote.node)
+            if node is None:
+                # it gets killed once the agent is back
+                continue
+            try:
+                node.conn.send(op = 'kill', job = job)
+                remote.killed = True
+            except OSError as err:
+                self.drop(node.conn, err)
+
+    def gauges(self, job_queue, running_jobs):
+        super().gauges(job_queue, running_jobs)
+        self.metrics.set('agents', len(self.nodes))
+
+    #### running jobs on agents ####
+
+    def spawn(self, current_job, path, gpus, running_jobs):
+        """ send the script at [path] to the agent that has [gpus] """
+        name = split_id(gpus[0])[0]
+        local = [split_id(g)[1] for g in gpus]
+        logging.info("Running job %s on %s GPU #%s...", current_job, name,
+                     ",".join(local), extra = dispatcher.job_fields(
+                        current_job, gpus = ",".join(gpus)))
+
+        try:
+            with open(path, 'rb') as f:
+                script = f.read().decode('utf-8', 'surrogateescape')
+            mode = os.stat(path).st_mode & 0o7777
+        except FileNotFoundError as err:
+            # a sweep's template, its batch got killed since the queue was
+            # synced
+            self.drop(current_job, err)
+            return False
+
+        bid, fname = dispatcher.job_key(current_job)
+        env, cpus = self.job_vars(current_job, local)
+        point = self.points.get(current_job)
+        node = self.nodes.get(name)
+        try:
+            if node is None:
+                raise OSError('not connected')
+            node.conn.send(op = 'run', job = current_job, batch = bid,
+                           name = fname, script = script, mode = mode,
+                           env = env, args = self.job_args(current_job),
+                           cpus = cpus, params = point and point[2])
+        except OSError as err:
+            if node is not None:
+                self.drop(node.conn, err)
+            self.requeue(current_job, path)
+            return False
+
+        job = RemoteJob(name)
+        running_jobs[current_job] = self.remote[current_job] = job
+        self.held[current_job] = gpus
+        self.on_launch(current_job)
+        self.mark(  store = self.store,
+                    job = current_job,
+                    pid = None,
+                    status = 'running')
+        return True
+
+    def requeue(self, job, path):
+        """ [job] never got to its agent, it goes back where it was """
+        logging.warning("Couldn't send %s to its agent, putting it back in "
+                        "the queue", job, extra = dispatcher.job_fields(job))
+        if job not in self.points:
+            shutil.move(path, job)
+        # its turn is given back, the next sync would have it anyway
+        self.enqueue(self.job_queue, job, refund = True)
+
+    def finish(self, job_name, running):
+        job = running[job_name]
+        self.remote.pop(job_name, None)
+        if job.error is None and not job.killed:
+            super().finish(job_name, running)
+        else:
+            self.failed(job_name, job, running)
+        # it's marked and out of the run folder, the agent can let go of it
+        self.ack(job.node, job_name)
+
+    def failed(self, job_name, job, running):
+        """ [job] couldn't run on its agent or got killed there """
+
+        if job.error is not None:
+            logging.warning("%s couldn't run on %s: %s", job_name, job.node,
+                            job.error, extra = dispatcher.job_fields(job_name,
+                                                        status = 'failed'))
+            self.metrics.inc('launch_failures_total')
+            self.metrics.inc('launch_failures_per_minute')
+            status = 'failed'
+        else:
+            logging.info("%s killed on %s", job_name, job.node,
+                         extra = dispatcher.job_fields(job_name,
+                                                       status = 'killed'))
+            status = 'killed'
+        self.mark(store = self.store, job = job_name, pid = None,
+                  status = status)
+        self.move_out(job_name, 'failed')
+        del running[job_name]
+        self.held.pop(job_name, None)
+        self.points.pop(job_name, None)
+
+    def ack(self, name, job):
+        """
+            tell the agent [name] we're done with the exit of [job], if it's
+            not there it tells us again when it's back and gets it then
+        """
+        node = self.nodes.get(name)
+        if node is None:
+            return
+        try:
+            node.conn.send(op = 'ack', job = job)
+        except OSError as err:
+            self.drop(node.conn, err)
+
+    def adopt(self, running_jobs):
+        # nothing runs here, the agents say what they're running (see hello)
+        pass
+
+    def main(self):
+        try:
+            super().main()
+        finally:
+            if self.server is not None:
+                self.server.close()
+
+#### the agent's end ####
+
+class Agent():
+    """Agent.
+
+        Runs on each GPU box, next to nothing else: connects to the
+        coordinator at [coordinator] (same addresses as Coordinator's
+        listen), tells it what GPUs there are (from [gpus], a gpu.GPUProvider)
+        every [report] seconds and whenever a job exits, and runs the jobs
+        it's sent.
+
+        Scripts go in [run]/batch-<id>/ while they run, their stdout and
+        stderr in [log_root]/batch-<id>/<script>/, like the dispatcher's.
+        If the coordinator goes away the jobs keep running and their exits
+        are kept until it's back (we try again every [retry] seconds).
+    """
+    def __init__(self, coordinator, key, run, log_root = None, name = None,
+                 gpus = None, report = 5, retry = 5):
+        self.coordinator = coordinator
+        self.key = key
+        self.run = run
+        self.log_root = log_root or os.path.join(run, 'logs')
+        self.name = name or socket.gethostname().split('.')[0]
+        self.gpus = gpus if gpus is not None else gpu.SMIProvider()
+        self.report = report
+        self.retry = retry
+        self.conn = None
+        self.jobs = {} # job -> (Popen, script path, gpus)
+        self.done = {} # job -> exit message the coordinator hasn't acked
+
+    def serve(self):
+        """ forever """
+        os.makedirs(self.run, exist_ok = True)
+        reported = retried = 0
+        while True:
+            if self.conn is None and time.monotonic() - retried >= self.retry:
+                retried = time.monotonic()
+                self.connect()
+            if self.conn is not None and \
+                    time.monotonic() - reported >= self.report:
+                reported = time.monotonic()
+                self.send(op = 'devices', devices = self.gpus.devices())
+
+            # a job exiting doesn't wake us up, so don't sleep long with jobs
+            # around
+            timeout = 0.1 if self.jobs else 1
+            if self.conn is not None:
+                ready = self.selector.select(timeout)
+                if ready:
+                    self.receive()
+            else:
+                time.sleep(timeout)
+            if self.reap():
+                self.send(op = 'devices', devices = self.gpus.devices())
+
+    def connect(self):
+        family, address = parse_address(self.coordinator)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(10)
+        try:
+            sock.connect(address)
+            conn = Connection(sock)
+            challenge = conn.wait()
+            nonce = os.urandom(16).hex()
+            conn.send(op = 'hello', name = self.name, nonce = nonce,
+                      auth = sign(self.key, challenge['nonce']),
+                      devices = self.gpus.devices(),
+                      running = [{'job': job, 'pid': p.pid, 'gpus': gpus}
+                                 for job, (p, _, gpus) in self.jobs.items()],
+                      done = list(self.done.values()))
+            welcome = conn.wait()
+            if not hmac.compare_digest(str(welcome.get('auth')),
+                                       sign(self.key, nonce)):
+                raise ValueError('the coordinator doesn\'t have our key')
+        except (OSError, EOFError, ValueError, KeyError) as err:
+            logging.warning("Couldn't connect to %s: %s", self.coordinator, err)
+            sock.close()
+            return
+        logging.info("Connected to %s as %s", self.coordinator, self.name)
+        self.conn = conn
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(sock, selectors.EVENT_READ)
+        # and whatever exited while we were away
+        for msg in list(self.done.values()):
+            self.send(**msg)
+        # it might not have waited for us to read the welcome
+        self.handle(conn.buffered())
+
+    def disconnect(self, why):
+        logging.warning("Lost the coordinator (%s), %d job(s) keep running",
+                        why, len(self.jobs))
+        self.selector.close()
+        self.conn.close()
+        self.conn = None
+
+    def send(self, **msg):
+        if self.conn is None:
+            return
+        try:
+            self.conn.send(**msg)
+        except OSError as err:
+            self.disconnect(err)
+
+    def receive(self):
+        try:
+            messages = self.conn.receive()
+        except (OSError, EOFError, ValueError) as err:
+            self.disconnect(err)
+            return
+        self.handle(messages)
+
+    def handle(self, messages):
+        for msg in messages:
+            op = msg.get('op')
+            if op == 'run':
+                self.start(msg)
+            elif op == 'kill':
+                self.kill(msg['job'])
+            elif op == 'ack':
+                self.done.pop(msg['job'], None)
+
+    def start(self, msg):
+        job = msg['job']
+        folder = os.path.join(self.run, 'batch-%d' % msg['batch'])
+        path = os.path.join(folder, msg['name'])
+        log_dir = os.path.join(self.log_root, 'batch-%d' % msg['batch'],
+                               os.path.splitext(msg['name'])[0])
+        try:
+            os.makedirs(folder, exist_ok = True)
+            with open(path, 'wb') as f:
+                f.write(msg['script'].encode('utf-8', 'surrogateescape'))
+            os.chmod(path, msg['mode'])
+        except OSError as err:
+            self.exited(job, None, str(err))
+            return
+
+        try:
+            stdout, stderr = capture.open_files(log_dir)
+            if msg.get('params') is not None:
+                with open(os.path.join(log_dir, 'params.json'), 'w') as f:
+                    json.dump(msg['params'], f)
+        except OSError as err:
+            logging.warning("Can't keep the output of %s in %s: %s", job,
+                            log_dir, err)
+            stdout = stderr = log_dir = None
+
+        env = dict(os.environ)
+        env.update(msg['env'])
+        pin = running.pinning(msg.get('cpus'))
+        if msg.get('cpus') and pin is None:
+            logging.warning("Can't pin %s to CPUs %s, running it unpinned",
+                            job, msg['cpus'])
+        try:
+            try:
+                p = subprocess.Popen([path] + msg['args'], env = env,
+                                     stdout = stdout, stderr = stderr,
+                                     start_new_session = True,
+                                     preexec_fn = pin)
+            finally:
+                for f in (stdout, stderr):
+                    if f is not None:
+                        f.close()
+        except OSError as err:
+            os.remove(path)
+            self.exited(job, None, str(err))
+            return
+
+        gpus = msg['env'].get('CUDA_VISIBLE_DEVICES', '').split(',')
+        self.jobs[job] = (p, path, [g for g in gpus if g])
+        logging.info("Running %s as %d", job, p.pid)
+        self.send(op = 'started', job = job, pid = p.pid, log_dir = log_dir)
+
+    def kill(self, job):
+        if job in self.jobs:
+            logging.info("Killing %s", job)
+            try:
+                # and whatever it started, like the dispatcher does
+                running.kill_group(self.jobs[job][0].pid)
+            except ProcessLookupError:
+                # it exited already, reap tells the coordinator
+                pass
+
+    def reap(self):
+        """ tell the coordinator about jobs that exited, True if any did """
+        exited = False
+        for job, (p, path, _) in list(self.jobs.items()):
+            rc = p.poll()
+            if rc is None:
+                continue
+            del self.jobs[job]
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            logging.info("%s returned %d", job, rc)
+            self.exited(job, rc, None)
+            exited = True
+        return exited
+
+    def exited(self, job, rc, error):
+        self.done[job] = {'op': 'exit', 'job': job, 'rc': rc, 'error': error}
+        self.send(**self.done[job])
@@ -0,0 +1,119 @@
+import json
+import logging
+import os
+import socket
+
+__all__ = [
+    'serve',
+    'accept',
+    'Request',
+    'send',
+    'COMMANDS',
+]
+
+# what a dispatcher can be told, see Dispatcher.command
+COMMANDS = ['status', 'pause', 'resume', 'drain', 'shutdown']
+
+def serve(path):
+    """
+        A unix socket at [path] for the dispatcher's loop to watch, None (and
+        a warning) if it can't have one. Only we can connect to it.
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(path)
+        os.chmod(path, 0o600)
+        server.listen(8)
+    except OSError as err:
+        # most likely a path over the ~100 characters unix sockets get
+        logging.warning("Can't listen for commands at %s: %s", path, err)
+        server.close()
+        return None
+    server.setblocking(False)
+    return server
+
+def accept(server):
+    """
+        The next connection on [server] as a Request, None if there isn't
+        one. Nothing is read yet, the dispatcher's loop watches it for that
+        (see Dispatcher.on_control).
+    """
+    try:
+        conn, _ = server.accept()
+    except BlockingIOError:
+        return None
+    return Request(conn)
+
+class Request():
+    """
+        A connection to the control socket, read as it comes in so somebody
+        connecting and sending nothing (or half a line) doesn't hold the
+        dispatcher up. The request is one line of JSON, a dict, and the
+        answer is too.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.conn.setblocking(False)
+        self.data = b''
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def read(self):
+        """
+            Read what's there (call it when it's readable), True once the
+            whole request is in (or it never will be).
+        """
+        try:
+            chunk = self.conn.recv(4096)
+        except BlockingIOError:
+            return False
+        except OSError:
+            chunk = b''
+        self.data += chunk
+        return not chunk or self.data.endswith(b'\n') or \
+            len(self.data) >= 2**16
+
+    def answer(self, handle):
+        """ answer the request with handle(request) and hang up """
+        with self.conn:
+            try:
+                request = json.loads(self.data)
+                if not isinstance(request, dict):
+                    raise TypeError('A request is a JSON object, not %s'
+                                    % type(request).__name__)
+                reply = dict(handle(request), ok = True)
+            except (KeyError, TypeError, ValueError) as err:
+                reply = {'ok': False, 'error': str(err)}
+            try:
+                # a few hundred bytes, there's room for that
+                self.conn.sendall(json.dumps(reply).encode() + b'\n')
+            except OSError as err:
+                logging.warning("Bad command connection: %s", err)
+
+    def close(self):
+        self.conn.close()
+
+def send(path, op, timeout = 5, **args):
+    """
+        Tell the dispatcher listening at [path] to [op] (one of COMMANDS),
+        returns its reply: ok, the state it's in now and how many jobs are
+        running and queued. Raises OSError if there's nobody there.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(timeout)
+        s.connect(path)
+        s.sendall(json.dumps(dict(args, op = op)).encode() + b'\n')
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = s.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+    if not data:
+        raise ConnectionResetError('No answer from %s' % path)
+    return json.loads(data)
@@ -1,12 +1,24 @@
+import asyncio
+import functools
+import json
 import multiprocessing as mp
 import os
+import re
+import selectors
 import shutil
-from collections import deque
+import signal
 import subprocess
-import datetime
+import errno
 import time
 import logging
-from queue import Empty
+
+from base import (capture, control, gpu, jobqueue, logs, metrics, running,
+                  sweep, watcher)
+
+# what we set to keep a job's thread pools down to its share of the CPUs
+THREAD_VARS = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']
+# how much of the end of a job's stderr retry_patterns look at
+STDERR_TAIL = 2**16
 
 class Dispatcher():
     """Dispatcher.
@@ -16,8 +28,39 @@ class Dispatcher():
         [wait] seconds and then checks the GPU for any free GPUs. It does this
         using the multiprocessing python module.
 
+        When inotify is available the queue directory is watched instead of
+        rescanned, so newly loaded scripts wake the dispatcher right away and
+        [wait] only bounds how long we sleep when nothing is happening.
+
+        Running jobs are followed through pidfds (or SIGCHLD on systems that
+        don't have them), so a job finishing wakes the dispatcher up too and
+        its GPUs get handed out again right away.
+
+        Sweep batches (see sweep.py) are one template and a manifest in the
+        batch folder, their points are queued as they're needed and the
+        template is run in place for each one, nothing gets moved around.
+
+        What's running is also kept on disk (see running.py), and jobs run
+        in their own session, so they outlive the dispatcher. A dispatcher
+        that starts up where another one died (or got stopped) picks up the
+        jobs that are still going and records how the others went, instead
+        of leaving them 'running' forever and their GPUs taken.
+
+        It takes commands on a unix socket, [dir]/control.sock (see
+        control.py and command()): pause and resume launching, drain (stop
+        launching, keep reaping what's running) and shut down once the
+        running jobs are done, or a deadline passes, whichever comes first.
+
+        Batches can ask for jobs that fail to be retried (see retry()),
+        they go back in the queue after a backoff, script and all.
+
     """
-    def __init__(self, run, queue, wait, spread, block, q):
+    def __init__(self, run, queue, wait, spread, block, store, watch = 'auto',
+                 gpus = None, schedule = 'exclusive', lookahead = 100,
+                 share = 'batch', serve_metrics = None, dump_metrics = None,
+                 dump_interval = 60, log_level = 'INFO', log_size = 10 * 2**20,
+                 log_backups = 5, log_root = None, output_cap = None,
+                 output_keep = 'head'):
         """
             run    :   run/execution directory
             dir    :   main directory where all the folders will be, based on
@@ -25,6 +68,31 @@ class Dispatcher():
             wait   :   wait time in between checking for new scripts
             spread :   spread range to spread GPU's over (is an integer)
             block  :   list of GPUs to block (so we can use them for debugging)
+            store  :   proxy to the state service (see store.py)
+            watch  :   how to watch the queue directory, 'inotify' | 'poll' |
+                       'auto' (inotify, falling back to polling)
+            gpus   :   where GPU inventory comes from, a gpu.GPUProvider
+                       (defaults to asking nvidia-smi every time)
+            schedule : 'exclusive' (a job gets [spread] idle GPUs to itself)
+                       or 'pack' (jobs share GPUs by memory, see pack())
+            lookahead : how far down the queue 'pack' looks for jobs that fit
+            share  :   what gets a fair share of the GPUs, each 'batch' or
+                       each 'label' (see jobqueue.py)
+            serve_metrics : where to serve the metrics over HTTP (see
+                       metrics.serve), e.g. '127.0.0.1:9464' or
+                       'unix:/tmp/maestro.sock'. Not served if None.
+            dump_metrics : file to write the metrics to as JSON every
+                       [dump_interval] seconds, if any
+            log_level : how chatty logfile.jsonl is ('DEBUG', 'INFO', ...)
+            log_size : bytes the log grows to before it's rotated (and the
+                       old one gzipped), [log_backups] of those are kept
+            log_root : where every job's stdout and stderr go, in
+                       [log_root]/batch-<id>/<script name>/ (default:
+                       [dir]/logs). That folder is the process' log_dir.
+            output_cap : keep at most this many bytes of each of a job's
+                       stdout and stderr, the first ones or the last ones
+                       ([output_keep] 'head' or 'tail'). None for everything,
+                       in which case the job writes to its files directly.
         """
 
         self.run = run
@@ -33,7 +101,45 @@ class Dispatcher():
         self.wait = wait
         self.spread = spread
         self.block = block
-        self.q = q
+        self.store = store
+        self.watch = watch
+        self.gpus = gpus if gpus is not None else gpu.SMIProvider()
+        self.schedule = schedule
+        self.lookahead = lookahead
+        self.share = share
+        self.serve_metrics = serve_metrics
+        self.dump_metrics = dump_metrics
+        self.dump_interval = dump_interval
+        self.log_level = log_level
+        self.log_size = log_size
+        self.log_backups = log_backups
+        self.log_root = log_root or os.path.join(self.dir, 'logs')
+        self.output_cap = output_cap
+        self.output_keep = output_keep
+        self.outputs = {} # job -> its capture.Captures, if it has any
+        self.endings = {} # job -> the end of its stderr, if it's not on file
+        self.listener = None
+        self.metrics = metrics.Metrics()
+        self.queued_at = {} # job -> when it got into the queue
+        self.devices_seen = None # the last GPU inventory we got
+        self.watcher = None
+        self.waiting = None
+        self.held = {} # job -> GPUs our own running jobs are on
+        self.batch_info = {} # batch id -> (label, options), see batch()
+        self.options_rev = 0 # how up to date batch_info is, see refresh()
+        self.sweeps = {} # batch id -> sweep.Points (None if it's unreadable)
+        self.points = {} # sweep job -> (Points, index, params), while it's
+                         # queued one by one or running
+        self.selector = None
+        self.exits = {} # job -> pidfd that turns readable when it exits
+        self.table = running.RunningTable(os.path.join(self.dir, 'running'))
+        self.control_path = os.path.join(self.dir, 'control.sock')
+        self.control = None # the socket commands come in on
+        self.requests = set() # connections to it we're still reading
+        self.mode = 'running' # | 'paused' | 'draining' | 'stopping'
+        self.deadline = None # when 'stopping' stops waiting for jobs
+        self.running = {} # job -> its Popen (or stand-in), see main
+        self.job_queue = None
 
         dirs = ['completed', 'failed', 'queue']
 
@@ -42,7 +148,7 @@ class Dispatcher():
             d = os.path.join(self.dir, d)
             os.makedirs(d, exist_ok = True)
 
-        self.p = mp.Process(target=self.dispatch, args=(self.q, ))
+        self.p = mp.Process(target=self.dispatch, args=(self.store, ))
 
     def start(self):
         """
@@ -51,71 +157,55 @@ class Dispatcher():
         self.p.start()
         return self.p.pid
 
-    def stop(self, pid):
+    def stop(self, deadline = None):
         """
-            Stop the dispatcher. We shouldn't use terminate here.
+            Stop the dispatcher we started: ask it to shut down once its jobs
+            are done, or after [deadline] seconds (the ones still running are
+            left to the next dispatcher), and only terminate it if it doesn't
+            answer. Returns False if it wasn't running.
         """
-        try:
-            psutil.Process(self.pid).kill()
-            return True
-        except NoSuchProcess:
+        if not self.p.is_alive():
             return False
+        try:
+            control.send(self.control_path, 'shutdown', deadline = deadline)
+        except OSError:
+            self.p.terminate()
+        return True
 
     def get_files(self):
         """
             Get the list of files in the queue directory that are shell files
         """
-        l = []
-        with os.scandir(self.queue) as it:
-            for f in it:
-                if f.is_dir():
-                    folder = os.path.join(self.queue, f.name)
-                    for file in os.listdir(folder):
-                        file = os.path.join(folder, file)
-                        l.append(file) if file.endswith('.sh') else None
-        return l
-
-    def gpu(self):
-        """
-            Check for available GPUs using NVIDIA's PMON tool.
-            Hopefully you have NVIDIA GPUs, otherwise this won't work.
-        """
-        # Nvidia-smi's process monitoring system with count 1
-        sp = subprocess.Popen(['nvidia-smi', 'pmon', '-c', '1'],
-                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-        out_str = sp.communicate()
-        out_list = list(filter(None, out_str[0].decode("utf-8").split('\n')))
-
-        gpu_info = []
-        # We skip the first two lines because it has the column names
-        for line in out_list:
-            exploded_info = [x for x in line.split(' ') if x != '']
-            gpu_info.append(exploded_info)
-
-        available_GPUs = []
-        for gpu in gpu_info:
-            gpu_id = gpu[0]
-            gpu_pid = gpu[1]
-
-            # this is what nvidia-smi pmon -c 1 uses to say that there's no process
-            # thankfully, if nvidia-smi pmon -c 1 screws up, which it might
-            # this will skip over the column identifiers
-            if gpu_pid == '-':
-                available_GPUs.append(gpu_id)
+        if self.watcher is None:
+            return watcher.PollWatcher(self.queue).files()
+        return self.watcher.files()
+
+    def get_sweeps(self):
+        """ the batch folders in the queue directory that are sweeps """
+        if self.watcher is None:
+            return watcher.PollWatcher(self.queue).sweeps()
+        return self.watcher.sweeps()
+
+    def gpu(self, devices = None):
+        """
+            Check for available GPUs (that aren't blocked) with whatever GPU
+            provider we were given, or in [devices] if we already asked.
+        """
+        if devices is None:
+            devices = self.gpus.devices()
+        available_GPUs = [d.id for d in devices if d.procs == 0]
+
+        # a job we just started might not show up on the GPU for a while, so
+        # don't trust the provider with GPUs our own jobs are sitting on
+        held = set(g for gpus in self.held.values() for g in gpus)
+        available_GPUs = [g for g in available_GPUs if g not in held]
 
         if self.block:
-            for b in self.block:
-                if b in available_GPUs:
-                    available_GPUs.remove(b)
+            block = [str(b) for b in self.block]
+            available_GPUs = [g for g in available_GPUs if g not in block]
 
         return available_GPUs
 
-    '''
-    def gpu(self):
-        return ['0','1','2','3']
-    '''
-
     def check_jobs(self, running):
         """ Void function that checks the global running jobs list
         and checks if any are completed and to remove them from the list.
@@ -125,172 +215,1581 @@ class Dispatcher():
         """
         if running:
             for job_name in list(running.keys()):
-                process = running[job_name]
-                if process.poll() is not None:
-
-                    logging.info('Found completed process... Checking '
-                    'return code.')
-
-                    if process.poll() == 0:
-                        logging.info("%s returned %d", job_name,
-                        process.poll())
-                        self.mark(  q = self.q,
-                                    job = job_name,
-                                    pid = process.pid,
-                                    status = 'completed')
-
-                        # move to completed folder
-
-                        completed = os.path.join(self.dir, 'completed')
-                        fname = os.path.basename(job_name)
-                        shutil.move(os.path.join(self.run, fname),
-                                                os.path.join(completed,fname))
-
-                    else:
-                        logging.warning("%s returned %d", job_name,
-                        process.poll())
-                        if process.poll() != -9:
-                            self.mark(  q = self.q,
-                                    job = job_name,
-                                    pid = process.pid,
-                                    status = 'failed')
-
-                        failed = os.path.join(self.dir, 'failed')
-                        fname = os.path.basename(job_name)
-                        shutil.move(os.path.join(self.run, fname),
-                                                os.path.join(failed, fname))
-
-
-                    # Remove job from running jobs
-                    del running[job_name]
-
-    def mark(self, q, pid, job, status):
-        # we get the filename from the job's path:
+                if running[job_name].poll() is not None:
+                    self.finish(job_name, running)
+
+    def finish(self, job_name, running):
+        """
+            [job_name] exited: record how it went, move its script out of the
+            run directory (or back to the queue, if it gets another go) and
+            forget about it.
+        """
+        logging.debug('Found completed process... Checking '
+        'return code.')
+
+        # with all of its output in first (a retry might want to look at it)
+        self.unfollow(job_name)
+        self.close_output(job_name)
+        self.settle(job_name, running,
+                    self.outcome(job_name, running[job_name]))
+
+    def outcome(self, job, process):
+        """
+            How [job] went, given its exited [process]: (status, plan), with
+            status 'completed', 'failed', 'killed' (it's marked as such
+            already) or 'retry', then plan is what retry_plan() came up with.
+
+            This is the part of finish that asks the state service and moves
+            files around, the async engine runs it in a thread.
+        """
+        rc = process.poll()
+        if rc == 0:
+            return 'completed', None
+        if rc == -9:
+            if not self.vanished(job, process):
+                return 'killed', None
+            # lost in a crash (or a reboot), that's no reason to run it again
+            return 'failed', None
+        plan = self.retry_plan(job, process.pid, rc)
+        if plan is not None:
+            return 'retry', plan
+        return 'failed', None
+
+    def settle(self, job_name, running, outcome):
+        """ the rest of finish, with the [outcome] of [job_name] """
+        status, plan = outcome
+        process = running.pop(job_name)
+        self.held.pop(job_name, None)
+        self.endings.pop(job_name, None)
+
+        if status == 'retry':
+            self.retry(job_name, process.pid, process.poll(), plan)
+            self.forget(job_name, process.pid)
+            return
+
+        if status == 'completed':
+            logging.info("%s returned %d", job_name,
+            process.poll(), extra = job_fields(job_name, status = 'completed',
+                                               pid = process.pid, rc = 0))
+            self.metrics.inc('completed_total')
+            self.mark(  store = self.store,
+                        job = job_name,
+                        pid = process.pid,
+                        status = 'completed')
+
+            # move to completed folder
+            self.move_out(job_name, 'completed')
+
+        else:
+            logging.warning("%s returned %d", job_name,
+            process.poll(), extra = job_fields(job_name, status = 'failed',
+                                    pid = process.pid, rc = process.poll()))
+            self.metrics.inc('failed_total')
+            if status == 'failed':
+                self.mark(  store = self.store,
+                        job = job_name,
+                        pid = process.pid,
+                        status = 'failed')
+
+            self.move_out(job_name, 'failed')
+
+        self.points.pop(job_name, None)
+        self.forget(job_name, process.pid)
+
+    def forget(self, job, pid):
+        """
+            [job] (that ran as [pid]) is marked, the next dispatcher has
+            nothing to pick up. Only after the mark: if we die before it, the
+            running table is how the next one finds out how it went.
+        """
+        self.table.remove(job, pid)
+
+    def vanished(self, job, process):
+        """
+            Whether [process] is a job we picked up after a restart that's
+            gone without saying how it went, and not because it got killed
+            (that's marked already).
+        """
+        if not getattr(process, 'lost', False):
+            return False
+        bid, fname = job_key(job)
+        return self.store.status(bid, fname) == 'running'
+
+    #### retries ####
+
+    def retry_plan(self, job, pid, rc):
+        """
+            Whether [job] (that exited with [rc]) gets another go later, if
+            its batch says so: None if it doesn't, otherwise (attempt, delay,
+            tries, limit) for retry(). Batch options that matter here:
+
+                max_attempts   :   how many times a job gets to run (default
+                                   1, no retries)
+                backoff        :   seconds before the first retry (default
+                                   30), doubled for every one after that...
+                backoff_max    :   ...up to this (default 3600)
+                retry_codes    :   exit codes worth a retry
+                retry_patterns :   regular expressions, a retry if one of them
+                                   is in the end of the job's stderr (CUDA out
+                                   of memory, an NCCL error, ...)
+
+            With neither retry_codes nor retry_patterns any failure is worth a
+            retry, with both either one will do. Killed jobs never are.
+
+            The script goes back to its batch folder here (moved, not copied)
+            and its output so far is kept in attempt-<n>/ in its log folder.
+        """
+        options = self.options(job)
+        limit = options.get('max_attempts', 1)
+        if limit <= 1 or self.job_queue is None:
+            return None
+        reason = self.retry_reason(job, rc, options)
+        if reason is None:
+            return None
+        bid, fname = job_key(job)
+        tries = self.store.attempts(bid, fname) + 1 # this one too
+        if tries >= limit:
+            logging.info("%s failed (%s) on its last attempt (%d)", job,
+                         reason, limit, extra = job_fields(job, rc = rc))
+            return None
+        if not self.move_back(job):
+            return None
+
+        delay = min(options.get('backoff', 30) * 2 ** (tries - 1),
+                    options.get('backoff_max', 3600))
+        attempt = {'pid': pid, 'rc': rc, 'reason': reason,
+                   'ended': time.time(),
+                   'log_dir': self.keep_output(job, tries)}
+        return attempt, delay, tries, limit
+
+    def retry(self, job, pid, rc, plan):
+        """
+            [job] goes back in the queue, deferred until its backoff is up,
+            and the state keeps what happened in the process' attempts.
+        """
+        attempt, delay, tries, limit = plan
+        self.record_retry(job, attempt)
+        self.defer(job, delay)
+        self.metrics.inc('retries_total')
+        logging.warning("%s returned %d (%s), retrying in %gs (attempt %d "
+                        "of %d)", job, rc, attempt['reason'], delay,
+                        tries + 1, limit,
+                        extra = job_fields(job, status = 'queued', pid = pid,
+                                           rc = rc))
+
+    def retry_reason(self, job, rc, options):
+        """ why [job] exiting with [rc] is worth a retry, None if it isn't """
+        codes = options.get('retry_codes')
+        patterns = options.get('retry_patterns')
+        if not codes and not patterns or codes and rc in codes:
+            return 'exit code %d' % rc
+        if patterns:
+            tail = self.stderr_tail(job)
+            for pattern in patterns:
+                try:
+                    if re.search(pattern, tail):
+                        return 'stderr matched %r' % pattern
+                except re.error as err:
+                    logging.warning("Bad retry pattern %r: %s", pattern, err,
+                                    extra = job_fields(job))
+        return None
+
+    def stderr_tail(self, job, size = STDERR_TAIL):
+        """ the last [size] bytes [job] wrote to stderr, as text """
+        if job in self.endings:
+            # capped, what's on file is how it started
+            return self.endings[job][-size:].decode(errors = 'replace')
+        try:
+            with open(os.path.join(self.job_log_dir(job), 'stderr'),
+                      'rb') as f:
+                f.seek(0, os.SEEK_END)
+                f.seek(max(0, f.tell() - size))
+                return f.read().decode(errors = 'replace')
+        except OSError:
+            return ''
+
+    def keep_output(self, job, tries):
+        """
+            Move what [job] wrote on attempt [tries] to attempt-<tries>/ in
+            its log folder, so the next one doesn't write over it. Returns
+            where it went, None if there was nothing (it's on an agent).
+        """
+        log_dir = self.job_log_dir(job)
+        kept = os.path.join(log_dir, 'attempt-%d' % tries)
+        moved = False
+        for name in ['stdout', 'stderr']:
+            try:
+                os.makedirs(kept, exist_ok = True)
+                os.replace(os.path.join(log_dir, name),
+                           os.path.join(kept, name))
+                moved = True
+            except OSError:
+                pass
+        return kept if moved else None
+
+    def move_back(self, job):
+        """
+            Put a script that ran back in its batch folder, False if it
+            can't go back (the batch got killed or deleted since).
+        """
+        if job in self.points:
+            # a sweep's point, there's no script of its own
+            return job_key(job)[0] in self.sweeps
+        try:
+            shutil.move(os.path.join(self.run, os.path.basename(job)), job)
+            return True
+        except OSError:
+            return False
+
+    def record_retry(self, job, attempt):
+        bid, fname = job_key(job)
+        with self.metrics.timer('state_update_seconds'):
+            self.store.retry(bid, fname, attempt)
+
+    def defer(self, job, delay):
+        """ [job] goes back in the queue in [delay] seconds, see release """
+        bid, _ = job_key(job)
+        self.job_queue.defer(job, bid, time.monotonic() + delay)
+
+    def release(self, job_queue):
+        """
+            Jobs whose backoff is up can be launched again, unless their
+            batch got killed or deleted in the meantime.
+        """
+        for job in job_queue.due(time.monotonic()):
+            if job in self.points or os.path.exists(job):
+                self.enqueue(job_queue, job)
+
+    #### picking up after another dispatcher ####
+
+    def adopt(self, running_jobs):
+        """
+            Take over the jobs in the running table, from a dispatcher that
+            isn't around anymore. The ones still going are followed like our
+            own and keep their GPUs, the ones that exited in the meantime get
+            reaped on the first tick.
+        """
+        alive = done = 0
+        for record in self.table.load():
+            job = record['job']
+            process = running.Adopted(record)
+            running_jobs[job] = process
+            if process.poll() is None:
+                alive += 1
+                self.held[job] = record['gpus']
+                self.follow(job, process.pid)
+                logging.info("Picked up %s, still running as %d", job,
+                             process.pid, extra = job_fields(job,
+                                        status = 'running', pid = process.pid))
+            else:
+                done += 1
+        if alive or done:
+            logging.info("Picked up %d running job(s) from the last "
+                         "dispatcher, %d more finished while it was gone",
+                         alive, done, extra = {'count': alive + done})
+
+    def move_in(self, job):
+        """ move a queued script into the run directory, returns where it went """
+        if job in self.points:
+            # a sweep's points all run its template, right where it is
+            return self.points[job][0].template
+        path = os.path.join(self.run, os.path.basename(job))
+        shutil.move(job, path)
+        return path
+
+    def move_out(self, job, folder):
+        """ move a script that ran from the run directory to [folder] """
+        if job in self.points:
+            return
         fname = os.path.basename(job)
-        # then we get the batch id from the job's path:
-        # will be of the form /a/b/c/file.sh
-        # so we do len(job) - len(fname) - 1 to get "batch-id"
-        # then we do basename on that and remove "batch-" which is [6:]
-        bid = os.path.basename(job[:len(job) - len(fname) - 1])[6:]
-        # then we mark the process' status
-        empty = True
-        while empty:
-            time.sleep(1)
+        try:
+            shutil.move(os.path.join(self.run, fname),
+                                os.path.join(self.dir, folder, fname))
+        except FileNotFoundError:
+            # a sweep's point we picked up after a restart (it ran its
+            # template in place), or somebody cleaned up the run directory
+            logging.debug("%s isn't in the run directory anymore", fname,
+                          extra = job_fields(job))
+
+    def mark(self, store, pid, job, status, log_dir = None):
+        # jobs live in [queue]/batch-<id>/<file>.sh, that's all the state
+        # service needs to find the process
+        bid, fname = job_key(job)
+        # then we tell the state service, which is one small message
+        with self.metrics.timer('state_update_seconds'):
+            store.mark(bid, fname, pid, status, log_dir)
+
+    def setup_logging(self, engine = ''):
+        """
+            Log to [dir]/logfile.jsonl, one JSON object per line, written
+            (and rotated, and compressed) by a background thread. `maestro.py
+            log` reads it back.
+        """
+        self.listener = logs.setup(os.path.join(self.dir, 'logfile.jsonl'),
+                                   level = self.log_level.upper(),
+                                   max_bytes = self.log_size,
+                                   backups = self.log_backups)
+
+        logging.info('------------ Job Dispatcher Started%s ------------',
+                     engine)
+
+    def listen(self):
+        """
+            Set up everything that can wake us up: the queue watcher (if it
+            has something to select on) and running jobs exiting.
+        """
+        self.selector = selectors.DefaultSelector()
+        if self.watcher.fileno() is not None:
+            self.selector.register(self.watcher.fileno(),
+                                   selectors.EVENT_READ, 'queue')
+        self.exits = {}
+        if not hasattr(os, 'pidfd_open'):
+            self.sigchld()
+        self.control = control.serve(self.control_path)
+        if self.control is not None:
+            self.selector.register(self.control, selectors.EVENT_READ,
+                                   self.on_control)
+
+    def sigchld(self):
+        """
+            No pidfds (old kernel or python), so have SIGCHLD poke a pipe
+            instead. Python writes to the wakeup fd for us.
+        """
+        if self.exits is None:
+            return
+        r, w = os.pipe()
+        os.set_blocking(r, False)
+        os.set_blocking(w, False)
+        signal.set_wakeup_fd(w)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        self.selector.register(r, selectors.EVENT_READ, 'sigchld')
+        self.exits = None
+        logging.info('No pidfd support, listening for SIGCHLD instead')
+
+    def follow(self, job, pid):
+        """ wake up when [job] exits """
+        if self.exits is None or self.selector is None:
+            return
+        try:
+            fd = os.pidfd_open(pid)
+        except ProcessLookupError:
+            # gone already, check_jobs will notice
+            return
+        except OSError:
+            self.sigchld()
+            return
+        self.exits[job] = fd
+        self.selector.register(fd, selectors.EVENT_READ, job)
+
+    def unfollow(self, job):
+        fd = self.exits.pop(job, None) if self.exits else None
+        if fd is not None:
+            self.selector.unregister(fd)
+            os.close(fd)
+
+    def sleep(self, timeout):
+        """
+            Sleep until the queue changes, a job exits or [timeout] seconds go
+            by, whichever comes first. Returns True if something happened.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            events = self.selector.select(max(0, deadline - time.monotonic()))
+            woke = False
+            for key, _ in events:
+                if isinstance(key.data, capture.Capture):
+                    # a job's output, that's not a reason for a tick
+                    if not key.data.read():
+                        self.selector.unregister(key.fd)
+                    continue
+                if callable(key.data):
+                    # somebody else's socket (see cluster.py), it says if
+                    # that was worth a tick
+                    if not key.data():
+                        continue
+                    woke = True
+                    continue
+                woke = True
+                if key.data == 'queue':
+                    self.watcher.read()
+                elif key.data == 'sigchld':
+                    try:
+                        while os.read(key.fd, 512):
+                            pass
+                    except BlockingIOError:
+                        pass
+                # otherwise it's a job's pidfd, check_jobs reaps it
+            if woke or not events or time.monotonic() >= deadline:
+                return woke
+
+    def enqueue(self, job_queue, job, refund = False):
+        """
+            Put [job] in the queue with its batch's priority and weight (from
+            the batch options, 0 and 1 if not given). With [refund] it's a
+            job we popped and couldn't place, so its turn is given back.
+        """
+        bid, _ = job_key(job)
+        label, options = self.batch(job)
+        # requeued or refunded jobs keep the time they first showed up
+        self.queued_at.setdefault(job, time.monotonic())
+        add = job_queue.refund if refund else job_queue.add
+        add(job, bid, label, options.get('priority', 0),
+            options.get('weight', 1))
+
+    def refresh(self, job_queue, news = None):
+        """
+            Pick up batch options that changed (someone reprioritized a batch
+            from the menu) and requeue that batch's jobs accordingly. [news]
+            is what store.options_since said, if somebody asked already.
+        """
+        if news is None:
+            news = self.store.options_since(self.options_rev)
+        rev, changed = news
+        self.options_rev = rev
+        for bid, info in changed.items():
+            self.batch_info[bid] = (info[0], info[1] or {})
+            jobs = job_queue.jobs(bid)
+            if jobs:
+                logging.info("Options of batch %d changed, requeueing its "
+                             "%d job(s)", bid, len(jobs),
+                             extra = {'batch': bid, 'count': len(jobs)})
+            for job in jobs:
+                job_queue.remove(job)
+                self.enqueue(job_queue, job)
+            # and what's left of a sweep
+            left = job_queue.remove_source(bid)
+            if left is not None:
+                self.enqueue_source(job_queue, bid, *left)
+
+    #### commands ####
+
+    def on_control(self):
+        """ someone connected to tell us something, see on_request """
+        request = control.accept(self.control)
+        if request is not None:
+            self.requests.add(request)
+            self.watch_request(request)
+        return False
+
+    def on_request(self, request):
+        """
+            [request] is readable, once it's all there it gets answered,
+            and that's always worth a tick
+        """
+        if not request.read():
+            return False
+        self.unwatch_request(request)
+        self.requests.discard(request)
+        request.answer(self.command)
+        return True
+
+    def watch_request(self, request):
+        self.selector.register(request, selectors.EVENT_READ,
+                               functools.partial(self.on_request, request))
+
+    def unwatch_request(self, request):
+        self.selector.unregister(request)
+
+    def command(self, request):
+        """
+            Do what [request] says (see control.COMMANDS) and return how
+            things stand after it:
+
+                status   :   just that
+                pause    :   stop launching jobs until resume
+                resume   :   launch jobs again
+                drain    :   stop launching, keep reaping what's running, it's
+                             'drained' once nothing is
+                shutdown :   drain, and exit once nothing is running, or
+                             once [deadline] seconds have gone by if given.
+                             Jobs still running then are left running, the
+                             next dispatcher picks them up (see adopt)
+
+            There's no coming back from a shutdown.
+        """
+        op = request.get('op')
+        if op not in control.COMMANDS:
+            raise ValueError('Unknown command %r' % op)
+        if op != 'status':
+            if self.mode == 'stopping' and op != 'shutdown':
+                raise ValueError('Shutting down already')
+            if op == 'shutdown':
+                deadline = request.get('deadline')
+                self.deadline = None
+                if deadline is not None:
+                    self.deadline = time.monotonic() + float(deadline)
+            self.mode = {'pause': 'paused', 'resume': 'running',
+                         'drain': 'draining', 'shutdown': 'stopping'}[op]
+            logging.info("Told to %s, %d job(s) running, %d queued", op,
+                         len(self.running), len(self.job_queue or ()))
+        return self.report()
+
+    def report(self):
+        """ what command() answers with """
+        state = self.mode
+        if state == 'draining' and not self.running:
+            state = 'drained'
+        left = None
+        if self.deadline is not None:
+            left = max(0, self.deadline - time.monotonic())
+        return {'state': state, 'pid': os.getpid(),
+                'running': len(self.running),
+                'queued': len(self.job_queue or ()), 'deadline': left}
+
+    def holding(self):
+        """ True if we aren't launching anything right now (and say why) """
+        if self.mode == 'running':
+            return False
+        if self.mode == 'paused':
+            self.idle('Paused, not launching anything')
+        elif self.mode == 'stopping':
+            self.idle('Shutting down, waiting on the running jobs'
+                      if self.running else None)
+        elif self.running:
+            self.idle('Draining, waiting on the running jobs')
+        else:
+            self.idle('Drained, nothing running')
+        return True
+
+    def finished(self):
+        """ True once a shutdown is done waiting for jobs """
+        if self.mode != 'stopping':
+            return False
+        if self.running and (self.deadline is None or
+                             time.monotonic() < self.deadline):
+            return False
+        if self.running:
+            logging.info("Shutdown deadline passed, leaving %d running "
+                         "job(s) to the next dispatcher", len(self.running),
+                         extra = {'count': len(self.running)})
+            capped = [job for job in self.running if job in self.outputs]
+            if capped:
+                # nobody reads their pipes anymore
+                logging.warning("%d of them have their output capped and "
+                                "will likely die of SIGPIPE", len(capped),
+                                extra = {'count': len(capped)})
+        logging.info('------------ Job Dispatcher Stopped ------------')
+        return True
+
+    def nap(self):
+        """
+            how long to sleep for, a shutdown's deadline or a retry's backoff
+            running out doesn't wait
+        """
+        nap = self.wait
+        if self.mode == 'stopping' and self.deadline is not None:
+            nap = min(nap, self.deadline - time.monotonic())
+        due = self.job_queue.next_due() if self.job_queue is not None else None
+        if due is not None:
+            nap = min(nap, due - time.monotonic())
+        return max(0, nap)
+
+    def sync_queue(self, job_queue, in_queue = None, in_sweeps = None):
+        """
+            Bring [job_queue] up to date with the scripts sitting in the queue
+            directory: new ones go in, removed (killed) ones go away. Same
+            for sweeps, with [in_sweeps] their batch folders.
+        """
+        if in_queue is None:
+            in_queue = self.get_files()
+        if in_sweeps is None:
+            in_sweeps = self.get_sweeps()
+
+        self.refresh(job_queue)
+        self.sync_sweeps(job_queue, in_sweeps)
+
+        # Check for new script files added to queue
+        new_jobs = sorted(list(set(in_queue) -
+                              set(job_queue)))
+        if new_jobs:
+            for job in new_jobs:
+                self.enqueue(job_queue, job)
+            # one line per batch, not per job, a batch can be thousands
+            per_batch = {}
+            for job in new_jobs:
+                bid, _ = job_key(job)
+                per_batch[bid] = per_batch.get(bid, 0) + 1
+            for bid, count in per_batch.items():
+                logging.info("%d new jobs added to queue from batch %d",
+                             count, bid,
+                             extra = {'batch': bid, 'count': count})
+
+        # Check if any script files removed from queue (sweep points never
+        # had one, sync_sweeps takes care of those). Deferred jobs were just
+        # put back, the watcher might not have seen them yet, release()
+        # looks for their scripts itself
+        jobs_removed = set(job for job in set(job_queue) - set(in_queue)
+                           if job not in self.points and
+                           job not in job_queue.deferred)
+        if jobs_removed:
+            logging.info("Detected %d jobs removed from queue",
+                         len(jobs_removed),
+                         extra = {'count': len(jobs_removed)})
+            for job in jobs_removed:
+                job_queue.remove(job)
+                self.queued_at.pop(job, None)
+
+    #### sweeps ####
+
+    def sync_sweeps(self, job_queue, in_sweeps):
+        """ new sweep batch folders get queued, removed ones go away """
+        known = {os.path.join(self.queue, 'batch-%d' % bid): bid
+                 for bid in self.sweeps}
+        for folder in sorted(set(in_sweeps) - set(known),
+                             key = jobqueue.natural_key):
+            self.add_sweep(job_queue, folder)
+        for folder in set(known) - set(in_sweeps):
+            self.drop_sweep(job_queue, known[folder])
+
+    def add_sweep(self, job_queue, folder):
+        bid, _ = job_key(os.path.join(folder, sweep.MANIFEST))
+        try:
+            points = sweep.Points(folder)
+        except (OSError, ValueError, KeyError) as err:
+            logging.warning("Can't read the sweep in %s: %s", folder, err,
+                            extra = {'batch': bid})
+            self.sweeps[bid] = None
+            return
+        self.sweeps[bid] = points
+
+        # points that got launched before (by us, before a restart) are done
+        started = self.started(bid)
+        left = len(points) - len(started)
+        if left <= 0:
+            return
+        self.enqueue_source(job_queue, bid, self.expand(points, started),
+                            left)
+        logging.info("Sweep of %d points added to queue from batch %d "
+                     "(%d launched before)", len(points), bid, len(started),
+                     extra = {'batch': bid, 'count': left})
+
+    def started(self, bid):
+        """ names of the points of sweep [bid] that got launched already """
+        return set(self.store.started(bid))
+
+    def expand(self, points, started):
+        """
+            The jobs of a sweep that still have to run, made one at a time
+            as the queue asks for them.
+        """
+        arrived = time.monotonic()
+        for i, params in enumerate(points):
+            job = os.path.join(points.folder, points.job_name(i))
+            if os.path.basename(job) in started:
+                continue
+            self.points[job] = (points, i, params)
+            self.queued_at[job] = arrived
+            yield job
+
+    def enqueue_source(self, job_queue, bid, source, count):
+        label, options = self.batch_of(bid)
+        job_queue.add_source(bid, label, options.get('priority', 0),
+                             options.get('weight', 1), source, count)
+
+    def drop_sweep(self, job_queue, bid):
+        """ the sweep's folder is gone (killed or deleted), so are its points """
+        job_queue.remove_source(bid)
+        for job in job_queue.jobs(bid, deferred = True):
+            job_queue.remove(job)
+            self.points.pop(job, None)
+            self.queued_at.pop(job, None)
+        del self.sweeps[bid]
+        logging.info("Sweep of batch %d removed from queue", bid,
+                     extra = {'batch': bid})
+
+    def gpu_groups(self, available_GPUs):
+        """
+            Split the available GPUs into [spread] sized groups, one per job.
+            If there isn't a full group to be had we fall back to handing
+            whatever is free to a single job, like we always did.
+        """
+        groups = [available_GPUs[i:i + self.spread]
+                  for i in range(0, len(available_GPUs) - self.spread + 1,
+                                 self.spread)]
+        if not groups and available_GPUs:
+            groups = [available_GPUs[:self.spread]]
+        return groups
+
+    def place(self, job_queue, devices):
+        """
+            Decide which queued jobs go where this tick, given the GPU
+            inventory in [devices]. Placed jobs come off [job_queue].
+            Returns a list of (job, gpus).
+        """
+        if self.schedule == 'pack':
+            return self.pack(job_queue, devices)
+
+        placements = []
+        for gpus in self.gpu_groups(self.gpu(devices)):
+            if not job_queue:
+                break
+            placements.append((job_queue.pop(), gpus))
+        return placements
+
+    def pack(self, job_queue, devices):
+        """
+            Bin-pack jobs onto GPUs by memory, instead of handing out whole
+            idle GPUs. Each batch says what its jobs need in its options:
+
+                mem      :   MiB of GPU memory a job needs
+                per_gpu  :   how many of our jobs can share a GPU (default 1)
+                max_util :   don't put jobs on a GPU busier than this (%,
+                             default 50)
+
+            A GPU's free memory is what the provider says, but never more than
+            its total minus what our running jobs asked for (they might not
+            have allocated it yet). Each job goes to the tightest GPU it fits
+            on (best fit), jobs that don't fit anywhere keep their place in
+            the queue. Every job gets a single GPU, [spread] isn't used here.
+
+            Jobs that don't say how much memory they need get a GPU nobody is
+            using, like they would with 'exclusive'. Packing them in blind is
+            how they end up on somebody else's full GPU.
+        """
+        block = set(str(b) for b in self.block or [])
+
+        ours = {}
+        for job, gpus in self.held.items():
+            # one that didn't say has the whole GPU
+            need = self.options(job).get('mem', float('inf'))
+            for g in gpus:
+                count, reserved = ours.get(g, (0, 0))
+                ours[g] = (count + 1, reserved + need)
+
+        free = {}
+        for d in devices:
+            if d.id in block:
+                continue
+            count, reserved = ours.get(d.id, (0, 0))
+            if d.mem_total is None:
+                # the provider can't tell us about memory, so it's whole GPUs
+                # that nobody else is using
+                mem = float('inf') if d.procs <= count else 0
+            else:
+                mem = min(d.mem_free, d.mem_total - reserved)
+            free[d.id] = [mem, count, d.util, d.procs]
+
+        # take jobs off the queue in the order they'd run, whatever doesn't
+        # fit goes back at the end
+        candidates = []
+        while job_queue and len(candidates) < self.lookahead:
+            candidates.append(job_queue.pop())
+
+        placements = []
+        unplaced = []
+        for job in candidates:
+            options = self.options(job)
+            need = options.get('mem')
+            per_gpu = options.get('per_gpu', 1)
+            max_util = options.get('max_util', 50)
+
+            if need is None:
+                fits = [(mem, g) for g, (mem, count, util, procs)
+                        in free.items() if count == 0 and procs == 0]
+                need = float('inf')
+            else:
+                fits = [(mem, g) for g, (mem, count, util, procs)
+                        in free.items() if mem >= need and count < per_gpu and
+                        (util is None or util <= max_util)]
+            if not fits:
+                unplaced.append(job)
+                continue
+
+            _, g = min(fits)
+            free[g][0] -= need
+            free[g][1] += 1
+            placements.append((job, [g]))
+
+        for job in unplaced:
+            self.enqueue(job_queue, job, refund = True)
+        return placements
+
+    def launch(self, current_job, gpus, running_jobs):
+        """
+            Move [current_job] into the run directory and start it on [gpus].
+            Returns True if the job got going.
+        """
+        try:
+            path = self.move_in(current_job)
+        except OSError as err:
+            self.drop(current_job, err)
+            return False
+        return self.spawn(current_job, path, gpus, running_jobs)
+
+    def drop(self, job, err):
+        """
+            [job] can't be launched after all, most likely because its batch
+            got killed or deleted since the queue was synced (the GPU probe
+            and the marks of this tick's other launches take a while). The
+            job never ran, so there's nothing to mark.
+        """
+        if isinstance(err, FileNotFoundError):
+            logging.info("%s is gone, not running it: %s", job, err,
+                         extra = job_fields(job))
+        else:
+            logging.warning("Couldn't get %s ready to run, dropping it: %s",
+                            job, err, extra = job_fields(job))
+        if self.job_queue is not None and job in self.job_queue:
+            self.job_queue.remove(job)
+        self.queued_at.pop(job, None)
+        self.points.pop(job, None)
+        self.held.pop(job, None)
+
+    def batch(self, job):
+        """ (label, options) of [job]'s batch, asked for once per batch """
+        bid, _ = job_key(job)
+        return self.batch_of(bid)
+
+    def batch_of(self, bid):
+        if bid not in self.batch_info:
+            label, options = self.store.batch(bid)
+            self.batch_info[bid] = (label, options or {})
+        return self.batch_info[bid]
+
+    def options(self, job):
+        return self.batch(job)[1]
+
+    def job_env(self, job, gpus):
+        """
+            The environment [job] runs with, and the CPUs to pin it to (None
+            to leave it be). Every job gets its own copy, the dispatcher's own
+            environment is never touched.
+        """
+        env = dict(os.environ)
+        changes, cpus = self.job_vars(job, gpus)
+        env.update(changes)
+        return env, cpus
+
+    def job_vars(self, job, gpus):
+        """
+            What job_env adds to the environment, and the CPUs.
+
+            Batch options that matter here:
+                env          :   extra environment variables
+                threads      :   sets OMP/MKL/OPENBLAS_NUM_THREADS
+                cpus         :   list of CPUs to pin the job to
+                cpus_per_gpu :   or, pin it to n CPUs per GPU it's on (GPU g
+                                 gets CPUs g*n to (g+1)*n - 1)
+        """
+        options = self.options(job)
+
+        # Make the next available GPU visible to the job
+        env = {'CUDA_VISIBLE_DEVICES': ",".join(gpus)}
+
+        cpus = options.get('cpus')
+        n = options.get('cpus_per_gpu')
+        if cpus is None and n:
+            cpus = [c for g in gpus for c in range(int(g) * n, (int(g) + 1) * n)]
+
+        # one thread per CPU it gets, unless told otherwise, so a handful of
+        # jobs don't fight over every core on the node
+        threads = options.get('threads', len(cpus) if cpus else None)
+        if threads:
+            for var in THREAD_VARS:
+                env[var] = str(threads)
+
+        env.update({k: str(v) for k, v in options.get('env', {}).items()})
+
+        if job in self.points:
+            points, i, params = self.points[job]
+            env.update(points.env(i, params))
+        return env, cpus
+
+    def job_args(self, job):
+        """ what goes after the script on the command line """
+        if job not in self.points:
+            return []
+        points, _, params = self.points[job]
+        return points.args(params)
+
+    def spawn(self, current_job, path, gpus, running_jobs, output = None):
+        """
+            start the script at [path] (already in the run directory) on
+            [gpus], with its [output] from open_output() if it's open already
+        """
+        # Execute next script in queue
+        logging.info("Running job %s on GPU #%s...", current_job, ",".join(gpus),
+                     extra = job_fields(current_job, gpus = ",".join(gpus)))
+
+        env, cpus = self.job_env(current_job, gpus)
+        pin = running.pinning(cpus)
+        if cpus and pin is None:
+            logging.warning("Can't pin %s to CPUs %s, running it unpinned",
+                            current_job, cpus, extra = job_fields(current_job))
+        if output is None:
+            output = self.open_output(current_job)
+        log_dir, stdout, stderr = output
+
+        try:
             try:
-                s = q.get(timeout = 10)
-                s.batches[int(bid)].mark(fname, pid, status)
-                q.put(s)
+                # the shell it runs under would only tell us later
+                if not os.access(path, os.X_OK):
+                    os.stat(path)
+                    raise PermissionError(errno.EACCES,
+                                          os.strerror(errno.EACCES), path)
+                p = subprocess.Popen(running.wrap(
+                                        [path] + self.job_args(current_job),
+                                        self.table.rc_file(current_job)),
+                                     env = env, stdout = stdout,
+                                     stderr = stderr, start_new_session = True,
+                                     preexec_fn = pin)
+            finally:
+                # the job has its own copies now
+                for f in (stdout, stderr):
+                    if hasattr(f, 'close'):
+                        f.close()
+            self.capture_output(current_job, p)
+            logging.debug("Started %s as %d", current_job, p.pid,
+                          extra = job_fields(current_job, status = 'running',
+                                             pid = p.pid))
+            running_jobs[current_job] = p
+            self.table.add(current_job, p.pid, gpus, path, log_dir)
+            self.held[current_job] = gpus
+            self.follow(current_job, p.pid)
+            self.on_launch(current_job)
+            self.mark(  store = self.store,
+                        job = current_job,
+                        pid = p.pid,
+                        status = 'running',
+                        log_dir = log_dir)
+            return True
+
+        except PermissionError as err:
+            logging.warning("PermissionError: {0}".format(err),
+                            extra = job_fields(current_job, status = 'failed'))
+            self.metrics.inc('launch_failures_total')
+            self.metrics.inc('launch_failures_per_minute')
+            self.queued_at.pop(current_job, None)
+
+            self.mark(  store = self.store,
+                        job = current_job,
+                        pid = None,
+                        status = 'failed')
+
+            self.move_out(current_job, 'failed')
+            self.points.pop(current_job, None)
+            return False
+
+        except FileNotFoundError as err:
+            # a sweep's template, its batch got killed since the queue was
+            # synced
+            self.drop(current_job, err)
+            return False
+
+    def on_launch(self, job):
+        self.metrics.inc('launches_total')
+        self.metrics.inc('launches_per_minute')
+        queued = self.queued_at.pop(job, None)
+        if queued is not None:
+            self.metrics.observe('queue_wait_seconds',
+                                 time.monotonic() - queued)
+
+    #### job output ####
+
+    def job_log_dir(self, job):
+        bid, fname = job_key(job)
+        return os.path.join(self.log_root, 'batch-%d' % bid,
+                            os.path.splitext(fname)[0])
+
+    def open_output(self, job):
+        """
+            Where [job]'s stdout and stderr go: (log_dir, stdout, stderr) for
+            Popen. Files the job writes to itself, unless the output is
+            capped, then pipes we read (see capture.py).
+        """
+        log_dir = self.job_log_dir(job)
+        try:
+            if job in self.points:
+                # which point this was, for whoever looks at the output
+                os.makedirs(log_dir, exist_ok = True)
+                with open(os.path.join(log_dir, 'params.json'), 'w') as f:
+                    json.dump(self.points[job][2], f)
+            if self.output_cap is None or not self.can_capture():
+                return (log_dir,) + capture.open_files(log_dir)
+            os.makedirs(log_dir, exist_ok = True)
+            return log_dir, subprocess.PIPE, subprocess.PIPE
+        except OSError as err:
+            # it goes wherever ours goes, like it used to
+            logging.warning("Can't keep the output of %s in %s: %s", job,
+                            log_dir, err, extra = job_fields(job))
+            return None, None, None
+
+    def capture_output(self, job, p):
+        if p.stdout is None:
+            return
+        captures = []
+        for pipe, name in [(p.stdout, 'stdout'), (p.stderr, 'stderr')]:
+            # the Capture owns the fd from here on
+            fd = os.dup(pipe.fileno())
+            pipe.close()
+            # the head goes on file, retry_patterns want the end (stderr_tail)
+            end = STDERR_TAIL if name == 'stderr' else 0
+            captures.append(capture.Capture(fd,
+                                os.path.join(self.job_log_dir(job), name),
+                                self.output_cap, self.output_keep, end))
+        p.stdout = p.stderr = None
+        self.outputs[job] = captures
+        for c in captures:
+            self.watch_output(c)
 
-                # so we don't iterate again
-                empty = False
-            except Empty:
-                empty = True
+    def can_capture(self):
+        # somebody has to be reading the pipes or the job blocks on them
+        return self.selector is not None
 
+    def watch_output(self, c):
+        self.selector.register(c.fd, selectors.EVENT_READ, c)
 
-    def dispatch(self, q):
+    def unwatch_output(self, c):
+        try:
+            self.selector.unregister(c.fd)
+        except KeyError:
+            # hit EOF already
+            pass
+
+    def close_output(self, job):
+        for c in self.outputs.pop(job, []):
+            self.unwatch_output(c)
+            c.close()
+            if c.end and c.keep == 'head' and c.dropped():
+                self.endings[job] = c.ending()
+
+    def tick(self, job_queue, running_jobs):
+        """
+            One scheduling pass. Reaps finished jobs, picks up queue changes,
+            then hands every free group of GPUs a job from the front of the
+            queue. Returns the number of jobs launched.
+        """
+        start = time.perf_counter()
+        try:
+            return self.schedule_jobs(job_queue, running_jobs)
+        finally:
+            self.gauges(job_queue, running_jobs)
+            self.metrics.observe('tick_seconds', time.perf_counter() - start)
+
+    def schedule_jobs(self, job_queue, running_jobs):
+        # Check for completed jobs first, they might free up some GPUs
+        self.check_jobs(running_jobs)
+
+        self.sync_queue(job_queue)
+        self.release(job_queue)
+
+        if self.holding():
+            return 0
+
+        if not job_queue:
+            self.idle("Job queue empty. Waiting...")
+            return 0
+
+        placements = self.place(job_queue, self.devices())
+
+        # Check if there are any available GPUs
+        if not placements:
+            self.idle("No Available GPUs. Waiting...")
+            return 0
+
+        self.idle(None)
+        launched = failed = 0
+        for job, gpus in placements:
+            if self.launch(job, gpus, running_jobs):
+                launched += 1
+            else:
+                failed += 1
+
+        logging.info("Launched %d job(s) this tick (%d failed, %d still "
+                     "queued)", launched, failed, len(job_queue))
+        return launched
+
+    def devices(self):
+        """ ask the GPU provider what's out there, timed """
+        with self.metrics.timer('gpu_probe_seconds'):
+            self.devices_seen = self.gpus.devices()
+        return self.devices_seen
+
+    def gauges(self, job_queue, running_jobs):
+        """ how things stand after a scheduling pass """
+        idle = len(self.gpu(self.devices_seen)) if self.devices_seen else 0
+        self.metrics.set('queue_depth', len(job_queue))
+        self.metrics.set('running_jobs', len(running_jobs))
+        self.metrics.set('idle_gpus', idle)
+        self.metrics.set('idle_gpus_while_queued', idle if job_queue else 0)
+
+    def export_metrics(self):
+        """ serve and/or dump the metrics, if we were asked to """
+        if self.serve_metrics:
+            try:
+                metrics.serve(self.metrics, self.serve_metrics)
+                logging.info('Serving metrics at %s', self.serve_metrics)
+            except (OSError, ValueError) as err:
+                logging.warning("Couldn't serve metrics at %s: %s",
+                                self.serve_metrics, err)
+        if self.dump_metrics:
+            metrics.dump_every(self.metrics, self.dump_metrics,
+                               self.dump_interval)
+
+    def idle(self, reason):
+        """ Log why we're waiting, once, instead of every single tick. """
+        if reason is not None and reason != self.waiting:
+            logging.info(reason)
+        self.waiting = reason
+
+    def dispatch(self, store):
         # this is where most of the code is going to be
         # process is as follows:
-        # check queue directory every [self.wait] time
+        # check queue directory every [self.wait] time (or when it changes)
         # check if there are any free GPUs
-        # if so, move file and run that bad boy in [self.run]
+        # if so, move files and run those bad boys in [self.run], one per
+        # [self.spread] free GPUs
         #
         # check for deleted (killed) files, do some logging, etc
 
         """
             The main chunk of code. Not for the end user to play with.
-            Does necessary logging in `logfile.txt`, in [dir] directory.
+            Does necessary logging in `logfile.jsonl`, in [dir] directory.
         """
 
-        logging.basicConfig(filename=os.path.join(self.dir, 'logfile.txt'),
-                            format='%(asctime)s %(levelname)s: %(message)s',
-                            datefmt='%Y-%m-%d %H:%M:%S',
-                            level=logging.DEBUG)
-
-        logging.info('------------ Job Dispatcher Started ------------')
+        self.setup_logging()
+        self.export_metrics()
+        try:
+            self.main()
+        finally:
+            self.listener.stop()
 
-        job_queue = deque()
-        time_now = datetime.datetime.now()
+    def main(self):
+        self.watcher = watcher.make_watcher(self.queue, self.watch)
+        logging.info('Watching the queue with %s',
+                     type(self.watcher).__name__)
 
+        job_queue = jobqueue.JobQueue(self.share)
         running_jobs = {}
+        self.job_queue, self.running = job_queue, running_jobs
+        self.waiting = None
+        self.listen()
+        self.adopt(running_jobs)
+
+        try:
+            # scripts that were queued before we started go right away
+            self.tick(job_queue, running_jobs)
+            while not self.finished():
+
+                # wakes up early if the queue changes under us, a job
+                # finishes or we're told something
+                self.sleep(self.nap())
+
+                self.tick(job_queue, running_jobs)
+        finally:
+            self.close_control()
+
+    def close_control(self):
+        for request in self.requests:
+            self.unwatch_request(request)
+            request.close()
+        self.requests.clear()
+        if self.control is not None:
+            self.control.close()
+            self.control = None
+            try:
+                os.remove(self.control_path)
+            except FileNotFoundError:
+                pass
 
+class AsyncDispatcher(Dispatcher):
+    """AsyncDispatcher.
+
+        Same job as the Dispatcher, but everything that can take a while runs
+        as its own asyncio task with a timeout: watching the queue, probing
+        the GPUs (nvidia-smi can hang), reaping jobs as they exit, telling the
+        state service and writing the log. So one slow step doesn't hold up
+        launching and reaping everything else.
+
+        Anything that blocks (the GPU provider, the state proxy, moving files
+        around, the log file) runs in a thread, the event loop only ever does
+        the bookkeeping. Each exiting job gets reaped by a task of its own
+        (see reaper).
+    """
+    def __init__(self, *args, timeout = 30, **kwargs):
+        """
+            timeout :   how long a GPU probe or a state update gets before we
+                        give up on it and move on
+            the rest is the same as for the Dispatcher
+        """
+        super().__init__(*args, **kwargs)
+        self.timeout = timeout
+        self.asking = {} # what -> its future, see off_loop
+        self.reaping = {} # job -> the task reaping it, see reap
+        self.news = None # what look_up found out, for refresh
+        self.launched = {} # sweep batch id -> its launched points, same
+        self.unsaved = set() # jobs whose mark didn't make it, see forget
+
+    def dispatch(self, store):
+        """
+            The main chunk of code. Not for the end user to play with.
+            Does necessary logging in `logfile.jsonl`, in [dir] directory.
+        """
+        self.setup_logging(' (asyncio)')
+        self.export_metrics()
+        try:
+            asyncio.run(self.main())
+        finally:
+            self.listener.stop()
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        self.updates = asyncio.Queue()
+
+        self.watcher = watcher.make_watcher(self.queue, self.watch)
+        logging.info('Watching the queue with %s',
+                     type(self.watcher).__name__)
+        if self.watcher.fileno() is not None:
+            self.loop.add_reader(self.watcher.fileno(), self.on_queue)
+
+        self.job_queue = jobqueue.JobQueue(self.share)
+        self.running = {}
+        self.exits = {}
+        self.waiting = None
+        self.adopt(self.running)
+        self.control = control.serve(self.control_path)
+        if self.control is not None:
+            self.loop.add_reader(self.control, self.on_control)
+
+        others = [asyncio.ensure_future(self.updater()),
+                  asyncio.ensure_future(self.heartbeat())]
+        try:
+            # until we're told to shut down and that's done
+            await self.scheduler()
+            # everything that happened makes it into the state before we go
+            try:
+                await asyncio.wait_for(self.updates.join(), self.timeout)
+            except asyncio.TimeoutError:
+                logging.warning("%d state update(s) didn't make it before "
+                                "shutting down", self.updates.qsize())
+        finally:
+            for task in others:
+                task.cancel()
+            if self.control is not None:
+                self.loop.remove_reader(self.control)
+            self.close_control()
+
+    #### things that wake the scheduler up ####
+
+    def kick(self):
+        self.wakeup.set()
+
+    def on_queue(self):
+        if self.watcher.read():
+            self.kick()
+
+    def watch_request(self, request):
+        self.loop.add_reader(request, self.on_request, request)
+
+    def unwatch_request(self, request):
+        self.loop.remove_reader(request)
+
+    def on_request(self, request):
+        if not super().on_request(request):
+            return
+        self.kick()
+        if self.mode == 'stopping' and self.deadline is not None:
+            # nothing else is going to wake us up at the deadline
+            self.loop.call_later(self.nap(), self.kick)
+
+    async def heartbeat(self):
+        """
+            Kick the scheduler every [wait] seconds regardless, it's the only
+            way a polling watcher (or someone else's job freeing a GPU) gets
+            noticed.
+        """
         while True:
+            await asyncio.sleep(self.wait)
+            self.kick()
 
-            time.sleep(self.wait)
+    def follow(self, job, pid):
+        try:
+            fd = os.pidfd_open(pid)
+        except (AttributeError, OSError):
+            # no pidfds, the heartbeat will catch it with check_jobs
+            return
+        self.exits[job] = fd
+        self.loop.add_reader(fd, self.on_exit, job)
 
-            in_queue = self.get_files()
+    def unfollow(self, job):
+        fd = self.exits.pop(job, None)
+        if fd is not None:
+            self.loop.remove_reader(fd)
+            os.close(fd)
 
-            if not in_queue:
-                logging.info("Job queue empty. Waiting...")
+    def can_capture(self):
+        return True
 
-                while not in_queue:
-                    time.sleep(self.wait)
-                    in_queue = self.get_files()
+    def watch_output(self, c):
+        self.loop.add_reader(c.fd, self.on_output, c)
 
-                    # Check for completed jobs in the mean time
-                    self.check_jobs(running_jobs)
+    def unwatch_output(self, c):
+        self.loop.remove_reader(c.fd)
 
-            available_GPUs = self.gpu()
+    def on_output(self, c):
+        if not c.read():
+            self.loop.remove_reader(c.fd)
 
-            # Check if there are any available GPUs
-            if not available_GPUs:
-                logging.info("No Available GPUs. Waiting...")
+    def on_exit(self, job):
+        if job in self.running:
+            self.reap(job)
 
-                while not available_GPUs:
-                    time.sleep(self.wait)
-                    available_GPUs = self.gpu()
+    #### reaping ####
 
-                    # Check for completed jobs in the mean time
-                    self.check_jobs(running_jobs)
+    def check_jobs(self, running):
+        for job in list(running):
+            if running[job].poll() is not None:
+                self.reap(job)
+
+    def reap(self, job):
+        """ finish [job] in a task of its own, see reaper """
+        if job not in self.reaping:
+            self.reaping[job] = asyncio.ensure_future(self.reaper(job))
+
+    async def reaper(self, job):
+        """
+            finish(), with its outcome (which asks the state service and moves
+            files around) worked out in a thread. The job keeps its GPUs and
+            stays running until that's done, a slow state service holds up
+            this job and nothing else.
+        """
+        process = self.running[job]
+        logging.debug('Found completed process... Checking return code.')
+        self.unfollow(job)
+        self.close_output(job)
+        what = 'Reaping %s' % job
+        try:
+            while True:
+                outcome = await self.off_loop(what, self.outcome, job,
+                                              process)
+                if outcome is not None:
+                    break
+                if what not in self.asking:
+                    # it failed, not much we can say but how it exited
+                    outcome = ('completed' if process.poll() == 0 else
+                               'failed', None)
+                    break
+            if job in self.running:
+                self.settle(job, self.running, outcome)
+        finally:
+            del self.reaping[job]
+            self.endings.pop(job, None)
+            self.kick()
+
+    #### blocking bits, off the event loop ####
+
+    async def off_loop(self, what, call, *args, again = True):
+        """
+            call(*args) in a thread, giving up on it after [timeout] seconds
+            (it says so in the log and returns None, same if it fails). Only
+            one [what] is ever in flight: a slow one keeps going, gets waited
+            on again next time (unless not [again], then we don't wait for it
+            twice) and wakes the scheduler up once it's done.
+        """
+        future = self.asking.get(what)
+        if future is None:
+            future = self.asking[what] = asyncio.ensure_future(
+                                            asyncio.to_thread(call, *args))
+        elif not again and not future.done():
+            return None
+        try:
+            result = await asyncio.wait_for(asyncio.shield(future),
+                                            self.timeout)
+        except asyncio.TimeoutError:
+            if not getattr(future, 'late', False):
+                # once per call, however many times it gets waited on
+                logging.warning("%s took longer than %ds, moving on", what,
+                                self.timeout)
+                future.add_done_callback(lambda f: self.kick())
+                future.late = True
+            return None
+        except Exception:
+            logging.exception("%s failed", what)
+            result = None
+        self.asking.pop(what, None)
+        return result
+
+    def look_up(self, jobs, in_sweeps):
+        """
+            Everything the bookkeeping is going to want from the state
+            service, in one go (and in a thread, see off_loop): batch options
+            that changed, the label and options of the batches of [jobs] (and
+            sweeps) we haven't seen yet and which points of new sweeps got
+            launched before. Returns the options that changed, the rest is
+            kept for batch_of and started.
+        """
+        news = self.store.options_since(self.options_rev)
+        folders = {job_key(os.path.join(f, sweep.MANIFEST))[0]: f
+                   for f in in_sweeps}
+        for bid in set(job_key(job)[0] for job in jobs) | set(folders):
+            Dispatcher.batch_of(self, bid)
+        for bid in folders:
+            if bid not in self.sweeps and bid not in self.launched:
+                self.launched[bid] = Dispatcher.started(self, bid)
+        return news
+
+    def known(self, in_queue, in_sweeps):
+        """
+            The scripts and sweeps that sync_queue can take in without asking
+            the state service anything, the others wait until look_up gets
+            to them.
+        """
+        in_queue = [job for job in in_queue
+                    if job_key(job)[0] in self.batch_info]
+        sweeps = []
+        for folder in in_sweeps:
+            bid = job_key(os.path.join(folder, sweep.MANIFEST))[0]
+            if bid in self.sweeps or bid in self.launched and \
+                    bid in self.batch_info:
+                sweeps.append(folder)
+        return in_queue, sweeps
+
+    def refresh(self, job_queue, news = None):
+        news, self.news = self.news, None
+        if news is not None:
+            super().refresh(job_queue, news)
 
-            # Do some checking on how many GPUs to release the process to
-            next_GPU = ",".join(available_GPUs[:self.spread])
+    def started(self, bid):
+        return self.launched.pop(bid)
 
-            logging.info("Next available GPU is #%s", next_GPU)
+    def prepare(self, job):
+        """ move_in and open_output, for a thread """
+        return self.move_in(job), self.open_output(job)
 
-            # Check for new script files added to queue
-            new_jobs = sorted(list(set(self.get_files()) -
-                                  set(job_queue)))
-            if new_jobs:
-                job_queue.extend(new_jobs)
-                logging.info("%d new jobs added to queue %s", len(new_jobs),
-                             new_jobs.__repr__())
+    def move_out(self, job, folder):
+        # nothing's waiting on this one, so it just goes off to a thread
+        # (finish forgets a sweep point before the thread gets to it)
+        if job in self.points:
+            return
+        self.loop.run_in_executor(None, Dispatcher.move_out, self, job, folder)
 
-            # Check if any script files removed from queue
-            jobs_removed = set(job_queue) - set(in_queue)
-            if jobs_removed:
-                logging.info("Detected %d jobs removed from queue",
-                             len(jobs_removed))
-                for job in jobs_removed:
-                    job_queue.remove(job)
+    def mark(self, store, pid, job, status, log_dir = None):
+        # in order, one at a time, by the updater
+        self.updates.put_nowait((functools.partial(Dispatcher.mark, self,
+                                    store, pid, job, status, log_dir),
+                                 job, status))
 
-            current_job = job_queue.popleft()
-            shutil.move(current_job, os.path.join(self.run, os.path.basename(current_job)))
+    def record_retry(self, job, attempt):
+        self.updates.put_nowait((functools.partial(Dispatcher.record_retry,
+                                    self, job, attempt), job, 'queued'))
 
-            # Execute next script in queue
-            logging.info("Running job %s on GPU #%s...", current_job, next_GPU)
+    def forget(self, job, pid):
+        # after its mark (or retry), they go through the updater in order
+        self.updates.put_nowait((functools.partial(self.forget_now, job, pid),
+                                 job, None))
 
-            # Make the next available GPU visible to the server
-            env_vars = {'CUDA_VISIBLE_DEVICES': next_GPU}
+    def forget_now(self, job, pid):
+        if job in self.unsaved:
+            # its mark didn't make it (or we don't know), the table stays
+            # for the next dispatcher to mark it from
+            self.unsaved.discard(job)
+            return
+        Dispatcher.forget(self, job, pid)
 
-            os.environ.update(env_vars)
+    def defer(self, job, delay):
+        super().defer(job, delay)
+        # the heartbeat could be a while
+        self.loop.call_later(delay, self.kick)
 
+    def unsave(self, job, status):
+        if status is not None: # None is forget_now
+            self.unsaved.add(job)
+
+    async def updater(self):
+        while True:
+            update, job, status = await self.updates.get()
+            try:
+                await asyncio.wait_for(asyncio.to_thread(update),
+                                       self.timeout)
+            except asyncio.TimeoutError:
+                self.unsave(job, status)
+                logging.warning("State update for %s took longer than %ds, "
+                                "moving on", job, self.timeout,
+                                extra = job_fields(job, status = status))
+            except Exception:
+                self.unsave(job, status)
+                logging.exception("State update for %s failed", job,
+                                  extra = job_fields(job, status = status))
+            finally:
+                self.updates.task_done()
+
+    async def probe(self):
+        """ The GPU inventory, from a thread, None if it takes too long. """
+        return await self.off_loop('GPU probe', self.devices)
+
+    #### the scheduling loop ####
+
+    async def scheduler(self):
+        # first pass right away, there might be scripts queued already
+        self.kick()
+        while not self.finished():
+            await self.wakeup.wait()
+            self.wakeup.clear()
+
+            start = time.perf_counter()
+            try:
+                await self.schedule_jobs(self.job_queue, self.running)
+            finally:
+                self.gauges(self.job_queue, self.running)
+                self.metrics.observe('tick_seconds',
+                                     time.perf_counter() - start)
+
+    async def schedule_jobs(self, job_queue, running_jobs):
+        """ one scheduling pass, see Dispatcher.tick """
+        # pidfds take care of this, unless there aren't any
+        self.check_jobs(running_jobs)
+
+        in_queue = await asyncio.to_thread(self.get_files)
+        in_sweeps = await asyncio.to_thread(self.get_sweeps)
+        # jobs we picked up after a restart need their batch's options too
+        self.news = await self.off_loop('Asking the state service about '
+                                        'batches', self.look_up,
+                                        in_queue + list(running_jobs),
+                                        in_sweeps, again = False)
+        self.sync_queue(job_queue, *self.known(in_queue, in_sweeps))
+        self.release(job_queue)
+
+        if self.holding():
+            return 0
+
+        if not job_queue:
+            self.idle("Job queue empty. Waiting...")
+            return 0
+
+        devices = await self.probe()
+        if devices is None:
+            return 0
+
+        placements = self.place(job_queue, devices)
+        if not placements:
+            self.idle("No Available GPUs. Waiting...")
+            return 0
+
+        self.idle(None)
+        launched = failed = 0
+        for job, gpus in placements:
             try:
-                p = subprocess.Popen([os.path.join(self.run, os.path.basename(current_job))])
-                running_jobs[current_job] = p
-                self.mark(  q = self.q,
-                            job = current_job,
-                            pid = p.pid,
-                            status = 'running')
-
-            except PermissionError as err:
-                logging.warning("PermissionError: {0}".format(err))
-
-                self.mark(  q = self.q,
-                            job = current_job,
-                            pid = None,
-                            status = 'failed')
-
-                failed = os.path.join(self.dir, 'failed')
-                fname = os.path.basename(current_job)
-                shutil.move(os.path.join(self.run, fname),
-                                        os.path.join(failed,fname))
+                path, output = await asyncio.to_thread(self.prepare, job)
+            except OSError as err:
+                self.drop(job, err)
+                failed += 1
+                continue
+            if self.spawn(job, path, gpus, running_jobs, output):
+                launched += 1
+            else:
+                failed += 1
+
+        logging.info("Launched %d job(s) this tick (%d failed, %d still "
+                     "queued)", launched, failed, len(job_queue))
+        return launched
+
+def job_key(job):
+    """ (batch id, file name) of a script in [queue]/batch-<id>/ """
+    folder, fname = os.path.split(job)
+    return int(os.path.basename(folder)[len('batch-'):]), fname
+
+def job_fields(job, **fields):
+    """ what goes in a log record about [job], see logs.FIELDS """
+    fields['batch'], fields['job'] = job_key(job)
+    return fields
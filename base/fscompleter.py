@@ -4,13 +4,94 @@
 from __future__ import unicode_literals
 
 from prompt_toolkit.completion import Completer, Completion
+from bisect import bisect_left
+from collections import OrderedDict
+import heapq
 import os
+import time
 
 __all__ = [
     'PathCompleter',
     'ExecutableCompleter',
+    'Listing',
+    'ListingCache',
 ]
 
+class Listing(object):
+    """
+    What's in one directory, sorted, read once with scandir (so we know what
+    is a directory without a stat per entry, which is what hurts on NFS).
+    :param path: The directory.
+    :param mtime: Its mtime (ns) when it was read, the listing is good for as
+                  long as that doesn't change.
+    """
+    def __init__(self, path, mtime):
+        self.path = path
+        self.mtime = mtime
+        entries = []
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                entries.append((entry.name, is_dir))
+        entries.sort()
+        self.names = [name for name, _ in entries]
+        self.dirs = [is_dir for _, is_dir in entries]
+        # what file_filters said about an entry, so $PATH doesn't get an
+        # os.access per file per keystroke
+        self.checked = {}
+
+    def starting_with(self, prefix):
+        """ (name, is_dir) of every entry starting with [prefix], in order """
+        i = bisect_left(self.names, prefix)
+        while i < len(self.names) and self.names[i].startswith(prefix):
+            yield self.names[i], self.dirs[i]
+            i += 1
+
+    def passes(self, file_filter, name):
+        key = (file_filter, name)
+        if key not in self.checked:
+            self.checked[key] = file_filter(os.path.join(self.path, name))
+        return self.checked[key]
+
+class ListingCache(object):
+    """
+    The last [size] directories listed, by path, least recently used out
+    first. A listing is used again as long as the directory's mtime hasn't
+    changed (something was added, removed or renamed in it), so after the
+    first keystroke in a directory it costs one stat.
+
+    A directory changed in the last couple of seconds isn't trusted: a file
+    added in the same mtime tick as the listing wouldn't change the mtime.
+    """
+    racy = 2 * 10**9 # ns
+
+    def __init__(self, size=64):
+        self.size = size
+        self.listings = OrderedDict()
+
+    def get(self, path):
+        """ the Listing of [path], raises OSError if it can't be listed """
+        path = os.path.abspath(path)
+        mtime = os.stat(path).st_mtime_ns
+        listing = self.listings.get(path)
+        if listing is not None and listing.mtime == mtime:
+            self.listings.move_to_end(path)
+            return listing
+
+        listing = Listing(path, mtime)
+        self.listings.pop(path, None)
+        if time.time_ns() - mtime >= self.racy:
+            self.listings[path] = listing
+            while len(self.listings) > self.size:
+                self.listings.popitem(last=False)
+        return listing
+
+# every completer shares this one (the menus make a new one per prompt)
+listings = ListingCache()
+
 class PathCompleter(Completer):
     """
     Complete for Path variables.
@@ -59,24 +140,26 @@ class PathCompleter(Completer):
             # Start of current file.
             prefix = os.path.basename(text)
 
-            # Get all filenames.
-            filenames = []
-            for directory in directories:
-                # Look for matches in this directory.
-                if os.path.isdir(directory):
-                    for filename in os.listdir(directory):
-                        if filename.startswith(prefix):
-                            filenames.append((directory, filename))
+            def matches(listing):
+                for name, is_dir in listing.starting_with(prefix):
+                    yield name, is_dir, listing
 
-            # Sort
-            filenames = sorted(filenames, key=lambda k: k[1])
+            # Get all filenames, sorted across directories.
+            found = []
+            for directory in directories:
+                try:
+                    found.append(matches(listings.get(directory)))
+                except OSError:
+                    # not there, not a directory, not ours to read...
+                    continue
 
             # Yield them.
-            for directory, filename in filenames:
-                completion = filename[len(prefix):]
-                full_name = os.path.join(directory, filename)
+            for name, is_dir, listing in heapq.merge(*found,
+                                                     key=lambda k: k[0]):
+                completion = name[len(prefix):]
+                filename = name
 
-                if os.path.isdir(full_name):
+                if is_dir:
                     # For directories, add a slash to the filename.
                     # (We don't add them to the `completion`. Users can type it
                     # to trigger the autocompletion themselves.)
@@ -84,7 +167,7 @@ class PathCompleter(Completer):
                 elif self.only_directories:
                     continue
 
-                if not self.file_filter(full_name):
+                if not listing.passes(self.file_filter, name):
                     continue
 
                 yield Completion(completion, 0, display=filename)
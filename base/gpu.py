@@ -0,0 +1,185 @@
+import subprocess
+import time
+from collections import namedtuple
+
+__all__ = [
+    'Device',
+    'GPUProvider',
+    'SMIProvider',
+    'NVMLProvider',
+    'FakeProvider',
+    'make_provider',
+]
+
+# id is a string, same as what goes into CUDA_VISIBLE_DEVICES
+# memory is in MiB and utilization in percent, None if the provider can't tell
+Device = namedtuple('Device', ['id', 'procs', 'mem_total', 'mem_free', 'util'])
+
+class GPUProvider():
+    """
+        Base class for anything that can tell the dispatcher what GPUs there
+        are and what's running on them. Subclasses implement devices().
+    """
+    def devices(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class SMIProvider(GPUProvider):
+    """
+        Asks NVIDIA's PMON tool (nvidia-smi pmon -c 1). Forking nvidia-smi
+        takes about a second, so the answer is kept for [ttl] seconds and
+        reused by anyone who asks in the mean time. A hung nvidia-smi gets
+        killed after [timeout] seconds and we go with what we had last.
+
+        pmon doesn't say anything about memory, so with [memory] we also ask
+        nvidia-smi --query-gpu for free memory and utilization (that's a
+        second fork, only worth it when packing jobs by memory).
+    """
+    def __init__(self, ttl = 0, timeout = 30, memory = False):
+        self.ttl = ttl
+        self.timeout = timeout
+        self.memory = memory
+        self.cached = []
+        self.stamp = None
+
+    def smi(self, args):
+        sp = subprocess.Popen(['nvidia-smi'] + args,
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            out, _ = sp.communicate(timeout = self.timeout)
+        except subprocess.TimeoutExpired:
+            sp.kill()
+            sp.communicate()
+            raise
+        return out.decode('utf-8')
+
+    def query_memory(self):
+        """ id -> (total MiB, free MiB, utilization %) """
+        out = self.smi(['--query-gpu=index,memory.total,memory.free,'
+                        'utilization.gpu', '--format=csv,noheader,nounits'])
+        info = {}
+        for line in out.splitlines():
+            fields = [f.strip() for f in line.split(',')]
+            if len(fields) != 4 or not fields[0].isdigit():
+                continue
+            try:
+                info[fields[0]] = tuple(int(f) for f in fields[1:])
+            except ValueError:
+                # [N/A] and friends
+                info[fields[0]] = (None, None, None)
+        return info
+
+    def query(self):
+        # Nvidia-smi's process monitoring system with count 1
+        out = self.smi(['pmon', '-c', '1'])
+
+        # one line per process (or a '-' pid if the gpu is empty), the column
+        # names are commented out with a '#'
+        procs = {}
+        for line in out.splitlines():
+            fields = line.split()
+            if not fields or line.lstrip().startswith('#'):
+                continue
+            gpu_id, gpu_pid = fields[0], fields[1]
+            if not gpu_id.isdigit():
+                continue
+            procs.setdefault(gpu_id, 0)
+            if gpu_pid != '-':
+                procs[gpu_id] += 1
+
+        memory = self.query_memory() if self.memory else {}
+        return [Device(i, n, *memory.get(i, (None, None, None)))
+                for i, n in procs.items()]
+
+    def devices(self):
+        now = time.monotonic()
+        if self.stamp is None or now - self.stamp >= self.ttl:
+            try:
+                self.cached = self.query()
+            except (OSError, subprocess.TimeoutExpired):
+                # no nvidia-smi or it hung, go with what we had
+                pass
+            self.stamp = now
+        return self.cached
+
+class NVMLProvider(GPUProvider):
+    """
+        Asks the NVIDIA driver directly through NVML, in process, so there's no
+        fork per query. Needs the nvidia-ml-py (pynvml) package.
+
+        NVML doesn't survive a fork, so it only gets initialized on the first
+        query, which happens in the dispatcher process.
+    """
+    def __init__(self):
+        try:
+            import pynvml
+        except ImportError:
+            raise ImportError('The NVML GPU backend needs pynvml, '
+                              'pip install nvidia-ml-py')
+        self.nvml = pynvml
+        self.handles = None
+
+    def devices(self):
+        nvml = self.nvml
+        if self.handles is None:
+            nvml.nvmlInit()
+            self.handles = [nvml.nvmlDeviceGetHandleByIndex(i)
+                            for i in range(nvml.nvmlDeviceGetCount())]
+
+        devices = []
+        for i, h in enumerate(self.handles):
+            procs = len(nvml.nvmlDeviceGetComputeRunningProcesses(h))
+            procs += len(nvml.nvmlDeviceGetGraphicsRunningProcesses(h))
+            mem = nvml.nvmlDeviceGetMemoryInfo(h)
+            util = nvml.nvmlDeviceGetUtilizationRates(h).gpu
+            devices.append(Device(str(i), procs, mem.total // 2**20,
+                                  mem.free // 2**20, util))
+        return devices
+
+    def close(self):
+        if self.handles is not None:
+            self.nvml.nvmlShutdown()
+            self.handles = None
+
+class FakeProvider(GPUProvider):
+    """
+        Pretend GPUs, for testing and benchmarking on machines without any.
+
+        count     :   how many devices there are
+        busy      :   busy pattern(s), a string per query where a '1' at
+                      position i means GPU i has something on it. Given a
+                      list, the patterns are cycled through one per query, so
+                      the same sequence of answers comes out every time.
+        mem_total :   memory per device (MiB)
+    """
+    def __init__(self, count = 4, busy = None, mem_total = 16384):
+        self.count = count
+        self.busy = busy if busy is not None else ['0' * count]
+        if isinstance(self.busy, str):
+            self.busy = [self.busy]
+        self.mem_total = mem_total
+        self.queries = 0
+
+    def devices(self):
+        pattern = self.busy[self.queries % len(self.busy)]
+        self.queries += 1
+        devices = []
+        for i in range(self.count):
+            procs = 1 if i < len(pattern) and pattern[i] == '1' else 0
+            free = 0 if procs else self.mem_total
+            devices.append(Device(str(i), procs, self.mem_total, free,
+                                  100 * procs))
+        return devices
+
+def make_provider(name = 'smi', **kwargs):
+    """
+        name: 'smi' | 'nvml' | 'fake', the rest goes to the provider
+    """
+    providers = {
+        'smi': SMIProvider,
+        'nvml': NVMLProvider,
+        'fake': FakeProvider,
+    }
+    return providers[name](**kwargs)
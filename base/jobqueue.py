@@ -0,0 +1,292 @@
+import heapq
+import itertools
+import re
+
+__all__ = [
+    'JobQueue',
+    'natural_key',
+]
+
+def natural_key(s):
+    """ sort key that puts batch-2 before batch-10 and run_9 before run_10 """
+    return tuple(int(t) if t.isdigit() else t for t in re.split(r'(\d+)', s))
+
+class Flow():
+    """
+        The jobs sharing one slice of the dispatcher (a batch, or all the
+        batches with the same label), in their own order.
+    """
+    def __init__(self, key, priority, weight, start):
+        self.key = key
+        self.priority = priority
+        self.weight = weight
+        self.pass_ = start # virtual time, goes up by 1/weight per job run
+        self.heap = [] # [order, seq, job, alive]
+        self.sources = [] # [batch, iterator, jobs left], see add_source
+        self.live = 0 # jobs in the heap that are alive, plus jobs left
+        self.version = 0
+
+    def pop(self):
+        while self.heap:
+            entry = heapq.heappop(self.heap)
+            if entry[3]:
+                self.live -= 1
+                return entry[2]
+        return None
+
+class JobQueue():
+    """
+        The dispatcher's queue of scripts waiting for GPUs.
+
+        Jobs are grouped into flows (one per batch, or one per label if
+        share = 'label'). Higher priority flows always go first. Between
+        flows of the same priority the GPUs are shared by weight (stride
+        scheduling): every job a flow gets to run moves it 1/weight further
+        along in virtual time, and the flow furthest behind goes next. So a
+        5000 job sweep and a 3 job debugging batch take turns instead of the
+        debugging batch waiting for the whole sweep.
+
+        Inside a flow jobs go in natural order of (batch id, file name).
+
+        Adding and popping is O(log n). Removing a job just marks it dead
+        and it gets skipped when it comes up, so that's O(1).
+
+        A flow can also get jobs from a source (a sweep, see add_source),
+        which is only asked for the next job when the flow's turn comes and
+        it has nothing else queued, so a huge sweep is never in here whole.
+
+        Jobs can also be deferred until some time (a retry backing off, see
+        defer). They count as queued (len, in), but can't be popped until
+        the dispatcher takes them out with due() and adds them again.
+    """
+    def __init__(self, share = 'batch'):
+        self.share = share
+        self.flows = {}
+        self.heap = [] # (-priority, pass, seq, flow key, flow version)
+        self.index = {} # job -> (flow key, batch, entry)
+        self.batches = {} # batch -> set of jobs
+        self.sources = {} # batch -> (flow key, source)
+        self.pending = 0 # jobs the sources have left
+        self.deferred = {} # job -> (batch, until)
+        self.later = [] # (until, seq, job), the deferred jobs by time
+        self.seq = itertools.count()
+        self.vtime = 0
+
+    def __len__(self):
+        return len(self.index) + self.pending + len(self.deferred)
+
+    def __bool__(self):
+        """ whether there's something to pop (deferred jobs don't count) """
+        return bool(self.index) or self.pending > 0
+
+    def __contains__(self, job):
+        return job in self.index or job in self.deferred
+
+    def __iter__(self):
+        """
+            the jobs that were queued one by one or deferred, in no
+            particular order (not what the sources still have)
+        """
+        return iter(list(self.index) + list(self.deferred))
+
+    def schedule(self, flow):
+        # versions are unique across flows, so an entry left over from a flow
+        # that emptied out never matches a new flow with the same key
+        flow.version = next(self.seq)
+        heapq.heappush(self.heap, (-flow.priority, flow.pass_, next(self.seq),
+                                   flow.key, flow.version))
+
+    def add(self, job, batch, label = None, priority = 0, weight = 1,
+            order = None):
+        """
+            Queue [job] from [batch]. [order] is what it's sorted on inside
+            its flow (natural order of the job's name by default).
+        """
+        if job in self.index:
+            return
+        flow = self.flow(batch, label, priority, weight)
+
+        entry = [order if order is not None else natural_key(job),
+                 next(self.seq), job, True]
+        heapq.heappush(flow.heap, entry)
+        self.grew(flow, 1)
+
+        self.index[job] = (flow.key, batch, entry)
+        self.batches.setdefault(batch, set()).add(job)
+
+    def add_source(self, batch, label = None, priority = 0, weight = 1,
+                   source = (), count = 0):
+        """
+            Queue the [count] jobs [source] (an iterable) yields for [batch],
+            without taking them out of it yet. They go after whatever jobs
+            the flow already has queued one by one, in the order they come
+            out. A batch has one source at most.
+        """
+        if count <= 0 or batch in self.sources:
+            return
+        flow = self.flow(batch, label, priority, weight)
+        src = [batch, iter(source), count]
+        flow.sources.append(src)
+        self.pending += count
+        self.sources[batch] = (flow.key, src)
+        self.grew(flow, count)
+
+    def remove_source(self, batch):
+        """
+            Take [batch]'s source out of the queue, returns (what's left of
+            the source, how many jobs it has left), or None if it has none.
+        """
+        found = self.sources.pop(batch, None)
+        if found is None:
+            return None
+        key, src = found
+        flow = self.flows[key]
+        flow.sources = [s for s in flow.sources if s is not src]
+        self.pending -= src[2]
+        flow.live -= src[2]
+        if flow.live == 0:
+            del self.flows[key]
+        return src[1], src[2]
+
+    def flow(self, batch, label, priority, weight):
+        """ the flow jobs of [batch] go in """
+        group = label if self.share == 'label' and label is not None else batch
+        key = (priority, self.share, group)
+
+        flow = self.flows.get(key)
+        if flow is None:
+            # a new flow starts where everybody else is now, not at zero,
+            # otherwise it would get to hog the GPUs until it caught up
+            flow = Flow(key, priority, max(weight, 1e-9), self.vtime)
+            self.flows[key] = flow
+        flow.weight = max(weight, 1e-9)
+        return flow
+
+    def grew(self, flow, n):
+        """ [flow] got [n] more jobs, it needs a turn if it had none """
+        flow.live += n
+        if flow.live == n:
+            flow.pass_ = max(flow.pass_, self.vtime)
+            self.schedule(flow)
+
+    def pull(self, flow):
+        """ the next job out of [flow]'s sources, None if they're dry """
+        while flow.sources:
+            src = flow.sources[0]
+            job = next(src[1], None)
+            if job is not None:
+                src[2] -= 1
+                flow.live -= 1
+                self.pending -= 1
+                if src[2] == 0:
+                    flow.sources.pop(0)
+                    del self.sources[src[0]]
+                return job
+            # it had fewer than it said
+            flow.sources.pop(0)
+            del self.sources[src[0]]
+            flow.live -= src[2]
+            self.pending -= src[2]
+        return None
+
+    def forget(self, job):
+        key, batch, entry = self.index.pop(job)
+        jobs = self.batches[batch]
+        jobs.discard(job)
+        if not jobs:
+            del self.batches[batch]
+        return key, entry
+
+    def remove(self, job):
+        if job in self.deferred:
+            # its entry in [later] is skipped when it comes up
+            del self.deferred[job]
+            return
+        key, entry = self.forget(job)
+        entry[3] = False
+        flow = self.flows[key]
+        flow.live -= 1
+        if flow.live == 0:
+            del self.flows[key]
+
+    def pop(self):
+        """ the next job to run """
+        while self.heap:
+            _, _, _, key, version = self.heap[0]
+            flow = self.flows.get(key)
+            if flow is None or flow.version != version:
+                heapq.heappop(self.heap)
+                continue
+
+            heapq.heappop(self.heap)
+            job = flow.pop()
+            if job is not None:
+                self.forget(job)
+            else:
+                job = self.pull(flow)
+            if job is None:
+                del self.flows[key]
+                continue
+
+            self.vtime = flow.pass_
+            flow.pass_ += 1 / flow.weight
+            if flow.live:
+                self.schedule(flow)
+            else:
+                del self.flows[key]
+            return job
+        raise IndexError('pop from an empty JobQueue')
+
+    def refund(self, job, batch, label = None, priority = 0, weight = 1,
+               order = None):
+        """
+            Put back a job we popped but couldn't place, and give its flow
+            back the turn it took.
+        """
+        self.add(job, batch, label, priority, weight, order)
+        flow = self.flows[self.index[job][0]]
+        flow.pass_ -= 1 / flow.weight
+        self.schedule(flow)
+
+    def jobs(self, batch, deferred = False):
+        """
+            the jobs of [batch] that were queued one by one, and the ones
+            that are deferred too with [deferred]
+        """
+        jobs = set(self.batches.get(batch, ()))
+        if deferred:
+            jobs.update(j for j, (b, _) in self.deferred.items() if b == batch)
+        return jobs
+
+    #### deferred jobs ####
+
+    def defer(self, job, batch, until):
+        """
+            Hold on to [job] of [batch] until [until] (time.monotonic), see
+            due(). It keeps nothing else about it, what flow it goes in is
+            decided when it's added again.
+        """
+        if job in self:
+            return
+        self.deferred[job] = (batch, until)
+        heapq.heappush(self.later, (until, next(self.seq), job))
+
+    def due(self, now):
+        """ the deferred jobs whose time has come, they're no longer in here """
+        jobs = []
+        while self.later and self.later[0][0] <= now:
+            until, _, job = heapq.heappop(self.later)
+            # unless it was removed (or removed and deferred again) since
+            if self.deferred.get(job, (None, None))[1] == until:
+                del self.deferred[job]
+                jobs.append(job)
+        return jobs
+
+    def next_due(self):
+        """ when the next deferred job is due, None if there aren't any """
+        while self.later:
+            until, _, job = self.later[0]
+            if self.deferred.get(job, (None, None))[1] == until:
+                return until
+            heapq.heappop(self.later)
+        return None
@@ -0,0 +1,193 @@
+import os
+import pickle as pkl
+import shutil
+import struct
+import time
+import zlib
+
+__all__ = [
+    'Journal',
+    'stamp',
+]
+
+# every record is its length and crc32, then the pickled (seq, op, args)
+_header = struct.Struct('<II')
+
+def stamp(snapshot, path):
+    """
+        Sizes and modification times of the [snapshot] and the journal at
+        [path] (and its .old). Anything written to either changes it.
+    """
+    found = []
+    for p in [snapshot, path, path + '.old']:
+        try:
+            st = os.stat(p)
+        except FileNotFoundError:
+            found.append(None)
+            continue
+        found.append((st.st_size, st.st_mtime_ns))
+    return tuple(found)
+
+class Journal():
+    """
+        Append-only log of the changes made to the State (batch added,
+        process marked, batch deleted), so that saving costs as much as what
+        changed instead of as much as the whole history.
+
+        Records are written as they happen and fsync'ed in groups, every
+        [sync_every] records or [sync_interval] seconds, whichever comes
+        first (and whenever sync() is called). Each record has a sequence
+        number; the snapshot remembers the last one it contains (State.seq)
+        so replaying never applies a change twice.
+
+        Compacting means writing a fresh snapshot of the State and starting
+        an empty journal. The old journal is kept next to it (as .old) until
+        the snapshot is safely on disk.
+
+        A record cut short by a crash fails its length or crc check, and
+        replaying stops right there.
+    """
+    def __init__(self, path, sync_every = 256, sync_interval = 1.0):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+
+        self.seq = 0
+        self.size = 0
+        self.pending = 0
+        self.synced = time.monotonic()
+        self.f = None
+        self.good = None # where the last good record ends, see replay
+
+    #### reading ####
+
+    def records(self, path):
+        """
+            yields (seq, op, args) for every good record in [path], self.end
+            is where the last one yielded ends
+        """
+        self.end = 0
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            while True:
+                header = f.read(_header.size)
+                if len(header) < _header.size:
+                    return
+                length, crc = _header.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    return
+                self.end = f.tell()
+                yield pkl.loads(payload)
+
+    def replay(self, state):
+        """
+            Apply whatever the journal has that [state] doesn't. Returns how
+            many records that was.
+        """
+        self.seq = getattr(state, 'seq', 0)
+        count = 0
+        for path in [self.path + '.old', self.path]:
+            for seq, op, args in self.records(path):
+                if seq <= self.seq:
+                    continue
+                getattr(state, op)(*args)
+                self.seq = seq
+                count += 1
+        self.good = self.end
+        state.seq = self.seq
+        return count
+
+    #### writing ####
+
+    def open(self):
+        self.f = open(self.path, 'ab')
+        self.size = self.f.tell()
+        if self.good is not None and self.size > self.good:
+            # the tail of a record a crash cut short, new records go where
+            # it started so replaying doesn't stop at it
+            self.f.truncate(self.good)
+            self.size = self.good
+        self.good = None
+
+    def append(self, op, *args):
+        self.seq += 1
+        payload = pkl.dumps((self.seq, op, args))
+        self.f.write(_header.pack(len(payload), zlib.crc32(payload)))
+        self.f.write(payload)
+        self.size += _header.size + len(payload)
+        self.pending += 1
+
+        if (self.pending >= self.sync_every or
+                time.monotonic() - self.synced >= self.sync_interval):
+            self.sync()
+        return self.seq
+
+    def sync(self):
+        """ make sure everything appended so far is on disk """
+        if self.pending:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self.pending = 0
+        self.synced = time.monotonic()
+
+    def rotate(self):
+        """
+            Put the current journal aside (as .old) and start an empty one.
+            Call this at the moment the snapshot is taken.
+
+            If there's a .old already, the last compaction never finished and
+            the snapshot on disk still needs it, so the current journal goes
+            at the end of it instead of over it.
+        """
+        self.sync()
+        self.f.close()
+        old = self.path + '.old'
+        if os.path.exists(old):
+            # whatever a crash cut short at its end goes, or replaying would
+            # stop there and never get to what we add
+            for _ in self.records(old):
+                pass
+            with open(self.path, 'rb') as src, open(old, 'r+b') as dst:
+                dst.truncate(self.end)
+                dst.seek(self.end)
+                shutil.copyfileobj(src, dst)
+                dst.flush()
+                os.fsync(dst.fileno())
+            os.remove(self.path)
+        else:
+            os.replace(self.path, old)
+        self.open()
+
+    def compact(self, data, snapshot):
+        """
+            Write [data] (the pickled State, taken when we rotated) to
+            [snapshot] and throw away the journal it makes redundant.
+        """
+        tmp = snapshot + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, snapshot)
+
+        # the rename itself has to hit the disk before the journal goes
+        fd = os.open(os.path.dirname(os.path.abspath(snapshot)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        try:
+            os.remove(self.path + '.old')
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        if self.f is not None:
+            self.sync()
+            self.f.close()
+            self.f = None
@@ -0,0 +1,203 @@
+import errno
+import fcntl
+import glob
+import os
+import shutil
+import tempfile
+
+from base import sweep
+
+__all__ = [
+    'matches',
+    'place',
+    'load',
+    'load_sweep',
+]
+
+# linux/fs.h, clone a file's extents (a copy-on-write copy, btrfs/xfs/...)
+FICLONE = 0x40049409
+
+# the errors that mean "this way of placing files doesn't work here"
+UNSUPPORTED = (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+               errno.EPERM, errno.EMLINK, errno.ENOSYS)
+
+def matches(pattern):
+    """ the files matching [pattern] (~ and * allowed), as they're found """
+    for path in glob.iglob(os.path.expanduser(pattern)):
+        if os.path.isfile(path):
+            yield path
+
+#### ways of getting a file into the queue ####
+
+def reflink(src, dst):
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            d.close()
+            os.remove(dst)
+            raise
+    shutil.copymode(src, dst)
+
+def hardlink(src, dst):
+    os.link(src, dst)
+
+def copy(src, dst):
+    shutil.copy(src, dst)
+
+METHODS = {
+    'reflink': reflink,
+    'hardlink': hardlink,
+    'copy': copy,
+}
+
+def place(pairs, mode = 'auto', workers = 8):
+    """
+        Put every (src, dst) of [pairs] in place.
+
+        mode : 'reflink' (copy-on-write clone, same filesystem only)
+               'hardlink' (same file, same filesystem only: editing the
+                    original in place after loading edits the queued script)
+               'copy'
+               'auto' (reflink, else hardlink, else copy)
+
+        Whatever works for the first file is used for the rest, falling back
+        to copying for any file it doesn't work on. Copies run on [workers]
+        threads. Returns the method that got used.
+    """
+    pairs = iter(pairs)
+    first = next(pairs, None)
+    if first is None:
+        return None
+
+    tries = ['reflink', 'hardlink', 'copy'] if mode == 'auto' else [mode]
+    for name in tries:
+        try:
+            METHODS[name](*first)
+            break
+        except OSError as err:
+            if err.errno not in UNSUPPORTED or name == tries[-1]:
+                raise
+    method = METHODS[name]
+
+    def put(pair):
+        try:
+            method(*pair)
+        except OSError as err:
+            if method is copy or err.errno not in UNSUPPORTED:
+                raise
+            copy(*pair)
+
+    if method is copy and workers > 1:
+        # (imported here, it drags logging in and `maestro.py load` mostly
+        # links, see bench_startup.py)
+        from concurrent.futures import ThreadPoolExecutor
+
+        # the copying itself happens outside the GIL
+        with ThreadPoolExecutor(workers) as pool:
+            for _ in pool.map(put, pairs):
+                pass
+    else:
+        for pair in pairs:
+            put(pair)
+    return name
+
+#### the whole thing ####
+
+def load(state, queue_dir, files, label, options = None, mode = 'auto',
+         workers = 8):
+    """
+        Make a batch out of [files] (paths): registers it with [state] in one
+        update and puts the scripts in [queue_dir]/batch-<id>.
+
+        The scripts are put together in a staging folder next to the queue
+        and renamed into it in one go, so the dispatcher never sees half a
+        batch. Files with a name that's already in the batch are skipped
+        (the run directory is flat, they'd overwrite each other).
+
+        Returns (batch id, how many files, skipped files, method used).
+    """
+    seen = set()
+    kept = []
+    skipped = []
+    for path in files:
+        name = os.path.basename(path)
+        if name in seen:
+            skipped.append(path)
+            continue
+        seen.add(name)
+        kept.append(path)
+    if not kept:
+        return None, 0, skipped, None
+
+    # same filesystem as the queue, so the rename is one step
+    staging = tempfile.mkdtemp(prefix = '.staging-',
+                               dir = os.path.dirname(os.path.abspath(queue_dir)))
+    id = None
+    try:
+        method = place(((p, os.path.join(staging, os.path.basename(p)))
+                        for p in kept), mode, workers)
+        # one state update for the whole batch, however big
+        id = state.add_batch(label, kept, options)
+        os.rename(staging, os.path.join(queue_dir, 'batch-' + str(id)))
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors = True)
+        if id is not None:
+            state.delete_batch(id)
+        raise
+
+    return id, len(kept), skipped, method
+
+def load_sweep(state, queue_dir, template, params, label, options = None,
+               via = 'env', mode = 'auto'):
+    """
+        Make a sweep batch (see sweep.py) out of the script at [template]
+        and [params]: a grid ({name: [values]}), a list of points
+        ([{name: value}]) or the path to a JSONL file of points. The
+        parameters get to the script through the environment (via = 'env')
+        or as arguments (via = 'args').
+
+        Whatever the size of the sweep, that's the template, the manifest
+        (and the JSONL file if it's one) in [queue_dir]/batch-<id>, put
+        together and renamed in like load() does it.
+
+        Returns (batch id, how many points, method used).
+    """
+    if isinstance(params, str):
+        params = os.path.expanduser(params)
+        size = sweep.count_points(params)
+    elif isinstance(params, dict):
+        size = 1
+        for values in params.values():
+            if not isinstance(values, list):
+                raise ValueError('a grid is {name: [values]}')
+            size *= len(values)
+    else:
+        params = list(params)
+        if not all(isinstance(p, dict) for p in params):
+            raise ValueError('a list of points is [{name: value}]')
+        size = len(params)
+    if size == 0:
+        return None, 0, None
+
+    staging = tempfile.mkdtemp(prefix = '.staging-',
+                               dir = os.path.dirname(os.path.abspath(queue_dir)))
+    id = None
+    try:
+        pairs = [(template, os.path.join(staging, sweep.TEMPLATE))]
+        if isinstance(params, str):
+            pairs.append((params, os.path.join(staging, sweep.PARAMS)))
+        method = place(pairs, mode, workers = 1)
+        name = os.path.splitext(os.path.basename(template))[0]
+        sweep.write(staging, name, None if isinstance(params, str) else params,
+                    size, via)
+
+        id = state.add_sweep(label, template, size, options)
+        os.rename(staging, os.path.join(queue_dir, 'batch-' + str(id)))
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors = True)
+        if id is not None:
+            state.delete_batch(id)
+        raise
+
+    return id, size, method
@@ -0,0 +1,136 @@
+import datetime
+import glob
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import shutil
+from collections import deque
+from queue import SimpleQueue
+
+__all__ = [
+    'FIELDS',
+    'JSONFormatter',
+    'GzipRotatingFileHandler',
+    'setup',
+    'files',
+    'records',
+    'query',
+]
+
+# what can go in a record besides the message, through extra={...}
+FIELDS = ('batch', 'job', 'status', 'pid', 'gpus', 'rc', 'count')
+
+class JSONFormatter(logging.Formatter):
+    """
+        One JSON object per line: time, level, message and whichever of
+        FIELDS the record was logged with, so the log can be filtered by
+        batch, job or status without parsing the message.
+    """
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created)
+                            .isoformat(timespec = 'milliseconds'),
+            'level': record.levelname,
+            'msg': record.getMessage(),
+        }
+        for field in FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default = str)
+
+class GzipRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+        A RotatingFileHandler whose old files get gzipped: logfile.jsonl,
+        logfile.jsonl.1.gz, logfile.jsonl.2.gz, ...
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.namer = lambda name: name + '.gz'
+        self.rotator = self.compress
+
+    def compress(self, source, dest):
+        with open(source, 'rb') as f, gzip.open(dest, 'wb') as out:
+            shutil.copyfileobj(f, out)
+        os.remove(source)
+
+def setup(path, level = logging.INFO, max_bytes = 10 * 2**20, backups = 5):
+    """
+        Send everything logged in this process to [path] as JSON lines, from a
+        background thread: logging calls only put the record on a queue, the
+        formatting, writing, rotating and compressing happen in the listener.
+        Returns the listener, stop() it on the way out to flush the queue.
+    """
+    handler = GzipRotatingFileHandler(path, maxBytes = max_bytes,
+                                      backupCount = backups)
+    handler.setFormatter(JSONFormatter())
+
+    records = SimpleQueue()
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+
+    root = logging.getLogger()
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.setLevel(level)
+    return listener
+
+#### reading it back ####
+
+def files(path):
+    """ [path] and its rotated files, oldest first """
+    def number(name):
+        n = name[len(path) + 1:].split('.')[0]
+        return int(n) if n.isdigit() else 0
+    rotated = sorted(glob.glob(glob.escape(path) + '.*.gz'), key = number,
+                     reverse = True)
+    return rotated + ([path] if os.path.exists(path) else [])
+
+def records(path):
+    """ yields every record in [path] and its rotated files, oldest first """
+    for name in files(path):
+        opener = gzip.open if name.endswith('.gz') else open
+        with opener(name, 'rt') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # not one of ours (an old plain text log, a cut off line)
+                    continue
+
+def query(path, batch = None, job = None, status = None, level = None,
+          since = None, tail = None):
+    """
+        The records in the log at [path] that match everything given, one
+        file and one line at a time. [tail] keeps only the last so many.
+
+        batch  :   batch id
+        job    :   script name (or the full path)
+        status :   running | completed | failed | ...
+        level  :   lowest level to show, e.g. 'WARNING'
+        since  :   ISO timestamp, e.g. '2024-05-01' or '2024-05-01T13:00'
+    """
+    lowest = logging.getLevelName(level.upper()) if level else None
+    job = os.path.basename(job) if job else None
+
+    def matches(r):
+        if batch is not None and r.get('batch') != batch:
+            return False
+        if job is not None and r.get('job') != job:
+            return False
+        if status is not None and r.get('status') != status:
+            return False
+        if lowest is not None and \
+                logging.getLevelName(r.get('level', 'INFO')) < lowest:
+            return False
+        if since is not None and r.get('time', '') < since:
+            return False
+        return True
+
+    found = (r for r in records(path) if matches(r))
+    if tail:
+        return iter(deque(found, maxlen = tail))
+    return found
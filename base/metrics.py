@@ -0,0 +1,282 @@
+import http.server
+import json
+import os
+import socketserver
+import threading
+import time
+from collections import deque
+
+__all__ = [
+    'Counter',
+    'Gauge',
+    'Histogram',
+    'Rate',
+    'Metrics',
+    'serve',
+    'dump_every',
+]
+
+# seconds, good for anything from a state update to a job sitting in the queue
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 1800,
+           3600, 4 * 3600, 24 * 3600)
+
+class Counter():
+    """ only goes up """
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, n = 1):
+        self.value += n
+
+    def lines(self):
+        return ['%s %s' % (self.name, self.value)]
+
+    def json(self):
+        return self.value
+
+class Gauge(Counter):
+    """ whatever it was last set to """
+    kind = 'gauge'
+
+    def set(self, value):
+        self.value = value
+
+class Histogram():
+    """ how many observations fell in each bucket, plus their sum """
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets = BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, b in enumerate(self.buckets):
+            if value <= b:
+                self.counts[i] += 1
+                break
+
+    def lines(self):
+        lines = []
+        total = 0
+        for b, n in zip(self.buckets, self.counts):
+            total += n
+            lines.append('%s_bucket{le="%g"} %d' % (self.name, b, total))
+        lines.append('%s_bucket{le="+Inf"} %d' % (self.name, self.count))
+        lines.append('%s_sum %s' % (self.name, self.sum))
+        lines.append('%s_count %d' % (self.name, self.count))
+        return lines
+
+    def json(self):
+        return {'count': self.count, 'sum': self.sum,
+                'mean': self.sum / self.count if self.count else None}
+
+class Rate():
+    """ how many times something happened in the last [window] seconds """
+    kind = 'gauge'
+
+    def __init__(self, name, help, window = 60):
+        self.name = name
+        self.help = help
+        self.window = window
+        self.times = deque()
+
+    def inc(self, n = 1):
+        now = time.monotonic()
+        self.times.extend([now] * n)
+        self.count(now)
+
+    def count(self, now = None):
+        cutoff = (now or time.monotonic()) - self.window
+        while self.times and self.times[0] < cutoff:
+            self.times.popleft()
+        return len(self.times)
+
+    def lines(self):
+        return ['%s %d' % (self.name, self.count())]
+
+    def json(self):
+        return self.count()
+
+class Metrics():
+    """
+        The dispatcher's counters and timers. Updating them is a couple of
+        additions under a lock, so it's fine to do in the scheduling loop
+        (and from the async engine's threads).
+
+        Read them as Prometheus text (text()) or as a dict (json()).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.metrics = {}
+
+        self.gauge('queue_depth', 'Jobs waiting in the queue')
+        self.gauge('running_jobs', 'Jobs the dispatcher has running')
+        self.gauge('idle_gpus', 'GPUs with nothing on them (not blocked)')
+        self.gauge('idle_gpus_while_queued', 'Idle GPUs while jobs are '
+                   'waiting in the queue, should be 0 most of the time')
+        self.histogram('gpu_probe_seconds', 'How long asking for the GPU '
+                       'inventory took')
+        self.histogram('state_update_seconds', 'How long telling the state '
+                       'service about a job took')
+        self.histogram('tick_seconds', 'How long a scheduling pass took')
+        self.histogram('queue_wait_seconds', 'How long jobs waited in the '
+                       'queue before being launched')
+        self.counter('launches_total', 'Jobs launched')
+        self.counter('launch_failures_total', 'Jobs that failed to launch')
+        self.counter('completed_total', 'Jobs that exited with 0')
+        self.counter('failed_total', 'Jobs that exited with something else')
+        self.counter('retries_total', 'Failed jobs that were queued again')
+        self.rate('launches_per_minute', 'Jobs launched in the last minute')
+        self.rate('launch_failures_per_minute', 'Jobs that failed to launch '
+                  'in the last minute')
+
+    #### making them ####
+
+    def add(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help):
+        return self.add(Counter('maestro_' + name, help))
+
+    def gauge(self, name, help):
+        return self.add(Gauge('maestro_' + name, help))
+
+    def histogram(self, name, help, buckets = BUCKETS):
+        return self.add(Histogram('maestro_' + name, help, buckets))
+
+    def rate(self, name, help, window = 60):
+        return self.add(Rate('maestro_' + name, help, window))
+
+    #### updating them ####
+
+    def inc(self, name, n = 1):
+        with self.lock:
+            self.metrics['maestro_' + name].inc(n)
+
+    def set(self, name, value):
+        with self.lock:
+            self.metrics['maestro_' + name].set(value)
+
+    def observe(self, name, value):
+        with self.lock:
+            self.metrics['maestro_' + name].observe(value)
+
+    def timer(self, name):
+        """ with metrics.timer('tick_seconds'): ... """
+        return _Timer(self, name)
+
+    #### reading them ####
+
+    def text(self):
+        """ Prometheus text exposition format """
+        lines = []
+        with self.lock:
+            for m in self.metrics.values():
+                lines.append('# HELP %s %s' % (m.name, m.help))
+                lines.append('# TYPE %s %s' % (m.name, m.kind))
+                lines.extend(m.lines())
+        return '\n'.join(lines) + '\n'
+
+    def json(self):
+        with self.lock:
+            values = {m.name: m.json() for m in self.metrics.values()}
+        values['time'] = time.time()
+        values['uptime'] = time.time() - self.started
+        return values
+
+class _Timer():
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+        return False
+
+#### serving them ####
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] in ('/', '/metrics'):
+            body = self.server.metrics.text().encode('utf-8')
+            kind = 'text/plain; version=0.0.4; charset=utf-8'
+        elif self.path.split('?')[0] == '/metrics.json':
+            body = json.dumps(self.server.metrics.json()).encode('utf-8')
+            kind = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', kind)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # unix sockets don't have a (host, port)
+        return str(self.client_address or 'unix')
+
+    def log_message(self, format, *args):
+        # scrapes every 15s would drown everything else in the log
+        pass
+
+class _TCPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def serve(metrics, address):
+    """
+        Serve [metrics] over HTTP from a background thread, at [address]:
+        'host:port', just a port (localhost), or 'unix:/some/path' for a unix
+        socket (curl --unix-socket /some/path http://x/metrics). Returns the
+        server, shutdown() it to stop.
+    """
+    if address.startswith('unix:'):
+        path = address[len('unix:'):]
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        server = _UnixServer(path, _Handler)
+    else:
+        host, _, port = address.rpartition(':')
+        server = _TCPServer((host or '127.0.0.1', int(port)), _Handler)
+    server.metrics = metrics
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server
+
+def dump_every(metrics, path, interval):
+    """
+        Write [metrics] as JSON to [path] every [interval] seconds, from a
+        background thread. The file is replaced in one go, so whoever reads
+        it never sees half of it.
+    """
+    def dump():
+        while True:
+            time.sleep(interval)
+            tmp = path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(metrics.json(), f)
+            os.replace(tmp, path)
+
+    thread = threading.Thread(target = dump, daemon = True)
+    thread.start()
+    return thread
@@ -0,0 +1,173 @@
+import functools
+import json
+import logging
+import os
+import signal
+
+__all__ = [
+    'RunningTable',
+    'Adopted',
+    'wrap',
+    'pinning',
+    'kill_group',
+]
+
+# what every job is run under: the script, then its exit status written
+# down where the next dispatcher can find it if we aren't around to wait()
+# for it anymore. $0 is that file, the rest is the command. The file is only
+# read once the shell is gone, so it's never seen half written (unless the
+# shell got killed writing it, and then it wasn't going to say anything)
+WRAPPER = '"$@"; rc=$?; echo $rc > "$0"; exit $rc'
+
+def wrap(command, rc_file):
+    """ [command] (a Popen list) run under WRAPPER, writing to [rc_file] """
+    return ['/bin/sh', '-c', WRAPPER, rc_file] + list(command)
+
+def pinning(cpus):
+    """
+        What Popen should run in the child (preexec_fn) to pin the job to
+        [cpus] before it starts, so the wrapper and everything it starts get
+        it from the first instruction on. None if there's nothing to pin, or
+        if those CPUs aren't ours to give (a job can't be pinned to them
+        either way, and a failing preexec_fn would fail the launch).
+    """
+    if not cpus:
+        return None
+    cpus = set(cpus)
+    if not cpus <= os.sched_getaffinity(0):
+        return None
+    return functools.partial(os.sched_setaffinity, 0, cpus)
+
+def started(pid):
+    """ when [pid] started, to tell it from whatever gets its pid later """
+    import psutil # slow to import, and only the dispatcher needs it
+
+    try:
+        return psutil.Process(pid).create_time()
+    except psutil.Error:
+        return None
+
+def kill_group(pid, sig = signal.SIGKILL):
+    """
+        Send [sig] to the job with [pid] and everything it started. Jobs lead
+        their own process group, ones started before that don't, so they only
+        get it themselves. Raises ProcessLookupError if it's gone.
+    """
+    try:
+        os.killpg(pid, sig)
+    except ProcessLookupError:
+        os.kill(pid, sig)
+
+class RunningTable():
+    """
+        The jobs a dispatcher has running, on disk, so the next one can pick
+        them up if it dies or gets stopped while they're still going (see
+        Dispatcher.adopt).
+
+        One small JSON file per job in [folder] (pid, when it started, its
+        GPUs, the script and the log folder), written when it's launched and
+        removed when it's reaped, plus the file its exit status goes to
+        (see wrap). Files are replaced in one go, no fsync though: if the
+        machine goes down the jobs go with it, and then there's nothing to
+        pick up anyway.
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok = True)
+
+    def name(self, job):
+        # jobs are [queue]/batch-<id>/<file>.sh, unique per batch folder
+        folder, fname = os.path.split(job)
+        return os.path.join(self.folder, '%s-%s' % (os.path.basename(folder),
+                                                   fname))
+
+    def rc_file(self, job):
+        return self.name(job) + '.rc'
+
+    def add(self, job, pid, gpus, path, log_dir):
+        record = {
+            'job': job,
+            'pid': pid,
+            'started': started(pid),
+            'gpus': list(gpus),
+            'path': path,
+            'log_dir': log_dir,
+            'rc_file': self.rc_file(job),
+        }
+        name = self.name(job) + '.json'
+        with open(name + '.tmp', 'w') as f:
+            json.dump(record, f)
+        os.replace(name + '.tmp', name)
+
+    def remove(self, job, pid = None):
+        """ [job]'s record, only if it's still the one for [pid] if given """
+        if pid is not None:
+            try:
+                with open(self.name(job) + '.json') as f:
+                    if json.load(f).get('pid') != pid:
+                        # launched again already
+                        return
+            except (OSError, ValueError):
+                pass
+        for name in [self.name(job) + '.json', self.rc_file(job)]:
+            try:
+                os.remove(name)
+            except FileNotFoundError:
+                pass
+
+    def load(self):
+        """ every job in the table, as the dicts add() wrote """
+        records = []
+        for entry in sorted(os.scandir(self.folder), key = lambda e: e.name):
+            if not entry.name.endswith('.json'):
+                continue
+            try:
+                with open(entry.path) as f:
+                    records.append(json.load(f))
+            except (OSError, ValueError) as err:
+                logging.warning("Can't read %s, forgetting about it: %s",
+                                entry.path, err)
+                os.remove(entry.path)
+        return records
+
+class Adopted():
+    """
+        Stands in for the Popen of a job that an earlier dispatcher started
+        (from its RunningTable record). It isn't our child, so its exit
+        status comes from its rc file, and if it's gone without one (killed
+        along with its shell, or the machine restarted), returncode is -9 and
+        lost is True.
+    """
+    def __init__(self, record):
+        self.pid = record['pid']
+        self.started = record['started']
+        self.rc_file = record['rc_file']
+        self.returncode = None
+        self.lost = False
+
+    def alive(self):
+        import psutil
+
+        try:
+            p = psutil.Process(self.pid)
+            # same pid, somebody else entirely
+            if self.started is not None and \
+                    abs(p.create_time() - self.started) > 1:
+                return False
+            return p.status() != psutil.STATUS_ZOMBIE
+        except psutil.Error:
+            return False
+
+    def poll(self):
+        if self.returncode is not None:
+            return self.returncode
+        if self.alive():
+            return None
+        # it writes the file before it exits, so it's there by now if ever
+        try:
+            with open(self.rc_file) as f:
+                self.returncode = int(f.read())
+        except (OSError, ValueError):
+            self.returncode = -9
+            self.lost = True
+        return self.returncode
@@ -0,0 +1,380 @@
+import os
+import pickle as pkl
+import signal
+import threading
+from multiprocessing.managers import BaseManager, BaseProxy
+
+from base import base, journal
+
+__all__ = [
+    'StateStore',
+    'StoreProxy',
+    'StateManager',
+    'serve',
+    'connect',
+]
+
+class StateStore():
+    """
+        Holds the one and only State of the experiment manager.
+
+        It lives in its own (manager) process and everybody else (the menus,
+        the dispatcher, the saver) talks to it through a proxy with small
+        messages: mark this file of that batch as running with this pid, add a
+        batch, delete a batch, and so on. Nobody ever takes the State away
+        from it, so there's nothing to wait for or fight over, and a status
+        change doesn't mean pickling the whole history back and forth.
+
+        Anyone who wants to look at everything gets a snapshot (a copy).
+
+        Every change is appended to a journal next to the saved State (see
+        journal.py). The State itself only gets rewritten when the journal
+        grows past [compact_size] bytes, or on save().
+    """
+    def __init__(self, path, compact_size = 4 * 2**20):
+        self.path = path
+        self.compact_size = compact_size
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.version = 0
+        self.saved = 0
+        self.options_rev = 0
+        self.options_changed = {} # batch id -> options_rev it changed at
+        self.clients = 0 # connected with connect() and still using it
+
+        try:
+            with open(path, 'rb') as f:
+                self.state = pkl.load(f)
+        except FileNotFoundError:
+            self.state = base.State()
+
+        self.journal = journal.Journal(os.path.splitext(path)[0] + '.journal')
+        self.journal.replay(self.state)
+        self.journal.open()
+
+        # a compaction that didn't get to finish gets finished now. Otherwise
+        # the journal is picked up where it was, rewriting the whole history
+        # every time someone starts maestro would make starting up as slow as
+        # the history is big
+        if self.journal.size >= compact_size or \
+                os.path.exists(self.journal.path + '.old'):
+            self.version += 1
+            self.save()
+
+    def apply(self, op, *args):
+        """ change the State and journal it, only call with the lock held """
+        result = getattr(self.state, op)(*args)
+        self.journal.append(op, *args)
+        self.version += 1
+        return result
+
+    def killed(self, bid, changed):
+        """ journal what a kill did, as marks """
+        for p, pid, status in changed:
+            self.journal.append('mark', bid, os.path.basename(p.filename),
+                                p.pid, p.status)
+            self.version += 1
+
+    def dump(self):
+        """ the whole State, pickled while nobody can touch it """
+        with self.lock:
+            return pkl.dumps(self.state)
+
+    def get_version(self):
+        return self.version
+
+    def attach(self, count = 1):
+        """
+            Somebody connected ([count] = 1) or is done ([count] = -1). Whoever
+            serves the store waits for them before going away (see
+            api.Maestro.close).
+        """
+        with self.lock:
+            self.clients = max(0, self.clients + count)
+
+    def get_clients(self):
+        return self.clients
+
+    def get_batch(self, bid):
+        """ a batch's (label, options), (None, None) if it doesn't exist """
+        with self.lock:
+            batch = self.state.batches.get(bid)
+            if batch is None:
+                return None, None
+            return batch.label, batch.options
+
+    def summary(self, bid = None, processes = False):
+        """
+            Every batch (or just [bid]) as a dict, with how many processes
+            have each status but without the processes themselves unless
+            asked for (see Batch.summary). Much less to send than dump().
+        """
+        with self.lock:
+            if bid is not None:
+                batch = self.state.batches.get(bid)
+                return [] if batch is None else [batch.summary(processes)]
+            return [b.summary(processes) for b in self.state.batches.values()]
+
+    def set_options(self, bid, options):
+        with self.lock:
+            if bid not in self.state.batches:
+                return False
+            self.apply('set_options', bid, options)
+            self.options_rev += 1
+            self.options_changed[bid] = self.options_rev
+            return True
+
+    def options_since(self, rev):
+        """
+            What batch options changed after [rev]: returns the current rev
+            and {batch id: (label, options)}.
+        """
+        with self.lock:
+            changed = {}
+            for bid, r in self.options_changed.items():
+                batch = self.state.batches.get(bid)
+                if r > rev and batch is not None:
+                    changed[bid] = (batch.label, batch.options)
+            return self.options_rev, changed
+
+    def mark(self, bid, fname, pid, status, log_dir = None):
+        with self.lock:
+            if log_dir is None:
+                self.apply('mark', bid, fname, pid, status)
+            else:
+                self.apply('mark', bid, fname, pid, status, log_dir)
+
+    def add_batch(self, label, filenames, options = None):
+        """ make a batch of queued processes out of [filenames], returns its id """
+        with self.lock:
+            id = max(self.state.batches.keys(), default = -1) + 1
+            self.apply('add_batch', id, label, list(filenames), options)
+            return id
+
+    def add_sweep(self, label, template, size, options = None):
+        """ make a sweep batch of [size] points (see sweep.py), returns its id """
+        with self.lock:
+            id = max(self.state.batches.keys(), default = -1) + 1
+            self.apply('add_sweep', id, label, template, size, options)
+            return id
+
+    def get_started(self, bid):
+        """ names of the points of sweep [bid] that got launched """
+        with self.lock:
+            batch = self.state.batches.get(bid)
+            if not isinstance(batch, base.Sweep):
+                return []
+            return batch.started()
+
+    def retry(self, bid, fname, attempt):
+        """ [fname] goes back to queued, [attempt] into its history """
+        with self.lock:
+            self.apply('retry', bid, fname, attempt)
+
+    def get_attempts(self, bid, fname):
+        """ how many times [fname] got retried so far """
+        with self.lock:
+            batch = self.state.batches.get(bid)
+            p = batch.find(fname) if batch is not None else None
+            return len(p.attempts or []) if p is not None else 0
+
+    def get_status(self, bid, fname):
+        """ status of [fname] in batch [bid], None if there's no such thing """
+        with self.lock:
+            batch = self.state.batches.get(bid)
+            p = batch.find(fname) if batch is not None else None
+            return p.status if p is not None else None
+
+    def delete_batch(self, bid):
+        with self.lock:
+            if bid not in self.state.batches:
+                return False
+            return self.apply('delete_batch', bid)
+
+    def kill_batch(self, bid):
+        with self.lock:
+            self.killed(bid, self.state.kill(bid))
+
+    def kill_pid(self, pid):
+        """ kill the process with [pid], returns False if we don't know it """
+        with self.lock:
+            found = self.state.find_pid(pid)
+            if found is None:
+                return False
+            bid, p = found
+            old = (p, p.pid, p.status)
+            self.state.kill_pid(pid)
+            if (p.pid, p.status) != old[1:]:
+                self.killed(bid, [old])
+            return True
+
+    def sync(self):
+        """
+            Make sure the journal is on disk, and compact it if it's gotten
+            big. This is what the saver calls every so often.
+        """
+        with self.lock:
+            self.journal.sync()
+            big = self.journal.size >= self.compact_size
+        if big:
+            self.save()
+
+    def save(self):
+        """
+            Write a fresh snapshot of the State (if it changed since the last
+            one) and start the journal over. The file is replaced in one go
+            so a crash never leaves half of it.
+        """
+        with self.save_lock:
+            with self.lock:
+                if self.saved == self.version:
+                    return False
+                self.state.seq = self.journal.seq
+                data = pkl.dumps(self.state)
+                version = self.version
+                self.journal.rotate()
+
+            self.journal.compact(data, self.path)
+            self.saved = version
+            return True
+
+    def close(self, save = True):
+        """ [save] = False leaves it to the journal, see sync() """
+        if save:
+            self.save()
+        else:
+            self.sync()
+        with self.lock:
+            self.journal.close()
+            self.write_summary()
+
+    def write_summary(self):
+        """
+            Leave what `maestro.py status` shows (Batch.summary without the
+            processes) next to the snapshot, so a status that finds nobody
+            serving the state doesn't have to load the whole history for it
+            (see api.Maestro.peek). It's only good for as long as the
+            snapshot and the journal stay as they are now, so only call this
+            with the journal closed, on the way out. The journal's last
+            sequence number goes with it, so a batch can be added without
+            loading the history (see api.Maestro.add_cold).
+        """
+        found = (journal.stamp(self.path, self.journal.path),
+                 [b.summary(False) for b in self.state.batches.values()],
+                 self.journal.seq)
+        path = os.path.splitext(self.path)[0] + '.summary'
+        with open(path + '.tmp', 'wb') as f:
+            pkl.dump(found, f)
+        os.replace(path + '.tmp', path)
+
+class StoreProxy(BaseProxy):
+    """ what everybody outside the manager process gets to talk to """
+    _exposed_ = ('dump', 'summary', 'get_version', 'attach', 'get_clients',
+                 'get_batch', 'set_options',
+                 'options_since', 'mark', 'add_batch', 'add_sweep',
+                 'get_started', 'get_status', 'retry', 'get_attempts',
+                 'delete_batch',
+                 'kill_batch', 'kill_pid', 'sync', 'save', 'close')
+
+    def snapshot(self):
+        """ a copy of the whole State, for looking at """
+        return pkl.loads(self._callmethod('dump'))
+
+    def summary(self, bid = None, processes = False):
+        return self._callmethod('summary', (bid, processes))
+
+    def version(self):
+        return self._callmethod('get_version')
+
+    def attach(self, count = 1):
+        return self._callmethod('attach', (count,))
+
+    def clients(self):
+        return self._callmethod('get_clients')
+
+    def batch(self, bid):
+        return self._callmethod('get_batch', (bid,))
+
+    def options(self, bid):
+        return self.batch(bid)[1]
+
+    def set_options(self, bid, options):
+        return self._callmethod('set_options', (bid, options))
+
+    def options_since(self, rev):
+        return self._callmethod('options_since', (rev,))
+
+    def mark(self, bid, fname, pid, status, log_dir = None):
+        return self._callmethod('mark', (bid, fname, pid, status, log_dir))
+
+    def add_batch(self, label, filenames, options = None):
+        return self._callmethod('add_batch', (label, filenames, options))
+
+    def add_sweep(self, label, template, size, options = None):
+        return self._callmethod('add_sweep', (label, template, size, options))
+
+    def started(self, bid):
+        return self._callmethod('get_started', (bid,))
+
+    def status(self, bid, fname):
+        return self._callmethod('get_status', (bid, fname))
+
+    def retry(self, bid, fname, attempt):
+        return self._callmethod('retry', (bid, fname, attempt))
+
+    def attempts(self, bid, fname):
+        return self._callmethod('get_attempts', (bid, fname))
+
+    def delete_batch(self, bid):
+        return self._callmethod('delete_batch', (bid,))
+
+    def kill_batch(self, bid):
+        return self._callmethod('kill_batch', (bid,))
+
+    def kill_pid(self, pid):
+        return self._callmethod('kill_pid', (pid,))
+
+    def sync(self):
+        return self._callmethod('sync')
+
+    def save(self):
+        return self._callmethod('save')
+
+    def close(self, save = True):
+        return self._callmethod('close', (save,))
+
+class StateManager(BaseManager):
+    pass
+
+_stores = {} # path -> StateStore, in the manager process
+
+def _store(path):
+    # everybody asking for the same path gets the same store, whether they
+    # started the manager or connected to it later (see connect)
+    if path not in _stores:
+        _stores[path] = StateStore(path)
+    return _stores[path]
+
+StateManager.register('Store', _store, proxytype = StoreProxy)
+
+def serve(path, address = None, authkey = None):
+    """
+        Start the state service for the State saved at [path]. Returns the
+        manager (shut it down when you're done) and a proxy to the store.
+
+        With an [address] (a unix socket path) and [authkey], other processes
+        can get to the same store with connect().
+    """
+    manager = StateManager(address = address, authkey = authkey)
+    # ctrl-c is for the menus, the state has to outlive it so it can be saved
+    manager.start(signal.signal, (signal.SIGINT, signal.SIG_IGN))
+    return manager, manager.Store(path)
+
+def connect(path, address, authkey):
+    """
+        A proxy to the store for the State at [path] that someone else is
+        serving at [address]. Raises OSError if nobody is.
+    """
+    manager = StateManager(address = address, authkey = authkey)
+    manager.connect()
+    return manager.Store(path)
@@ -0,0 +1,116 @@
+import itertools
+import json
+import os
+
+__all__ = [
+    'MANIFEST',
+    'Points',
+    'write',
+    'count_points',
+    'value',
+]
+
+# what makes a batch folder a sweep, and what's next to it
+MANIFEST = 'sweep.json'
+TEMPLATE = 'template'
+PARAMS = 'params.jsonl'
+
+class Points():
+    """
+        The points of a sweep, read off the manifest in its batch folder.
+
+        A sweep is one script (the template) and one of:
+            grid  :   {name: [values]}, every combination of them (in order,
+                      the last name changing fastest)
+            list  :   [{name: value}, ...]
+            jsonl :   a file with one {name: value} per line, read a line at
+                      a time as points get launched
+
+        Nothing gets made up front: iterating goes through the points one by
+        one, so a 100k point sweep is a manifest and a template on disk and
+        only whatever's queued or running in memory.
+
+        Point i runs the template as <name>_<i>.sh, with its parameters in
+        the environment (via = 'env') or as --name value arguments (via =
+        'args'). Either way it gets MAESTRO_POINT and MAESTRO_PARAMS (JSON).
+    """
+    def __init__(self, folder):
+        with open(os.path.join(folder, MANIFEST)) as f:
+            manifest = json.load(f)
+        self.folder = folder
+        self.name = manifest['name']
+        self.via = manifest.get('via', 'env')
+        self.size = manifest['size']
+        self.template = os.path.join(folder, manifest.get('template', TEMPLATE))
+        self.grid = manifest.get('grid')
+        self.list = manifest.get('list')
+        self.jsonl = manifest.get('jsonl')
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        """ the parameters of every point, in order """
+        if self.grid is not None:
+            names = list(self.grid)
+            for values in itertools.product(*self.grid.values()):
+                yield dict(zip(names, values))
+        elif self.list is not None:
+            yield from self.list
+        else:
+            with open(os.path.join(self.folder, self.jsonl)) as f:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+
+    def job_name(self, i):
+        return '%s_%d.sh' % (self.name, i)
+
+    def env(self, i, params):
+        """ what point [i] gets in its environment """
+        env = {'MAESTRO_POINT': str(i), 'MAESTRO_PARAMS': json.dumps(params)}
+        if self.via == 'env':
+            env.update({str(k): value(v) for k, v in params.items()})
+        return env
+
+    def args(self, params):
+        """ what a point with [params] gets on its command line """
+        if self.via != 'args':
+            return []
+        return [a for k, v in params.items() for a in ('--' + str(k), value(v))]
+
+def value(v):
+    """ a parameter as a string: strings as they are, the rest as JSON """
+    return v if isinstance(v, str) else json.dumps(v)
+
+def count_points(path):
+    """
+        How many points are in the JSONL file at [path], checking every line
+        is a JSON object on the way (one line in memory at a time).
+    """
+    count = 0
+    with open(path) as f:
+        for n, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            if not isinstance(json.loads(line), dict):
+                raise ValueError('line %d of %s isn\'t a JSON object'
+                                 % (n, path))
+            count += 1
+    return count
+
+def write(folder, name, params, size, via = 'env'):
+    """
+        Write the manifest of a sweep of [size] points into [folder].
+        [params] is the grid (a dict), the list of points, or None if the
+        points are in [folder]/params.jsonl.
+    """
+    manifest = {'name': name, 'via': via, 'size': size, 'template': TEMPLATE}
+    if isinstance(params, dict):
+        manifest['grid'] = params
+    elif params is not None:
+        manifest['list'] = list(params)
+    else:
+        manifest['jsonl'] = PARAMS
+    with open(os.path.join(folder, MANIFEST), 'w') as f:
+        json.dump(manifest, f)
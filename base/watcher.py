@@ -0,0 +1,277 @@
+import ctypes
+import ctypes.util
+import os
+import stat
+import struct
+
+from base import sweep
+
+__all__ = [
+    'PollWatcher',
+    'InotifyWatcher',
+    'make_watcher',
+]
+
+class PollWatcher():
+    """
+        Keeps track of the shell scripts sitting in the batch folders of the
+        queue directory by walking it with scandir every time we're asked to.
+
+        This is what the dispatcher always did, it's kept around as the
+        fallback for systems (or filesystems, NFS I'm looking at you) where
+        inotify isn't available.
+    """
+    def __init__(self, queue):
+        self.queue = queue
+
+    def fileno(self):
+        """ There's nothing to select on for polling. """
+        return None
+
+    def files(self):
+        """
+            Get the list of files in the queue directory that are shell files
+        """
+        l = []
+        with os.scandir(self.queue) as it:
+            for f in it:
+                if f.is_dir() and f.name.startswith('batch-'):
+                    with os.scandir(f.path) as batch:
+                        for s in batch:
+                            if s.name.endswith('.sh'):
+                                l.append(s.path)
+        return l
+
+    def sweeps(self):
+        """ the batch folders that are sweeps (have a manifest, see sweep.py) """
+        l = []
+        with os.scandir(self.queue) as it:
+            for f in it:
+                if f.is_dir() and f.name.startswith('batch-') and \
+                        os.path.exists(os.path.join(f.path, sweep.MANIFEST)):
+                    l.append(f.path)
+        return l
+
+    def read(self):
+        """ Nothing to drain for polling. """
+        return False
+
+    def close(self):
+        pass
+
+# from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+QUEUE_MASK = IN_CREATE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE | IN_ONLYDIR
+BATCH_MASK = (IN_CREATE | IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM |
+              IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+_event = struct.Struct('iIII')
+
+def complete(path):
+    """
+        Whether a file that just got created ([path], IN_CREATE) is all there
+        already: a hard link to a file that was written before, or a symlink.
+        Anything else is still being written, and shows up again once it's
+        closed.
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISLNK(st.st_mode) or st.st_nlink > 1
+
+class InotifyWatcher():
+    """
+        Watches the queue directory with inotify (through ctypes, so there's
+        nothing extra to install) and keeps an in-memory index of the queued
+        shell scripts that gets updated one event at a time instead of walking
+        every batch folder again.
+
+        The queue directory itself is watched for batch folders coming and
+        going, and each batch folder is watched for scripts being written,
+        moved in, moved out or deleted. A script only shows up in the index
+        once it has been closed after writing (or moved in), so we never hand
+        out a half copied file.
+
+        If the kernel event queue overflows we throw the index away and rescan.
+    """
+    def __init__(self, queue):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+
+        self.queue = queue
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        self.index = {}     # batch folder -> set of script paths
+        self.manifests = set() # batch folders that are sweeps
+        self.wds = {}       # watch descriptor -> batch folder (or queue)
+        self.rescan()
+
+    def fileno(self):
+        return self.fd
+
+    def watch(self, path, mask):
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        self.wds[wd] = path
+        return wd
+
+    def add_batch(self, folder):
+        """
+            Start watching a batch folder and pick up whatever is already in
+            it. The watch goes in first so nothing slips between the two.
+        """
+        try:
+            self.watch(folder, BATCH_MASK)
+            scripts = set()
+            manifest = False
+            with os.scandir(folder) as it:
+                for s in it:
+                    if s.name.endswith('.sh'):
+                        scripts.add(s.path)
+                    manifest = manifest or s.name == sweep.MANIFEST
+        except (FileNotFoundError, NotADirectoryError):
+            return
+        self.index[folder] = scripts
+        if manifest:
+            self.manifests.add(folder)
+
+    def rescan(self):
+        self.index = {}
+        self.manifests = set()
+        self.watch(self.queue, QUEUE_MASK)
+        with os.scandir(self.queue) as it:
+            for f in it:
+                if f.is_dir() and f.name.startswith('batch-'):
+                    self.add_batch(f.path)
+
+    def files(self):
+        """
+            Get the list of files in the queue directory that are shell files
+        """
+        return [s for scripts in self.index.values() for s in scripts]
+
+    def sweeps(self):
+        """ the batch folders that are sweeps (have a manifest, see sweep.py) """
+        return list(self.manifests)
+
+    def drop(self, folder):
+        self.index.pop(folder, None)
+        self.manifests.discard(folder)
+
+    def read(self):
+        """
+            Drain pending events and update the index. Returns True if the set
+            of queued scripts (may have) changed.
+        """
+        changed = False
+        while True:
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return changed
+
+            offset = 0
+            while offset < len(buf):
+                wd, mask, _, length = _event.unpack_from(buf, offset)
+                offset += _event.size
+                name = buf[offset:offset + length].rstrip(b'\0')
+                offset += length
+                changed = self.handle(wd, mask, os.fsdecode(name)) or changed
+
+    def handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            self.rescan()
+            return True
+
+        folder = self.wds.get(wd)
+        if folder is None:
+            return False
+
+        if mask & IN_IGNORED:
+            del self.wds[wd]
+            if folder != self.queue:
+                self.drop(folder)
+            return True
+
+        path = os.path.join(folder, name)
+        if folder == self.queue:
+            if not name.startswith('batch-'):
+                return False
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_batch(path)
+            else:
+                self.drop(path)
+            return True
+
+        # a batch folder going away (or being renamed) shows up in the queue
+        # folder's events already. The watch follows the folder around, and
+        # a rename inside the queue hands it to the new name (see add_batch),
+        # so it's too late to drop anything here.
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            return False
+
+        if mask & IN_ISDIR:
+            return False
+
+        scripts = self.index.get(folder)
+        if scripts is None:
+            # moved out of the queue, the watch just hasn't been dropped
+            return False
+
+        if name != sweep.MANIFEST and not name.endswith('.sh'):
+            return False
+        if mask & IN_CREATE and not complete(path):
+            # wait for it to be closed
+            return False
+        added = mask & (IN_CREATE | IN_CLOSE_WRITE | IN_MOVED_TO)
+
+        if name == sweep.MANIFEST:
+            if added:
+                self.manifests.add(folder)
+            else:
+                self.manifests.discard(folder)
+        elif added:
+            scripts.add(path)
+        else:
+            scripts.discard(path)
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+def make_watcher(queue, mode = 'auto'):
+    """
+        Pick a watcher for the queue directory.
+
+        mode: 'inotify' | 'poll' | 'auto' (inotify if we can, poll otherwise)
+    """
+    if mode == 'poll':
+        return PollWatcher(queue)
+    try:
+        return InotifyWatcher(queue)
+    except (OSError, AttributeError, TypeError):
+        # no libc (or no inotify in it), ran out of watches, etc.
+        if mode == 'inotify':
+            raise
+        return PollWatcher(queue)
@@ -0,0 +1,285 @@
+# benchmark for the dispatcher, no GPUs needed
+
+#### what it does ####
+#
+# Fills a temporary queue with [--batches] batch-* folders of [--jobs]
+# trivial .sh scripts each (they just sleep), runs a Dispatcher on them
+# against fake GPUs and measures:
+#   - queue-to-launch latency (batch folder shows up -> job started)
+#   - launches per second
+#   - completion-to-reap latency (script done -> dispatcher noticed)
+#   - time spent in get_files, gpu, the GPU probe and the state marks
+#   - peak RSS of the dispatcher process
+# and writes it all out as JSON, so changes to the scheduling loop can be
+# compared run against run.
+#
+# e.g. python bench.py --batches 20 --jobs 50 --gpus 8 --out before.json
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from base import dispatcher, gpu, store
+
+#### instrumented dispatcher ####
+
+def instrument(engine):
+    """
+        A subclass of the dispatcher [engine] that times the interesting
+        bits, remembers when every job was launched and reaped, and sends it
+        all to [results] once [total] jobs have been reaped.
+    """
+    class Bench(engine):
+        def __init__(self, *args, total, results, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.total = total
+            self.results = results
+            self.launched = {}
+            self.reaped = {}
+            self.timings = {}
+            self.timings_lock = threading.Lock()
+
+        def timed(self, name, f):
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return f(*args, **kwargs)
+                finally:
+                    took = time.perf_counter() - start
+                    # the async engine marks from threads
+                    with self.timings_lock:
+                        t = self.timings.setdefault(name, [0, 0.0, 0.0])
+                        t[0] += 1
+                        t[1] += took
+                        t[2] = max(t[2], took)
+            return wrapper
+
+        def dispatch(self, store):
+            # the probe and the marks are what actually takes time, whatever
+            # engine calls them (and from wherever)
+            self.gpus.devices = self.timed('devices', self.gpus.devices)
+            self.store.mark = self.timed('mark', self.store.mark)
+            self.get_files = self.timed('get_files', self.get_files)
+            self.gpu = self.timed('gpu', self.gpu)
+            super().dispatch(store)
+
+        def spawn(self, current_job, *args):
+            ok = super().spawn(current_job, *args)
+            if ok:
+                self.launched[current_job] = time.time()
+            return ok
+
+        def settle(self, job_name, running, outcome):
+            # where both engines end up once a job's exit is sorted out
+            super().settle(job_name, running, outcome)
+            self.reaped[job_name] = time.time()
+            if len(self.reaped) == self.total:
+                self.report()
+
+        def report(self):
+            rusage = resource.getrusage(resource.RUSAGE_SELF)
+            with self.timings_lock:
+                timings = {name: {'calls': n, 'total_s': total,
+                                  'mean_ms': 1000 * total / n,
+                                  'max_ms': 1000 * worst}
+                           for name, (n, total, worst) in self.timings.items()}
+            self.results.put({
+                'launched': self.launched,
+                'reaped': self.reaped,
+                'timings': timings,
+                # KiB on Linux
+                'peak_rss_kib': rusage.ru_maxrss,
+            })
+
+    return Bench
+
+#### the synthetic workload ####
+
+def make_batches(state, root, batches, jobs, sleep, seed):
+    """
+        Make [batches] batch folders of [jobs] scripts in [root]/staging and
+        register them with the state service. Returns a list of (batch id,
+        staged folder, number of jobs).
+
+        Every script writes the time it finished (with ns) to [root]/done,
+        that's what the reap latency is measured from.
+    """
+    rng = random.Random(seed)
+    lo, hi = sleep
+    made = []
+    for b in range(batches):
+        # the run directory is flat, so names have to be unique across
+        # batches, not just inside one
+        names = ['b%d_job_%d.sh' % (b, j) for j in range(jobs)]
+        bid = state.add_batch('bench-%d' % b, names)
+        folder = os.path.join(root, 'staging', 'batch-%d' % bid)
+        os.makedirs(folder)
+        for name in names:
+            done = os.path.join(root, 'done', '%d-%s' % (bid, name))
+            path = os.path.join(folder, name)
+            with open(path, 'w') as f:
+                f.write('#!/bin/sh\n')
+                f.write('sleep %.3f\n' % rng.uniform(lo, hi))
+                f.write('date +%%s.%%N > %s\n' % done)
+            os.chmod(path, 0o755)
+        made.append((bid, folder, jobs))
+    return made
+
+#### numbers ####
+
+def percentiles(values):
+    """ p50/p90/p99/max of [values] (seconds) in ms, nearest rank """
+    if not values:
+        return None
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+    return {
+        'count': len(values),
+        'p50_ms': 1000 * pick(0.50),
+        'p90_ms': 1000 * pick(0.90),
+        'p99_ms': 1000 * pick(0.99),
+        'max_ms': 1000 * values[-1],
+        'mean_ms': 1000 * sum(values) / len(values),
+    }
+
+def summarize(report, arrivals, root):
+    launch = []
+    for job, t in report['launched'].items():
+        bid, _ = dispatcher.job_key(job)
+        launch.append(t - arrivals[bid])
+
+    reap = []
+    for job, t in report['reaped'].items():
+        bid, name = dispatcher.job_key(job)
+        try:
+            with open(os.path.join(root, 'done', '%d-%s' % (bid, name))) as f:
+                reap.append(t - float(f.read()))
+        except (FileNotFoundError, ValueError):
+            # didn't get to the end (failed, or no date with %N)
+            pass
+
+    first = min(arrivals.values())
+    last = max(report['launched'].values())
+    return {
+        'queue_to_launch': percentiles(launch),
+        'completion_to_reap': percentiles(reap),
+        'launches_per_s': len(launch) / max(last - first, 1e-9),
+        'makespan_s': max(report['reaped'].values()) - first,
+        'timings': report['timings'],
+        'peak_rss_kib': report['peak_rss_kib'],
+    }
+
+#### the run ####
+
+def run(args):
+    root = tempfile.mkdtemp(prefix = 'maestro-bench-')
+    for d in ['queue', 'run', 'staging', 'done']:
+        os.makedirs(os.path.join(root, d))
+
+    manager, state = store.serve(os.path.join(root, 'state.pkl'))
+    try:
+        made = make_batches(state, root, args.batches, args.jobs, args.sleep,
+                            args.seed)
+        total = sum(n for _, _, n in made)
+
+        engine = {'sync': dispatcher.Dispatcher,
+                  'async': dispatcher.AsyncDispatcher}[args.engine]
+        results = mp.Queue()
+        d = instrument(engine)(
+                run = os.path.join(root, 'run'),
+                queue = os.path.join(root, 'queue'),
+                wait = args.wait,
+                spread = args.spread,
+                block = [],
+                store = state,
+                watch = args.watch,
+                gpus = gpu.FakeProvider(count = args.gpus),
+                schedule = args.schedule,
+                total = total,
+                results = results)
+        d.start()
+        # let it get to sleep on an empty queue first
+        time.sleep(args.settle)
+
+        # batches show up in one go, like maestro's loader does it
+        arrivals = {}
+        for bid, folder, _ in made:
+            arrivals[bid] = time.time()
+            os.rename(folder, os.path.join(root, 'queue',
+                                           os.path.basename(folder)))
+            if args.interval:
+                time.sleep(args.interval)
+
+        try:
+            report = results.get(timeout = args.timeout)
+        except Exception:
+            print('Timed out waiting for the jobs to finish, see %s'
+                  % os.path.join(root, 'logfile.jsonl'), file = sys.stderr)
+            d.p.kill()
+            return 1
+        d.p.kill()
+        d.p.join()
+
+        out = {
+            'config': vars(args),
+            'jobs': total,
+            'results': summarize(report, arrivals, root),
+        }
+    finally:
+        manager.shutdown()
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors = True)
+
+    text = json.dumps(out, indent = 4)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return 0
+
+def sleep_range(s):
+    """ '0.1' or '0.05:0.5' (uniform) """
+    lo, _, hi = s.partition(':')
+    return float(lo), float(hi or lo)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                description = 'Throughput and latency benchmark for the '
+                'maestro dispatcher, on fake GPUs.')
+    parser.add_argument('--batches', type=int, default=10)
+    parser.add_argument('--jobs', type=int, default=20,
+                        help='Scripts per batch. Default: 20.')
+    parser.add_argument('--sleep', type=sleep_range, default=(0.05, 0.2),
+                        metavar='LO[:HI]', help='How long each script sleeps, '
+                        'in seconds, uniform in [LO, HI]. Default: 0.05:0.2.')
+    parser.add_argument('--interval', type=float, default=0,
+                        help='Seconds between batches showing up. Default: 0.')
+    parser.add_argument('--gpus', type=int, default=8,
+                        help='Fake GPUs. Default: 8.')
+    parser.add_argument('--spread', type=int, default=1)
+    parser.add_argument('--wait', type=int, default=30,
+                        help='The dispatcher\'s wait. Default: 30.')
+    parser.add_argument('--engine', choices=['sync', 'async'], default='sync')
+    parser.add_argument('--schedule', choices=['exclusive', 'pack'],
+                        default='exclusive')
+    parser.add_argument('--watch', choices=['auto', 'inotify', 'poll'],
+                        default='auto')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--settle', type=float, default=0.5,
+                        help='Seconds to give the dispatcher to start up.')
+    parser.add_argument('--timeout', type=float, default=600,
+                        help='Give up after this many seconds.')
+    parser.add_argument('--out', metavar='FILE',
+                        help='Write the JSON here instead of stdout.')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the temporary directory around.')
+    sys.exit(run(parser.parse_args()))
@@ -0,0 +1,178 @@
+# benchmark for how long maestro.py takes to start, no GPUs needed
+
+#### what it does ####
+#
+# Makes a temporary maestro directory with a big history in it ([--batches]
+# batches of [--jobs] finished scripts each), then times quick commands
+# (maestro.py --help, status, status --batch, dispatcher status, load) from
+# starting python to exiting, [--runs] times each:
+#   - cold: nothing else running, so the command serves the state itself
+#     (and has to load the history to do it), except for `status` which
+#     reads the summary the last one left behind (see api.Maestro.peek)
+#     and `load` which adds to the journal (see api.Maestro.add_cold)
+#   - served: with `maestro.py server` running, like when the menus or a
+#     dispatcher are up, so the command just talks to it
+# plus a bare `python -c pass` to see how much of it is python itself, and
+# optionally the slowest imports of `maestro.py status` (-X importtime).
+#
+# e.g. python bench_startup.py --batches 200 --jobs 500 --budget 100
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from base import store
+
+MAESTRO = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'maestro.py')
+
+COMMANDS = [
+    ['--help'],
+    ['status'],
+    ['status', '--batch', '0'],
+    ['dispatcher', 'status'],
+    ['load', 'job.sh'],
+]
+
+#### the history ####
+
+def make_history(root, batches, jobs):
+    """ [batches] batches of [jobs] completed scripts, straight in the store """
+    s = store.StateStore(os.path.join(root, 'maestro_sys', 'manager_state.pkl'))
+    pid = 1000
+    for b in range(batches):
+        names = ['/somewhere/b%d/job_%d.sh' % (b, j) for j in range(jobs)]
+        bid = s.add_batch('bench-%d' % b, names, {'priority': b % 3})
+        for j in range(jobs):
+            pid += 1
+            s.mark(bid, 'job_%d.sh' % j, pid, 'running')
+            s.mark(bid, 'job_%d.sh' % j, pid, 'completed')
+    s.close()
+    return os.path.getsize(s.path)
+
+#### timing ####
+
+def maestro(root, *args, **kwargs):
+    return subprocess.run([sys.executable, MAESTRO] + list(args), cwd = root,
+                          stdout = subprocess.DEVNULL, **kwargs)
+
+def time_command(root, command, runs):
+    took = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        p = subprocess.run(command, cwd = root, stdout = subprocess.DEVNULL,
+                           stderr = subprocess.PIPE)
+        took.append((time.perf_counter() - start) * 1000)
+        if p.returncode not in (0, 1):
+            raise RuntimeError('%s failed: %s' % (' '.join(command),
+                                                  p.stderr.decode()))
+    return {'min_ms': round(min(took), 1),
+            'median_ms': round(statistics.median(took), 1)}
+
+def time_commands(root, runs):
+    return {' '.join(c): time_command(root, [sys.executable, MAESTRO] + c, runs)
+            for c in COMMANDS}
+
+def import_times(root, top):
+    """ the [top] slowest imports of `maestro.py status`, in ms (cumulative) """
+    p = subprocess.run([sys.executable, '-X', 'importtime', MAESTRO, 'status'],
+                       cwd = root, stdout = subprocess.DEVNULL,
+                       stderr = subprocess.PIPE, text = True)
+    found = []
+    for line in p.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if cumulative.strip().isdigit():
+            found.append((int(cumulative) / 1000, name.strip()))
+    found.sort(reverse = True)
+    return [{'module': name, 'ms': round(ms, 1)} for ms, name in found[:top]]
+
+def serve(root):
+    """ `maestro.py server` in the background, once its socket is up """
+    server = subprocess.Popen([sys.executable, MAESTRO, 'server'], cwd = root,
+                              stdout = subprocess.DEVNULL)
+    sock = os.path.join(root, 'maestro_sys', 'state.sock')
+    deadline = time.monotonic() + 60
+    while not os.path.exists(sock):
+        if server.poll() is not None or time.monotonic() > deadline:
+            server.kill()
+            raise RuntimeError('maestro.py server didn\'t start')
+        time.sleep(0.05)
+    return server
+
+def run(args):
+    root = tempfile.mkdtemp(prefix = 'maestro-startup-')
+    server = None
+    try:
+        maestro(root, 'init', '--queue-dir', root, '--run-dir',
+                os.path.join(root, 'run'), check = True)
+        with open(os.path.join(root, 'job.sh'), 'w') as f:
+            f.write('#!/bin/sh\ntrue\n')
+        start = time.perf_counter()
+        size = make_history(root, args.batches, args.jobs)
+        made = time.perf_counter() - start
+
+        out = {
+            'config': vars(args),
+            'history': {'processes': args.batches * args.jobs,
+                        'bytes': size, 'made_in_s': round(made, 2)},
+            'python': time_command(root, [sys.executable, '-c', 'pass'],
+                                   args.runs),
+            'cold': time_commands(root, args.runs),
+        }
+        server = serve(root)
+        out['served'] = time_commands(root, args.runs)
+        if args.imports:
+            out['imports'] = import_times(root, args.imports)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors = True)
+
+    text = json.dumps(out, indent = 4)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    # cold commands count too, that's what a cron job or a sweep script
+    # usually gets
+    if args.budget is not None:
+        over = [(how, c, t['median_ms']) for how in ['cold', 'served']
+                for c, t in out[how].items() if t['median_ms'] > args.budget]
+        for how, c, ms in over:
+            print('%s (%s): %.1f ms, over the %.1f ms budget'
+                  % (c, how, ms, args.budget), file = sys.stderr)
+        return 1 if over else 0
+    return 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                description = 'Startup time benchmark for maestro.py commands, '
+                'against a big history.')
+    parser.add_argument('--batches', type=int, default=100)
+    parser.add_argument('--jobs', type=int, default=500,
+                        help='Scripts per batch. Default: 500.')
+    parser.add_argument('--runs', type=int, default=10,
+                        help='Times each command is run. Default: 10.')
+    parser.add_argument('--imports', type=int, default=15, metavar='N',
+                        help='Report the N slowest imports of `maestro.py '
+                        'status` (0 for none). Default: 15.')
+    parser.add_argument('--budget', type=float, metavar='MS',
+                        help='Exit with 1 if a command takes longer than '
+                        'this (median), cold or served.')
+    parser.add_argument('--out', metavar='FILE',
+                        help='Write the JSON here instead of stdout.')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the temporary directory around.')
+    sys.exit(run(parser.parse_args()))
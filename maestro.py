@@ -4,41 +4,31 @@
 
 from __future__ import print_function, unicode_literals
 try:
-    from base import base, fscompleter, dispatcher
+    from base import api
 except ImportError:
     print('It seems that you don\'t have the base files'
                                 ' installed, look into that first...')
 
-#### stuff for the interface ####
-
-import questionary
-import prompt_toolkit
-
 #### general imports ####
 
-from pprint import pprint
 import json
-import subprocess
 import argparse
 import os
-import pickle as pkl
-import glob
-import shutil
-import psutil
-import multiprocessing as mp
-import time
-from queue import Empty
+import signal
+import sys
 
-#### cool welcome message producer ####
-
-from pyfiglet import Figlet
+# the menus (questionary, prompt_toolkit, pyfiglet) take longer to import than
+# most commands take to run, so they're imported once we know there's no
+# command to run (see the interface below, and bench_startup.py)
 
 #### general usage things ####
 
-main_menu = ['view','load','start/stop','clear','kill','exit']
+main_menu = ['view','load','sweep','priority','start/stop','clear','kill','exit']
 
 commands = [    'Overview of the job history',
                 'Load files into the dispatcher',
+                'Load a parameter sweep',
+                'Change the priority of a batch',
                 'Start/Stop the dispatcher',
                 'Kill batch or specific process',
                 'Clear current screen',
@@ -60,8 +50,444 @@ parser.add_argument('--no-welcome', action='store_true',
 parser.add_argument('--delay', type=int, default=60, metavar='DELAY',
                     help='Delay (time) in checking the state object. Default: 60 seconds.')
 
+parser.add_argument('--watch', choices=['auto', 'inotify', 'poll'],
+                    default='auto',
+                    help='How the dispatcher watches the queue directory. '
+                    'Default: auto (inotify if available, polling otherwise).')
+
+parser.add_argument('--gpu-backend', choices=['smi', 'nvml', 'fake'],
+                    default='smi',
+                    help='Where the dispatcher gets GPU inventory from. '
+                    'Default: smi (nvidia-smi pmon).')
+
+parser.add_argument('--gpu-ttl', type=float, default=0, metavar='TTL',
+                    help='Seconds to reuse an nvidia-smi answer for. Default: 0.')
+
+parser.add_argument('--fake-gpus', type=int, default=4, metavar='N',
+                    help='Number of devices for the fake GPU backend. Default: 4.')
+
+parser.add_argument('--schedule', choices=['exclusive', 'pack'],
+                    default='exclusive',
+                    help='exclusive: a job gets idle GPUs to itself. pack: '
+                    'jobs share GPUs by memory, using the "mem", "per_gpu" and '
+                    '"max_util" batch options (jobs without "mem" still get '
+                    'an idle GPU). Default: exclusive.')
+
+parser.add_argument('--engine', choices=['sync', 'async'], default='sync',
+                    help='Dispatcher engine, the original blocking loop or the '
+                    'asyncio one. Default: sync.')
+
+parser.add_argument('--share', choices=['batch', 'label'], default='batch',
+                    help='What gets a fair share of the GPUs when several '
+                    'batches are queued: each batch, or each label. Batches '
+                    'can be given a "priority" and a "weight" in their '
+                    'options. Default: batch.')
+
+parser.add_argument('--metrics', metavar='ADDRESS',
+                    help='Serve dispatcher metrics (Prometheus text at '
+                    '/metrics, JSON at /metrics.json) at HOST:PORT, PORT or '
+                    'unix:PATH. Off by default.')
+
+parser.add_argument('--metrics-dump', metavar='FILE',
+                    help='Also write the dispatcher metrics to FILE as JSON '
+                    'every --metrics-interval seconds.')
+
+parser.add_argument('--metrics-interval', type=float, default=60,
+                    metavar='SECONDS', help='Default: 60.')
+
+parser.add_argument('--log-level', type=str.upper,
+                    choices=['DEBUG', 'INFO', 'WARNING'], default='INFO',
+                    help='How much the dispatcher logs. Default: INFO.')
+
+parser.add_argument('--log-size', type=float, default=10, metavar='MB',
+                    help='Size the dispatcher log is rotated (and gzipped) at. '
+                    'Default: 10 MB.')
+
+parser.add_argument('--log-backups', type=int, default=5, metavar='N',
+                    help='How many rotated logs to keep. Default: 5.')
+
+parser.add_argument('--log-root', metavar='DIR',
+                    help='Where each job\'s stdout and stderr are kept, in '
+                    'DIR/batch-<id>/<script>/. Default: logs/ next to the '
+                    'queue directory.')
+
+parser.add_argument('--output-cap', type=float, metavar='MB',
+                    help='Keep at most this much of each job\'s stdout and '
+                    'stderr. Default: no limit.')
+
+parser.add_argument('--output-keep', choices=['head', 'tail'], default='head',
+                    help='With --output-cap, keep the start or the end of '
+                    'the output. Default: head.')
+
+parser.add_argument('--load-mode', choices=['auto', 'reflink', 'hardlink',
+                    'copy'], default='auto',
+                    help='How loaded scripts get into the queue. auto: a '
+                    'reflink (copy-on-write clone) if the filesystem can, '
+                    'else a hardlink, else a copy. With hardlinks, editing a '
+                    'script in place after loading it edits the queued one '
+                    'too. Default: auto.')
+
+parser.add_argument('--load-workers', type=int, default=8, metavar='N',
+                    help='Threads copying scripts when they have to be '
+                    'copied. Default: 8.')
+
+commands_parser = parser.add_subparsers(dest='command', metavar='COMMAND',
+                    help='Run a command instead of the menus.')
+
+log_parser = commands_parser.add_parser('log',
+                    help='Search the dispatcher log.')
+log_parser.add_argument('--batch', type=int, help='Only this batch ID.')
+log_parser.add_argument('--job', help='Only this script.')
+log_parser.add_argument('--status', help='Only records with this status '
+                    '(running, completed, failed, ...).')
+log_parser.add_argument('--level', type=str.upper,
+                    choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                    help='Only this level and up.')
+log_parser.add_argument('--since', metavar='TIME',
+                    help='Only records from TIME on, e.g. 2024-05-01T13:00.')
+log_parser.add_argument('--tail', type=int, metavar='N',
+                    help='Only the last N matching records.')
+log_parser.add_argument('--json', action='store_true',
+                    help='Print the records as JSON lines.')
+log_parser.add_argument('--file', help='Log file to search. Default: the '
+                    'one next to the queue directory in the settings.')
+
+def json_object(s):
+    try:
+        options = json.loads(s)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError('not JSON: %s' % err)
+    if not isinstance(options, dict):
+        raise argparse.ArgumentTypeError('not a JSON object')
+    return options
+
+init_parser = commands_parser.add_parser('init',
+                    help='Set where the queue and run directories are.')
+init_parser.add_argument('--queue-dir', required=True,
+                    help='The queue directory goes in DIR/queue.')
+init_parser.add_argument('--run-dir', required=True)
+
+load_parser = commands_parser.add_parser('load',
+                    help='Load scripts as a batch.')
+load_parser.add_argument('patterns', nargs='+', metavar='PATTERN',
+                    help='Scripts to load (* wildcard allowed, quote it).')
+load_parser.add_argument('--label', default='')
+load_parser.add_argument('--options', type=json_object, metavar='JSON',
+                    help='Batch options, e.g. \'{"priority": 2}\'.')
+
+sweep_parser = commands_parser.add_parser('sweep',
+                    help='Load a parameter sweep as a batch.')
+sweep_parser.add_argument('template', help='The script every point runs.')
+sweep_parser.add_argument('params', help='A grid as JSON ({"lr": [0.1, '
+                    '0.01]}), a JSON list of points, or a .jsonl file of '
+                    'points.')
+sweep_parser.add_argument('--label', default='')
+sweep_parser.add_argument('--options', type=json_object, metavar='JSON')
+sweep_parser.add_argument('--via', choices=['env', 'args'], default='env',
+                    help='How points get their parameters. Default: env.')
+
+status_parser = commands_parser.add_parser('status',
+                    help='Show the batches and their processes.')
+status_parser.add_argument('--batch', type=int, help='Only this batch ID '
+                    '(with its processes).')
+status_parser.add_argument('--processes', action='store_true',
+                    help='Include every batch\'s processes in --json.')
+status_parser.add_argument('--json', action='store_true')
+
+kill_parser = commands_parser.add_parser('kill',
+                    help='Kill a batch or a process.')
+kill_what = kill_parser.add_mutually_exclusive_group(required=True)
+kill_what.add_argument('--batch', type=int)
+kill_what.add_argument('--pid', type=int)
+
+delete_parser = commands_parser.add_parser('delete',
+                    help='Delete batches from the history.')
+delete_parser.add_argument('batches', nargs='+', type=int, metavar='ID')
+
+priority_parser = commands_parser.add_parser('priority',
+                    help='Change the priority and/or weight of a batch.')
+priority_parser.add_argument('batch', type=int, metavar='ID')
+priority_parser.add_argument('--priority', type=int)
+priority_parser.add_argument('--weight', type=float)
+
+dispatcher_parser = commands_parser.add_parser('dispatcher',
+                    help='Start, stop, run or control the dispatcher.')
+dispatcher_parser.add_argument('action', choices=['start', 'stop', 'run',
+                    'status', 'pause', 'resume', 'drain'], help='start: in '
+                    'the background. run: in the foreground (for systemd, '
+                    'tmux, ...). stop: once the running jobs are done or '
+                    '--deadline passes. pause/resume: launching jobs. drain: '
+                    'stop launching for good, let the running jobs finish.')
+dispatcher_parser.add_argument('--deadline', type=float, metavar='SECONDS',
+                    help='How long stop waits for the running jobs, the ones '
+                    'still running after that are picked up by the next '
+                    'dispatcher (the ones with capped output usually die '
+                    'with it). Default: as long as they take.')
+dispatcher_parser.add_argument('--spread', type=int, default=1,
+                    help='GPUs per job. Default: 1.')
+dispatcher_parser.add_argument('--wait', type=int, default=60,
+                    help='Seconds between checks for new scripts. Default: 60.')
+dispatcher_parser.add_argument('--block', nargs='*', default=[],
+                    metavar='GPU', help='GPUs to leave alone (NODE/GPU with '
+                    '--listen).')
+dispatcher_parser.add_argument('--listen', metavar='ADDRESS',
+                    help='Coordinate agents (see `agent`) at HOST:PORT, PORT '
+                    'or unix:PATH and run jobs on their GPUs instead of this '
+                    'node\'s. They need maestro_sys/cluster.key.')
+
+agent_parser = commands_parser.add_parser('agent',
+                    help='Run jobs on this node for a dispatcher started with '
+                    '--listen, in the foreground. Uses --gpu-backend.')
+agent_parser.add_argument('coordinator', metavar='ADDRESS',
+                    help='Where the dispatcher listens.')
+agent_parser.add_argument('--run-dir', required=True,
+                    help='Where scripts are put while they run.')
+agent_parser.add_argument('--log-root', metavar='DIR', dest='agent_log_root',
+                    help='Where the jobs\' output goes. Default: RUN_DIR/logs.')
+agent_parser.add_argument('--name', help='Default: the host name.')
+agent_parser.add_argument('--key-file', default=os.path.join('maestro_sys',
+                    'cluster.key'), help='A copy of the dispatcher\'s '
+                    'maestro_sys/cluster.key. Default: %(default)s.')
+agent_parser.add_argument('--report', type=float, default=5,
+                    metavar='SECONDS', help='How often the GPU inventory is '
+                    'sent. Default: 5.')
+
+commands_parser.add_parser('server', help='Serve the state in the '
+                    'foreground, so commands and the menus share it.')
+
 args = parser.parse_args()
 
+def dispatcher_config(wait, spread, block, listen = None):
+    """ what api.make_dispatcher takes, from the settings and the flags """
+    if listen is not None:
+        api.authkey(name = 'cluster.key')
+        return dict(dispatcher_config(wait, spread, block), listen = listen,
+                    key_file = os.path.abspath(os.path.join(api.SYS_DIR,
+                                                            'cluster.key')))
+    return dict(
+        run = settings['run_dir'],
+        queue = settings['queue_dir'],
+        wait = wait,
+        spread = spread,
+        block = block,
+        engine = args.engine,
+        gpu_backend = args.gpu_backend,
+        gpu_ttl = args.gpu_ttl,
+        fake_gpus = args.fake_gpus,
+        watch = args.watch,
+        schedule = args.schedule,
+        share = args.share,
+        serve_metrics = args.metrics,
+        dump_metrics = args.metrics_dump,
+        dump_interval = args.metrics_interval,
+        log_level = args.log_level,
+        log_size = int(args.log_size * 2**20),
+        log_backups = args.log_backups,
+        log_root = args.log_root and os.path.expanduser(args.log_root),
+        output_cap = args.output_cap and int(args.output_cap * 2**20),
+        output_keep = args.output_keep)
+
+#### commands ####
+
+if args.command == 'log':
+    from base import logs
+
+    path = args.file
+    if path is None:
+        try:
+            queue_dir = api.load_settings()['queue_dir']
+        except KeyError:
+            raise SystemExit('No settings yet, so no idea where the log is. '
+                             'Try --file.')
+        path = os.path.join(os.path.dirname(queue_dir), 'logfile.jsonl')
+
+    found = logs.query(path, batch = args.batch, job = args.job,
+                       status = args.status, level = args.level,
+                       since = args.since, tail = args.tail)
+    try:
+        for r in found:
+            if args.json:
+                print(json.dumps(r))
+            else:
+                print('%s %s: %s' % (r.get('time'), r.get('level'),
+                                     r.get('msg')))
+    except BrokenPipeError:
+        # | head
+        pass
+    raise SystemExit
+
+def run_command(m):
+    """ everything but the menus and `log`, returns the exit status """
+    if args.command == 'init':
+        m.setup(args.queue_dir, args.run_dir)
+        print('Queue directory: %s' % m.settings['queue_dir'])
+        print('Run directory: %s' % m.settings['run_dir'])
+
+    elif args.command == 'load':
+        id, count, skipped, method = m.load(args.patterns, args.label,
+                    args.options, mode = args.load_mode,
+                    workers = args.load_workers)
+        for path in skipped:
+            print('Skipped %s, there\'s already a script with that name in '
+                  'the batch.' % path, file = sys.stderr)
+        if id is None:
+            print('No files matched, nothing loaded.', file = sys.stderr)
+            return 1
+        print(id)
+
+    elif args.command == 'sweep':
+        params = args.params
+        if not os.path.isfile(os.path.expanduser(params)):
+            params = json.loads(params)
+        id, count, method = m.load_sweep(args.template, params, args.label,
+                    args.options, via = args.via, mode = args.load_mode)
+        if id is None:
+            print('That sweep has no points, nothing loaded.', file = sys.stderr)
+            return 1
+        print(id)
+
+    elif args.command == 'status':
+        batches = m.status(args.batch, args.processes)
+        if args.json:
+            print(json.dumps(batches))
+            return 0
+        for b in batches:
+            counts = ', '.join('%s %d' % kv for kv in sorted(b['counts'].items()))
+            sweep = ' (sweep of %d)' % b['sweep']['size'] if 'sweep' in b else ''
+            print('%-6d %-24s %s%s' % (b['id'], b['label'], counts or 'empty',
+                                       sweep))
+
+    elif args.command == 'kill':
+        if args.batch is not None:
+            m.kill(args.batch)
+        elif not m.kill_pid(args.pid):
+            print('No process of ours has pid %d.' % args.pid, file = sys.stderr)
+            return 1
+        else:
+            print('Killed process %d' % args.pid)
+
+    elif args.command == 'delete':
+        for bid in args.batches:
+            m.delete(bid)
+
+    elif args.command == 'priority':
+        changes = {k: v for k, v in [('priority', args.priority),
+                                     ('weight', args.weight)] if v is not None}
+        print(json.dumps(m.set_options(args.batch, **changes)))
+
+    elif args.command == 'dispatcher':
+        if args.action == 'status':
+            pid = m.dispatcher_pid()
+            reply = m.control('status') if pid else None
+            if reply is not None:
+                print('%s (%d), %d running, %d queued' % (reply['state'],
+                      pid, reply['running'], reply['queued']))
+            else:
+                print('running (%d)' % pid if pid else 'stopped')
+            return 0 if pid else 1
+        if args.action == 'stop':
+            if not m.stop_dispatcher(args.deadline):
+                print('No dispatcher running.', file = sys.stderr)
+                return 1
+            return 0
+        if args.action in ['pause', 'resume', 'drain']:
+            reply = m.control(args.action)
+            if reply is None:
+                print('No dispatcher listening.', file = sys.stderr)
+                return 1
+            if not reply['ok']:
+                print(reply['error'], file = sys.stderr)
+                return 1
+            print('%s, %d running, %d queued' % (reply['state'],
+                  reply['running'], reply['queued']))
+            return 0
+
+        m.require('queue_dir', 'run_dir')
+        config = dispatcher_config(args.wait, args.spread, args.block,
+                                   args.listen)
+        if args.action == 'start':
+            pid = m.start_dispatcher(config)
+            if pid is None:
+                print('There\'s already a dispatcher running.', file = sys.stderr)
+                return 1
+            print(pid)
+        else:
+            if m.dispatcher_pid() is not None:
+                print('There\'s already a dispatcher running.', file = sys.stderr)
+                return 1
+            m.settings['dispatcher'] = os.getpid()
+            api.save_settings(m.settings)
+            api.run_dispatcher(m, config)
+
+    elif args.command == 'agent':
+        import logging
+
+        logging.basicConfig(level = args.log_level,
+                            format = '%(asctime)s %(levelname)s %(message)s')
+        agent = api.make_agent(dict(
+            coordinator = args.coordinator,
+            key_file = args.key_file,
+            run = os.path.expanduser(args.run_dir),
+            log_root = args.agent_log_root and
+                       os.path.expanduser(args.agent_log_root),
+            name = args.name,
+            report = args.report,
+            gpu_backend = args.gpu_backend,
+            gpu_ttl = args.gpu_ttl,
+            fake_gpus = args.fake_gpus))
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+        try:
+            agent.serve()
+        except KeyboardInterrupt:
+            pass
+
+    elif args.command == 'server':
+        m.state # whoever's serving it already, or us from now on
+        if not m.hosting:
+            print('The state is already being served.', file = sys.stderr)
+            return 1
+        print('Serving the state, ctrl-c to stop.')
+        try:
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+            signal.pause()
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+if args.command is not None:
+    settings = api.load_settings()
+    try:
+        with api.Maestro() as m:
+            settings = m.settings
+            status = run_command(m)
+    except BrokenPipeError:
+        # | head
+        status = 0
+    except (KeyError, RuntimeError, ValueError, OSError) as err:
+        raise SystemExit('maestro: %s' % (err.args[0] if isinstance(err,
+                                                    KeyError) else err))
+    raise SystemExit(status)
+
+#### stuff for the interface ####
+
+import questionary
+import prompt_toolkit
+import shutil
+
+from base import base, fscompleter, loader
+
+#### cool welcome message producer ####
+
+from pyfiglet import Figlet
+
+# the state lives in its own process, everyone else talks to it through
+# [state]. If maestro's already running here (`maestro.py server`, a
+# dispatcher, other menus) we share theirs, otherwise it's ours and saved
+# every second until we exit (see api.py). A big history takes a while to
+# load, so that starts now and happens while we say hello.
+m = api.Maestro()
+m.warm()
+
 #### welcome message ####
 if not args.no_welcome:
     figlet = Figlet()
@@ -73,12 +499,8 @@ if not args.no_welcome:
 print('Welcome to maestro: the experiment manager.')
 print('Loading settings (if available)...')
 
-try:
-    f = open('maestro_sys/settings.pkl', 'rb')
-    settings = pkl.load(f)
-except FileNotFoundError:
-    settings = {}
-
+settings = m.settings
+if not settings:
     print('Couldn\'t find any settings file so we\'re going to ask a couple questions...')
     print('For the following questions, you can use "~" to expand your home directory...\n')
 
@@ -93,52 +515,15 @@ except FileNotFoundError:
     settings['queue_dir'] = os.path.join(queue_dir, 'queue')
     settings['run_dir'] = run_dir
 
-    try:
-        os.mkdir('maestro_sys')
-    except FileExistsError:
-        pass
-
     # add additional settings if need be
-    with open('maestro_sys/settings.pkl', 'wb') as settings_file:
-        pkl.dump(settings, settings_file)
+    api.save_settings(settings)
 
 # check if there's a state file that exists, otherwise initialize to nothing
 print('Setting up maestro state...')
-try:
-    f = open('maestro_sys/manager_state.pkl', 'rb')
-    state = pkl.load(f)
-except FileNotFoundError:
-    try:
-        os.mkdir('maestro_sys')
-    except FileExistsError:
-        state = base.State()
-
 
-finally:
-    q = mp.Queue()
-    q.put(state)
-
-
-#### define the daemon ####
-def save(q):
-    while True:
-        time.sleep(5)
-        empty = True
-        while empty:
-            try:
-                s = q.get(timeout = 10)
-                q.put(s)
-                empty = False
-                with open('maestro_sys/manager_state.pkl', 'wb') as state_file:
-                    pkl.dump(s, state_file)
-            except Empty:
-                empty = True
-
-
-#### start the daemon ####
-
-saver = mp.Process(target=save, args=(q,))
-saver.start()
+state = m.state
+if not m.hosting:
+    print('Sharing the state with the maestro that\'s already running.')
 
 #### main loop ####
 while True:
@@ -148,38 +533,39 @@ while True:
                                             choices=commands).ask()
 
         if answer == 'Exit the experiment manager':
-            try:
-                pid = settings['dispatcher']
-                alive = psutil.pid_exists(pid)
-                if alive:
-                    print('Kill the dispatcher first using built-in stopper.')
-                else:
-                    raise SystemExit
-            except KeyError:
+            if m.dispatcher_pid() is not None:
+                print('Kill the dispatcher first using built-in stopper.')
+            else:
                 raise SystemExit
 
         elif answer == 'Clear current screen':
             os.system('clear')
 
         elif answer == 'Overview of the job history':
-            state = q.get()
-            if state.batches == {}:
+            snapshot = state.snapshot()
+            if snapshot.batches == {}:
                 print('Job history is empty.')
 
             else:
-                for bid in state.batches.keys():
-                    batch = state.batches[bid]
+                for bid in snapshot.batches.keys():
+                    batch = snapshot.batches[bid]
                     header = ('BATCH ID: %g \t\t LABEL: %s' % (bid, batch.label))
                     print(header)
+                    if isinstance(batch, base.Sweep):
+                        print('SWEEP: %g points of %s, %g launched so far'
+                              % (batch.size, batch.template,
+                                 len(batch.processes)))
                     print(dash)
                     print('PROCESSES:')
-                    print('{:<10s}{:<36s}{:<20s}{:<10s}'.format('pid', 'filename', 'log', 'status'))
+                    print('{:<10s}{:<36s}{:<12s}{}'.format('pid', 'filename', 'status', 'log'))
                     print(dash)
                     for proc in batch.processes:
-                        dic = proc.__dict__
+                        dic = proc.to_dict()
                         dic['filename'] = os.path.basename(dic['filename'])
                         replace = lambda x: '~' if x is None else str(x)
-                        print('{:<10s}{:<36s}{:<20s}{:<10s}'.format(*[replace(x) for x in dic.values()]))
+                        # the log path goes last, it's long
+                        print('{:<10s}{:<36s}{:<12s}{}'.format(*[replace(dic[k])
+                                for k in ['pid', 'filename', 'status', 'log_dir']]))
                     print('')
 
                 # ask if you want to delete records...
@@ -189,10 +575,10 @@ while True:
                     to_delete = input('Enter the batch IDs to delete,'
                                                 ' separated by spaces: ').split(' ')
                     for d in to_delete:
-                        if not d.isdigit() and d not in state.batches.keys():
+                        if not d.isdigit() or int(d) not in snapshot.batches.keys():
                             print('Attempted to delete non-existent batch, skipping.')
                         else:
-                            del state.batches[int(d)]
+                            state.delete_batch(int(d))
 
                             try:
                                 shutil.rmtree(os.path.join(settings['queue_dir'],
@@ -200,16 +586,13 @@ while True:
                             except FileNotFoundError:
                                 pass
 
-            q.put(state)
-
         elif answer == 'Load files into the dispatcher':
-            state = q.get()
             files = prompt_toolkit.prompt('Enter files you wish to load (* wildcard allowed): ',
                 completer=fscompleter.PathCompleter(),
                         complete_while_typing=True)
 
-            files = os.path.expanduser(files)
-            globbed = glob.glob(files)
+            # just the paths, nothing gets read or copied until we're sure
+            globbed = list(loader.matches(files))
 
             if len(globbed) > 0:
                 print('You\'ve loaded %g file(s) '
@@ -218,41 +601,119 @@ while True:
                 answer = questionary.confirm('Are you sure?').ask()
                 if answer: #if yes
                     label = input('Please type in a label for this batch: ')
+                    options = input('Batch options as JSON, e.g. {"threads": 4, '
+                                    '"env": {"SEED": 1}} (enter for none): ')
+                    while options.strip():
+                        try:
+                            options = json.loads(options)
+                            if isinstance(options, dict):
+                                break
+                        except ValueError:
+                            pass
+                        options = input('Please enter a JSON object: ')
+                    # one state update, then the scripts show up in the
+                    # queue all at once
+                    id, count, skipped, method = loader.load(state,
+                                settings['queue_dir'], globbed, label,
+                                options or None, mode = args.load_mode,
+                                workers = args.load_workers)
+                    for path in skipped:
+                        print('Skipped %s, there\'s already a script with '
+                              'that name in the batch.' % path)
+                    if id is not None:
+                        print('Loaded %g file(s) as batch %g (%s).'
+                              % (count, id, method))
+
+        elif answer == 'Load a parameter sweep':
+            template = os.path.expanduser(prompt_toolkit.prompt(
+                'Enter the template script: ',
+                completer=fscompleter.PathCompleter(),
+                        complete_while_typing=True))
+            while not os.path.isfile(template):
+                template = os.path.expanduser(input('No such file, try again: '))
+
+            # a grid gets every combination, a .jsonl file has a point per line
+            params = prompt_toolkit.prompt('Enter a grid as JSON, e.g. '
+                '{"lr": [0.1, 0.01], "seed": [1, 2, 3]}, a JSON list of points, '
+                'or a .jsonl file of points: ',
+                completer=fscompleter.PathCompleter(),
+                        complete_while_typing=True)
+            while True:
+                if os.path.isfile(os.path.expanduser(params)):
+                    break
+                try:
+                    params = json.loads(params)
+                    if isinstance(params, (dict, list)):
+                        break
+                except ValueError:
+                    pass
+                params = input('Please enter a JSON object, list or a file: ')
+
+            via = questionary.select('How do the parameters get to the script?',
+                        choices = ['env', 'args']).ask()
+            label = input('Please type in a label for this batch: ')
+            options = input('Batch options as JSON (enter for none): ')
+            while options.strip():
+                try:
+                    options = json.loads(options)
+                    if isinstance(options, dict):
+                        break
+                except ValueError:
+                    pass
+                options = input('Please enter a JSON object: ')
+
+            try:
+                id, count, method = loader.load_sweep(state,
+                            settings['queue_dir'], template, params, label,
+                            options or None, via = via, mode = args.load_mode)
+            except ValueError as err:
+                print('Couldn\'t load that sweep: %s' % err)
+            else:
+                if id is None:
+                    print('That sweep has no points, nothing loaded.')
+                else:
+                    print('Loaded a sweep of %g point(s) as batch %g (%s).'
+                          % (count, id, method))
+
+        elif answer == 'Change the priority of a batch':
+            snapshot = state.snapshot()
+            for bid, batch in snapshot.batches.items():
+                options = batch.options or {}
+                print('BATCH ID: %g \t LABEL: %s \t PRIORITY: %s \t WEIGHT: %s'
+                      % (bid, batch.label, options.get('priority', 0),
+                         options.get('weight', 1)))
+
+            answer = input('Input the ID of the batch: ')
+            while(not answer.isdigit() or
+                  int(answer) not in snapshot.batches.keys()):
+                answer = input('Please try again: ')
+            bid = int(answer)
+            options = dict(snapshot.batches[bid].options or {})
+
+            # higher priority always goes first, between batches of the same
+            # priority the GPUs are shared by weight
+            for key, kind in [('priority', int), ('weight', float)]:
+                value = input('New %s (enter to keep %s): '
+                              % (key, options.get(key, kind(key == 'weight'))))
+                while value.strip():
                     try:
-                        k = list(state.batches.keys())
-                        id = state.batches[k[-1]].id + 1
-                    except IndexError:
-                        id = 0
-                    processes = []
-                    for g in globbed:
-                        proc = base.Process(
-                            pid = None,
-                            filename = g,
-                            log_dir = None,
-                            status = 'queued'
-                        )
-                        processes.append(proc)
-                    new_batch = base.Batch(
-                        id = id,
-                        label = label,
-                        processes = processes,
-                        options = None
-                    )
-                    state.batches[new_batch.id] = new_batch
-                    # move files to batch queue folder...
-                    batch_folder = os.path.join(settings['queue_dir'],
-                                'batch-' + str(new_batch.id))
-                    os.makedirs(batch_folder)
-
-                    for file in globbed:
-                        shutil.copy(file, os.path.join(batch_folder, os.path.basename(file)))
-
-            q.put(state)
+                        if key != 'weight' or kind(value) > 0:
+                            options[key] = kind(value)
+                            break
+                    except ValueError:
+                        pass
+                    value = input('Please try again: ')
+
+            state.set_options(bid, options)
+
         elif answer == 'Start/Stop the dispatcher':
             # start the dispatcher
             print('Some questions before we start the dispatcher...')
             menu = [    'Start Dispatcher',
                         'Stop Dispatcher',
+                        'Pause Dispatcher',
+                        'Resume Dispatcher',
+                        'Drain Dispatcher',
                         'Back to Main Menu'
                         ]
             answer = questionary.select('What do you want to do?', choices = menu).ask()
@@ -262,17 +723,11 @@ while True:
 
             elif answer == 'Start Dispatcher':
                 # check if there is already a dispatcher running
-                try:
-                    pid = settings['dispatcher']
-                    alive = psutil.pid_exists(pid)
-                    if alive:
-                        print('There\'s already a dispatcher running.')
-                        start = False
+                if m.dispatcher_pid() is not None:
+                    print('There\'s already a dispatcher running.')
+                    start = False
 
-                    else:
-                        start = True
-
-                except KeyError:
+                else:
                     print('No dispatcher detected, setting up now.')
                     start = True
 
@@ -304,34 +759,51 @@ while True:
                                                             ' or equal to 30: ')
                     wait = int(inp)
 
-                    d = dispatcher.Dispatcher(
-                            run = settings['run_dir'],
-                            queue = settings['queue_dir'],
-                            wait = wait,
-                            spread = spread,
-                            block = block,
-                            q = q)
+                    d = api.make_dispatcher(state,
+                            dispatcher_config(wait, spread, block))
 
                     pid = d.start()
                     settings['dispatcher'] = pid
+                    api.save_settings(settings)
                     print('Dispatcher has been started.')
 
             elif answer == 'Stop Dispatcher':
-                try:
-                    pid = settings['dispatcher']
-                    # settings['dispatcher'] contains the PID
-                    try:
-                        psutil.Process(pid).kill()
-                        del settings['dispatcher']
-                    except psutil.NoSuchProcess:
-                        print('No dispatcher detected. Try starting one.')
-                except KeyError:
+                reply = m.control('status')
+                deadline = None
+                if reply is not None and reply['running']:
+                    inp = input('%d job(s) are running, how many seconds '
+                                'should it wait for them (nothing to let them '
+                                'finish)? ' % reply['running'])
+                    while(inp and not inp.isdigit()):
+                        inp = input('Please enter a number of seconds, or '
+                                                                'nothing: ')
+                    deadline = int(inp) if inp else None
+                # it can take hours, no point sitting here for it
+                if not m.stop_dispatcher(deadline, wait = False):
                     print('No dispatcher detected. Try starting one.')
+                elif reply is not None and reply['running']:
+                    print('Dispatcher is stopping, it exits once %s.'
+                          % ('its jobs are done' if deadline is None else
+                             'its jobs are done or in %d seconds, whichever '
+                             'comes first' % deadline))
+                else:
+                    print('Dispatcher is stopping.')
+
+            elif answer in ['Pause Dispatcher', 'Resume Dispatcher',
+                            'Drain Dispatcher']:
+                reply = m.control(answer.split()[0].lower())
+                if reply is None:
+                    print('No dispatcher detected. Try starting one.')
+                elif not reply['ok']:
+                    print(reply['error'])
+                else:
+                    print('Dispatcher is %s, %d job(s) running, %d queued.'
+                          % (reply['state'], reply['running'], reply['queued']))
             else:
                 print('What else is there to do?')
 
         elif answer == 'Kill batch or specific process':
-            state = q.get()
+            snapshot = state.snapshot()
 
             menu = [    'Kill certain process',
                         'Kill all processes in a batch',
@@ -343,35 +815,20 @@ while True:
             if answer == 'Kill certain process':
                 answer = input('Input the ID of the process'
                                                     ' you wish to cancel: ')
-                kv_id = {}
-                for k in state.batches.keys():
-                    kv_id[k] = state.batches[k].get_all_id()
-
-                # a neat way to flatten a list of lists
-                all = [item for sublist in kv_id.values() for item in sublist]
-                while(not answer.isdigit() and answer not in all):
+                # the state service goes looking for it and kills it
+                while(not answer.isdigit() or not state.kill_pid(int(answer))):
                     answer = input('Please try again: ')
-
-                answer = int(answer)
-                # kill the process (must perform a search)
-                for b in state.batches.values():
-                    if answer in b.get_all_id():
-                        for p in b.processes:
-                            if answer == p.pid:
-                                print('Killing Process %g' % p.pid)
-                                p.kill()
-                                break
-                        break
+                print('Killed Process %d' % int(answer))
 
             elif answer == 'Kill all processes in a batch':
                 answer = input('Input the ID of the batch you wish to cancel: ')
                 while(not answer.isdigit() or int(answer) < 0 or \
-                    int(answer) not in state.batches.keys()):
+                    int(answer) not in snapshot.batches.keys()):
                         answer = input('Please try again: ')
 
                 print('Killing batch ID %g' % int(answer))
                 dir = os.path.join(settings['queue_dir'], 'batch-' + answer)
-                state.batches[int(answer)].kill()
+                state.kill_batch(int(answer))
                 try:
                     shutil.rmtree(dir)
                 except FileNotFoundError:
@@ -384,19 +841,12 @@ while True:
             else:
                 print('Something has gone terribly wrong in the logic...')
 
-            q.put(state)
-
         else:
             print('Something has gone terribly wrong in the logic...')
 
     except (KeyboardInterrupt, SystemExit):
         print('')
         print('Exiting and saving current state...')
-        # save state on exit
-        with open('maestro_sys/manager_state.pkl', 'wb') as state_file:
-            pkl.dump(state, state_file)
-        with open('maestro_sys/settings.pkl', 'wb') as settings_file:
-            pkl.dump(settings, settings_file)
-
-        saver.terminate()
+        # save state on exit (if it's ours to save)
+        m.close()
         break
@@ -0,0 +1,187 @@
+import logging
+import multiprocessing as mp
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from base import api, cluster, loader, store
+
+def agent(root, sock, name):
+    # losing the coordinator is part of the plan
+    logging.disable(logging.WARNING)
+    api.make_agent(dict(coordinator = 'unix:' + sock,
+                        key_file = os.path.join(root, 'key'),
+                        run = os.path.join(root, name), name = name,
+                        report = 1, retry = 0.5, gpu_backend = 'fake',
+                        fake_gpus = 2)).serve()
+
+class TestCluster(unittest.TestCase):
+    """ a coordinator and a few agents on this machine, with fake GPUs """
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, True)
+        with open(os.path.join(self.root, 'key'), 'wb') as f:
+            f.write(b'secret')
+        manager, self.state = store.serve(os.path.join(self.root, 'state.pkl'))
+        self.addCleanup(manager.shutdown)
+        self.sock = os.path.join(self.root, 'coord.sock')
+        self.queue = os.path.join(self.root, 'queue')
+        os.makedirs(os.path.join(self.root, 'run'))
+        self.coordinator = None
+        self.addCleanup(self.stop)
+        self.start()
+
+    def start(self):
+        self.coordinator = api.make_dispatcher(self.state, dict(
+                            run = os.path.join(self.root, 'run'),
+                            queue = self.queue, wait = 1, spread = 1,
+                            block = [], listen = 'unix:' + self.sock,
+                            key_file = os.path.join(self.root, 'key')))
+        self.coordinator.start()
+
+    def stop(self):
+        if self.coordinator is not None:
+            self.coordinator.p.terminate()
+            self.coordinator.p.join()
+            self.coordinator = None
+
+    def agents(self, count):
+        for i in range(count):
+            p = mp.Process(target = agent,
+                           args = (self.root, self.sock, 'n%d' % i),
+                           daemon = True)
+            p.start()
+            self.addCleanup(p.join)
+            self.addCleanup(p.terminate)
+        # they connect, and tell what GPUs they have
+        time.sleep(1.5)
+
+    def load(self, count, sleep):
+        files = []
+        for i in range(count):
+            path = os.path.join(self.root, 'j%d.sh' % i)
+            with open(path, 'w') as f:
+                f.write('#!/bin/sh\nsleep %s\n' % sleep)
+            os.chmod(path, 0o755)
+            files.append(path)
+        bid, *_ = loader.load(self.state, self.queue, files, 'test')
+        return bid
+
+    def wait(self, bid, *statuses, timeout = 30):
+        """ the processes of [bid], once they all have one of [statuses] """
+        end = time.monotonic() + timeout
+        while True:
+            processes = self.state.snapshot().batches[bid].processes
+            if all(p.status in statuses for p in processes):
+                return processes
+            if time.monotonic() > end:
+                self.fail([p.status for p in processes])
+            time.sleep(0.1)
+
+    def test_spread(self):
+        self.agents(3)
+        bid = self.load(6, 1)
+        processes = self.wait(bid, 'completed')
+        # log_dir is node:path
+        nodes = {p.log_dir.split(':')[0] for p in processes}
+        self.assertGreater(len(nodes), 1)
+
+    def test_finished_while_restarting(self):
+        self.agents(2)
+        bid = self.load(2, 2)
+        self.wait(bid, 'running')
+        self.stop()
+        # they exit with nobody to tell
+        time.sleep(3)
+        self.start()
+        self.wait(bid, 'completed')
+        # they're marked before they're moved out
+        completed = os.path.join(self.root, 'completed')
+        end = time.monotonic() + 5
+        while len(os.listdir(completed)) < 2 and time.monotonic() < end:
+            time.sleep(0.1)
+        self.assertEqual(sorted(os.listdir(completed)), ['j0.sh', 'j1.sh'])
+
+    def test_kill_takes_its_children(self):
+        self.agents(1)
+        child = os.path.join(self.root, 'child')
+        path = os.path.join(self.root, 'j.sh')
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\nsleep 60 &\necho $! > %s\nwait\n' % child)
+        os.chmod(path, 0o755)
+        bid, *_ = loader.load(self.state, self.queue, [path], 'test')
+        self.wait(bid, 'running')
+        end = time.monotonic() + 10
+        while not os.path.exists(child) and time.monotonic() < end:
+            time.sleep(0.1)
+        with open(child) as f:
+            pid = int(f.read())
+
+        # what `maestro kill` does
+        self.state.kill_batch(bid)
+        shutil.rmtree(os.path.join(self.queue, 'batch-%d' % bid))
+        self.wait(bid, 'killed')
+        end = time.monotonic() + 10
+        while alive(pid) and time.monotonic() < end:
+            time.sleep(0.1)
+        self.assertFalse(alive(pid))
+
+class Marks():
+    """ the state service, as far as marking goes """
+    def __init__(self, sent):
+        self.sent = sent
+
+    def mark(self, bid, fname, pid, status, log_dir = None):
+        self.sent.append(('mark', fname, status))
+
+    def status(self, bid, fname):
+        return 'running'
+
+class Conn():
+    def __init__(self, sent):
+        self.sent = sent
+        self.node = 'n0'
+
+    def send(self, **msg):
+        self.sent.append((msg['op'], msg['job']))
+
+class TestAck(unittest.TestCase):
+    """ an exit is acked once it's in the state, not when it comes in """
+    def test_acked_once_marked(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        run = os.path.join(root, 'run')
+        queue = os.path.join(root, 'queue')
+        os.makedirs(os.path.join(run, 'batch-0'))
+        os.makedirs(os.path.join(queue, 'batch-0'))
+        sent = []
+        c = cluster.Coordinator(run, queue, 30, 1, None, Marks(sent),
+                                listen = 'unix:' + os.path.join(root, 's'),
+                                key = b'secret')
+        conn = Conn(sent)
+        c.nodes['n0'] = cluster.Node('n0', conn, [])
+        job = os.path.join(queue, 'batch-0', 'a.sh')
+        open(os.path.join(run, 'batch-0', 'a.sh'), 'w').close()
+        c.remote[job] = c.running[job] = cluster.RemoteJob('n0', 1234)
+
+        self.assertTrue(c.handle(conn, {'op': 'exit', 'job': job, 'rc': 0,
+                                        'error': None}))
+        self.assertEqual(sent, [])
+        c.finish(job, c.running)
+        self.assertEqual(sent, [('mark', 'a.sh', 'completed'), ('ack', job)])
+
+        # it says it again (it reconnected before the ack got there)
+        del sent[:]
+        self.assertFalse(c.handle(conn, {'op': 'exit', 'job': job, 'rc': 0,
+                                         'error': None}))
+        self.assertEqual(sent, [('ack', job)])
+
+def alive(pid):
+    """ running, not a zombie nobody reaped yet """
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except FileNotFoundError:
+        return False
@@ -0,0 +1,61 @@
+import json
+import os
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+
+from base import control, dispatcher, gpu
+
+class TestRequest(unittest.TestCase):
+    def setUp(self):
+        ours, self.theirs = socket.socketpair()
+        self.addCleanup(self.theirs.close)
+        self.request = control.Request(ours)
+        self.addCleanup(self.request.close)
+
+    def ask(self, data):
+        self.theirs.sendall(data)
+        self.assertTrue(self.request.read())
+        self.request.answer(lambda request: {'op': request['op']})
+        return json.loads(self.theirs.recv(4096))
+
+    def test_answer(self):
+        self.assertEqual(self.ask(b'{"op": "status"}\n'),
+                         {'op': 'status', 'ok': True})
+
+    def test_silent(self):
+        # nothing there yet, and nobody waits for it
+        start = time.monotonic()
+        self.assertFalse(self.request.read())
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.theirs.sendall(b'{"op": ')
+        self.assertFalse(self.request.read())
+        self.assertEqual(self.ask(b'"drain"}\n'), {'op': 'drain', 'ok': True})
+
+    def test_not_a_dict(self):
+        reply = self.ask(b'["status"]\n')
+        self.assertFalse(reply['ok'])
+        self.assertIn('list', reply['error'])
+
+class TestShutdown(unittest.TestCase):
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        self.d = dispatcher.Dispatcher(os.path.join(root, 'run'),
+                                       os.path.join(root, 'queue'), 30, 1,
+                                       None, None, gpus = gpu.FakeProvider())
+        self.d.running = {'job.sh': None}
+
+    def test_waits_for_the_jobs(self):
+        reply = self.d.command({'op': 'shutdown'})
+        self.assertEqual(reply['state'], 'stopping')
+        self.assertIsNone(reply['deadline'])
+        self.assertFalse(self.d.finished())
+        self.d.running.clear()
+        self.assertTrue(self.d.finished())
+
+    def test_deadline(self):
+        self.d.command({'op': 'shutdown', 'deadline': 0})
+        self.assertTrue(self.d.finished())
@@ -0,0 +1,156 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from base import dispatcher, gpu
+
+# what `nvidia-smi pmon -c 1` says with two jobs on GPU 0 and nothing on 1
+PMON = """\
+# gpu        pid  type    sm   mem   enc   dec   command
+# Idx          #   C/G     %     %     %     %   name
+    0      12345     C    50    20     -     -   python
+    0      12346     C    40    10     -     -   python
+    1          -     -     -     -     -     -   -
+"""
+
+QUERY = """\
+0, 16384, 1024, 90
+1, 16384, 16000, 0
+"""
+
+class FakeSMI():
+    """ an nvidia-smi on the PATH that counts how often it's run """
+    def __init__(self, folder, pmon = PMON, query = QUERY, hang = False):
+        self.calls = os.path.join(folder, 'calls')
+        for name, out in [('pmon', pmon), ('query', query)]:
+            with open(os.path.join(folder, name), 'w') as f:
+                f.write(out)
+        path = os.path.join(folder, 'nvidia-smi')
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\n'
+                    'echo "$1" >> %s\n' % self.calls +
+                    ('exec sleep 10\n' if hang else '') +
+                    'if [ "$1" = pmon ]; then cat %s/pmon; '
+                    'else cat %s/query; fi\n' % (folder, folder))
+        os.chmod(path, 0o755)
+        self.env = mock.patch.dict(os.environ, {
+            'PATH': folder + os.pathsep + os.environ.get('PATH', '')})
+
+    def count(self):
+        try:
+            with open(self.calls) as f:
+                return len(f.read().split())
+        except FileNotFoundError:
+            return 0
+
+class TestSMIProvider(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def fake(self, **kwargs):
+        smi = FakeSMI(self.dir, **kwargs)
+        smi.env.start()
+        self.addCleanup(smi.env.stop)
+        return smi
+
+    def test_counts_processes_per_gpu(self):
+        self.fake()
+        devices = gpu.SMIProvider().devices()
+        self.assertEqual([(d.id, d.procs) for d in devices],
+                         [('0', 2), ('1', 0)])
+        # pmon says nothing about memory
+        self.assertEqual(devices[0].mem_total, None)
+
+    def test_memory(self):
+        self.fake()
+        devices = gpu.SMIProvider(memory = True).devices()
+        self.assertEqual(devices[0], gpu.Device('0', 2, 16384, 1024, 90))
+        self.assertEqual(devices[1], gpu.Device('1', 0, 16384, 16000, 0))
+
+    def test_unknown_memory(self):
+        self.fake(query = '0, [N/A], [N/A], [N/A]\n')
+        devices = gpu.SMIProvider(memory = True).devices()
+        self.assertEqual(devices[0], gpu.Device('0', 2, None, None, None))
+
+    def test_ttl(self):
+        smi = self.fake()
+        provider = gpu.SMIProvider(ttl = 60)
+        provider.devices()
+        provider.devices()
+        self.assertEqual(smi.count(), 1)
+
+        provider = gpu.SMIProvider(ttl = 0)
+        provider.devices()
+        provider.devices()
+        self.assertEqual(smi.count(), 3)
+
+    def test_hung_smi_keeps_last_answer(self):
+        self.fake()
+        provider = gpu.SMIProvider(timeout = 0.5)
+        first = provider.devices()
+        self.fake(hang = True)
+        self.assertEqual(provider.devices(), first)
+
+    def test_no_smi(self):
+        with mock.patch.dict(os.environ, {'PATH': self.dir}):
+            self.assertEqual(gpu.SMIProvider().devices(), [])
+
+class TestFakeProvider(unittest.TestCase):
+    def test_idle(self):
+        devices = gpu.FakeProvider(count = 3).devices()
+        self.assertEqual([d.id for d in devices], ['0', '1', '2'])
+        self.assertTrue(all(d.procs == 0 and d.mem_free == d.mem_total
+                            for d in devices))
+
+    def test_busy_patterns_cycle(self):
+        provider = gpu.FakeProvider(count = 2, busy = ['10', '01'])
+        answers = [[d.procs for d in provider.devices()] for _ in range(4)]
+        self.assertEqual(answers, [[1, 0], [0, 1], [1, 0], [0, 1]])
+
+    def test_busy_gpu_is_full(self):
+        busy, idle = gpu.FakeProvider(count = 2, busy = '1').devices()
+        self.assertEqual((busy.mem_free, busy.util), (0, 100))
+        self.assertEqual((idle.mem_free, idle.util), (idle.mem_total, 0))
+
+    def test_make_provider(self):
+        provider = gpu.make_provider('fake', count = 8)
+        self.assertIsInstance(provider, gpu.FakeProvider)
+        self.assertEqual(len(provider.devices()), 8)
+        with self.assertRaises(KeyError):
+            gpu.make_provider('nope')
+
+class TestDispatcherGPUs(unittest.TestCase):
+    def dispatcher(self, provider, spread = 1, block = None):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        return dispatcher.Dispatcher(os.path.join(root, 'run'),
+                                     os.path.join(root, 'queue'), 30, spread,
+                                     block, None, gpus = provider)
+
+    def test_idle_gpus(self):
+        d = self.dispatcher(gpu.FakeProvider(count = 4, busy = '0100'))
+        self.assertEqual(d.gpu(), ['0', '2', '3'])
+
+    def test_blocked_gpus(self):
+        d = self.dispatcher(gpu.FakeProvider(count = 4), block = [0, 3])
+        self.assertEqual(d.gpu(), ['1', '2'])
+
+    def test_our_jobs_keep_their_gpus(self):
+        # they might not show up on the GPU yet
+        d = self.dispatcher(gpu.FakeProvider(count = 4))
+        d.held['queue/batch-0/a.sh'] = ['1', '2']
+        self.assertEqual(d.gpu(), ['0', '3'])
+
+    def test_groups(self):
+        d = self.dispatcher(gpu.FakeProvider(count = 4), spread = 2)
+        self.assertEqual(d.gpu_groups(d.gpu()), [['0', '1'], ['2', '3']])
+        # not enough for a full group, whatever's free goes to one job
+        d = self.dispatcher(gpu.FakeProvider(count = 4, busy = '111'),
+                            spread = 2)
+        self.assertEqual(d.gpu_groups(d.gpu()), [['3']])
+
+if __name__ == '__main__':
+    unittest.main()
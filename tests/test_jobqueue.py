@@ -0,0 +1,152 @@
+import unittest
+
+from base import jobqueue
+
+def jobs(batch, count):
+    return ['/q/batch-%d/j%d.sh' % (batch, i) for i in range(count)]
+
+def drain(q):
+    popped = []
+    while q:
+        popped.append(q.pop())
+    return popped
+
+class TestJobQueue(unittest.TestCase):
+    def test_natural_order(self):
+        q = jobqueue.JobQueue()
+        for job in reversed(jobs(0, 12)):
+            q.add(job, 0)
+        self.assertEqual(drain(q), jobs(0, 12))
+
+    def test_priority_first(self):
+        q = jobqueue.JobQueue()
+        for job in jobs(0, 3):
+            q.add(job, 0)
+        for job in jobs(1, 2):
+            q.add(job, 1, priority = 5)
+        self.assertEqual(drain(q), jobs(1, 2) + jobs(0, 3))
+
+    def test_batches_take_turns(self):
+        # a big sweep doesn't hold up a small batch loaded after it
+        q = jobqueue.JobQueue()
+        for job in jobs(0, 100):
+            q.add(job, 0)
+        for job in jobs(1, 3):
+            q.add(job, 1)
+        first = [q.pop() for _ in range(6)]
+        self.assertEqual(sorted(first), sorted(jobs(0, 3) + jobs(1, 3)))
+
+    def test_shared_by_weight(self):
+        q = jobqueue.JobQueue()
+        for job in jobs(0, 30):
+            q.add(job, 0, weight = 1)
+        for job in jobs(1, 30):
+            q.add(job, 1, weight = 2)
+        first = [q.pop() for _ in range(30)]
+        self.assertEqual(sum(j in jobs(1, 30) for j in first), 20)
+
+    def test_late_flow_doesnt_hog(self):
+        # it starts where the others are now, not where they started
+        q = jobqueue.JobQueue()
+        for job in jobs(0, 20):
+            q.add(job, 0)
+        for _ in range(10):
+            q.pop()
+        for job in jobs(1, 20):
+            q.add(job, 1)
+        first = [q.pop() for _ in range(10)]
+        self.assertEqual(sum(j in jobs(1, 20) for j in first), 5)
+
+    def test_shared_by_label(self):
+        q = jobqueue.JobQueue(share = 'label')
+        for bid in range(3):
+            for job in jobs(bid, 10):
+                q.add(job, bid, label = 'a' if bid < 2 else 'b')
+        first = [q.pop() for _ in range(10)]
+        self.assertEqual(sum(j in jobs(2, 10) for j in first), 5)
+
+    def test_removed_lazily(self):
+        q = jobqueue.JobQueue()
+        for job in jobs(0, 4):
+            q.add(job, 0)
+        q.remove(jobs(0, 4)[0])
+        q.remove(jobs(0, 4)[2])
+        self.assertEqual(len(q), 2)
+        self.assertNotIn(jobs(0, 4)[0], q)
+        # still in the flow's heap, skipped when it comes up
+        self.assertEqual(drain(q), [jobs(0, 4)[1], jobs(0, 4)[3]])
+
+    def test_removed_flow(self):
+        q = jobqueue.JobQueue()
+        for job in jobs(0, 2):
+            q.add(job, 0)
+        for job in jobs(1, 2):
+            q.add(job, 1)
+        for job in jobs(0, 2):
+            q.remove(job)
+        self.assertEqual(q.jobs(0), set())
+        self.assertEqual(drain(q), jobs(1, 2))
+        with self.assertRaises(IndexError):
+            q.pop()
+
+    def test_refund(self):
+        q = jobqueue.JobQueue()
+        for job in jobs(0, 3):
+            q.add(job, 0)
+        for job in jobs(1, 3):
+            q.add(job, 1)
+        job = q.pop()
+        q.refund(job, 0)
+        # its batch gets its turn back, it's not behind batch 1 now
+        self.assertEqual(sorted([q.pop(), q.pop()]),
+                         [job, jobs(1, 1)[0]])
+
+    def test_source_pulled_lazily(self):
+        pulled = []
+        def source():
+            for job in jobs(1, 5):
+                pulled.append(job)
+                yield job
+
+        q = jobqueue.JobQueue()
+        q.add(jobs(1, 1)[0].replace('j0', 'template'), 1)
+        q.add_source(1, source = source(), count = 5)
+        self.assertEqual(len(q), 6)
+        q.pop()
+        self.assertEqual(pulled, [])
+        q.pop()
+        self.assertEqual(pulled, jobs(1, 1))
+        self.assertEqual(q.remove_source(1)[1], 4)
+        self.assertFalse(q)
+
+    def test_deferred(self):
+        q = jobqueue.JobQueue()
+        job, other = jobs(0, 2)
+        q.defer(job, 0, 10)
+        q.add(other, 0)
+        # queued as far as anybody asks, but not poppable
+        self.assertIn(job, q)
+        self.assertEqual(len(q), 2)
+        self.assertEqual(q.jobs(0), {other})
+        self.assertEqual(q.jobs(0, deferred = True), {job, other})
+        self.assertEqual(drain(q), [other])
+        self.assertEqual(q.next_due(), 10)
+
+        self.assertEqual(q.due(9), [])
+        self.assertEqual(q.due(10), [job])
+        self.assertNotIn(job, q)
+        self.assertIsNone(q.next_due())
+
+    def test_deferred_removed(self):
+        q = jobqueue.JobQueue()
+        job = jobs(0, 1)[0]
+        q.defer(job, 0, 10)
+        q.remove(job)
+        self.assertEqual(len(q), 0)
+        self.assertIsNone(q.next_due())
+        self.assertEqual(q.due(20), [])
+
+        # and deferred again, only the new time counts
+        q.defer(job, 0, 30)
+        self.assertEqual(q.due(20), [])
+        self.assertEqual(q.due(30), [job])
@@ -0,0 +1,176 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from base import api, journal, store
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'manager_state.pkl')
+
+    def store(self):
+        s = store.StateStore(self.path)
+        self.addCleanup(s.journal.close)
+        return s
+
+    def labels(self):
+        return sorted(b.label for b in self.store().state.batches.values())
+
+    def test_replay(self):
+        s = self.store()
+        bid = s.add_batch('a', ['a.sh', 'b.sh'])
+        s.mark(bid, 'a.sh', 123, 'running')
+        s.set_options(bid, {'priority': 2})
+        s.journal.sync()
+
+        state = self.store().state
+        self.assertEqual(state.batches[bid].options, {'priority': 2})
+        self.assertEqual(state.batches[bid].find('a.sh').pid, 123)
+
+    def test_compaction(self):
+        s = self.store()
+        s.add_batch('a', ['a.sh'])
+        self.assertTrue(s.save())
+        s.add_batch('b', ['b.sh'])
+        s.journal.sync()
+        self.assertFalse(os.path.exists(s.journal.path + '.old'))
+        self.assertEqual(self.labels(), ['a', 'b'])
+
+    def test_unfinished_compaction(self):
+        s = self.store()
+        s.add_batch('a', ['a.sh'])
+        s.save()
+        s.add_batch('b', ['b.sh'])
+        # the snapshot never made it, .old is all there is of b
+        s.journal.rotate()
+        s.add_batch('c', ['c.sh'])
+        s.journal.sync()
+
+        # and the one finishing it up doesn't get to write it either
+        with mock.patch.object(journal.Journal, 'compact',
+                               side_effect = RuntimeError('crash')):
+            with self.assertRaises(RuntimeError):
+                store.StateStore(self.path)
+        self.assertEqual(self.labels(), ['a', 'b', 'c'])
+        self.assertFalse(os.path.exists(s.journal.path + '.old'))
+
+    def test_torn_record(self):
+        s = self.store()
+        s.add_batch('a', ['a.sh'])
+        s.journal.sync()
+        with open(s.journal.path, 'ab') as f:
+            f.write(b'\x40\x00\x00\x00 half a record')
+
+        s = self.store()
+        s.add_batch('b', ['b.sh'])
+        s.journal.sync()
+        self.assertEqual(self.labels(), ['a', 'b'])
+
+    def test_options_of_a_deleted_batch(self):
+        j = journal.Journal(os.path.splitext(self.path)[0] + '.journal')
+        j.open()
+        j.append('set_options', 3, {'priority': 1})
+        j.close()
+        self.assertEqual(self.store().state.batches, {})
+
+if __name__ == '__main__':
+    unittest.main()
+
+class TestSummary(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'manager_state.pkl')
+
+    def test_left_behind(self):
+        s = store.StateStore(self.path)
+        bid = s.add_batch('a', ['a.sh', 'b.sh'])
+        s.mark(bid, 'a.sh', 123, 'completed')
+        s.close(save = False)
+
+        found = api.Maestro(self.dir).peek()
+        self.assertEqual(found, [{'id': bid, 'label': 'a', 'options': None,
+                                  'counts': {'queued': 1, 'completed': 1}}])
+
+    def test_stale(self):
+        s = store.StateStore(self.path)
+        bid = s.add_batch('a', ['a.sh'])
+        s.close(save = False)
+
+        # somebody changed things after and didn't leave a new one
+        s = store.StateStore(self.path)
+        self.addCleanup(s.journal.close)
+        s.mark(bid, 'a.sh', 123, 'running')
+        s.journal.sync()
+        self.assertIsNone(api.Maestro(self.dir).peek())
+
+    def test_served(self):
+        s = store.StateStore(self.path)
+        s.add_batch('a', ['a.sh'])
+        s.close(save = False)
+
+        open(os.path.join(self.dir, 'state.sock'), 'w').close()
+        self.assertIsNone(api.Maestro(self.dir).peek())
+
+class TestColdLoad(unittest.TestCase):
+    """ loading with nobody serving the state doesn't load the history """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'manager_state.pkl')
+        self.queue = os.path.join(self.dir, 'queue')
+        os.makedirs(self.queue)
+        api.save_settings({'queue_dir': self.queue}, self.dir)
+        self.script = os.path.join(self.dir, 'job.sh')
+        with open(self.script, 'w') as f:
+            f.write('#!/bin/sh\n')
+
+        s = store.StateStore(self.path)
+        self.first = s.add_batch('a', ['a.sh'])
+        s.close(save = False)
+
+    def load(self):
+        m = api.Maestro(self.dir)
+        with mock.patch.object(api.Maestro, 'open') as opened:
+            bid, count, _, _ = m.load(self.script, 'b')
+        self.assertFalse(opened.called)
+        return bid
+
+    def test_journaled(self):
+        bid = self.load()
+        self.assertEqual(bid, self.first + 1)
+        self.assertTrue(os.path.isdir(os.path.join(self.queue,
+                                                   'batch-%d' % bid)))
+        # the summary has it, so the next one can go the same way
+        self.assertEqual([b['id'] for b in api.Maestro(self.dir).peek()],
+                         [self.first, bid])
+        self.assertEqual(self.load(), bid + 1)
+
+        s = store.StateStore(self.path)
+        self.addCleanup(s.journal.close)
+        self.assertEqual(s.get_batch(bid)[0], 'b')
+        self.assertEqual([p.filename for p in s.state.batches[bid].processes],
+                         [self.script])
+        self.assertEqual(s.add_batch('c', ['c.sh']), bid + 2)
+
+    def test_taken_back(self):
+        m = api.Maestro(self.dir)
+        cold = api.Cold(m)
+        bid = cold.add_batch('b', ['b.sh'])
+        self.assertTrue(cold.delete_batch(bid))
+        self.assertEqual([b['id'] for b in m.peek()], [self.first])
+        s = store.StateStore(self.path)
+        self.addCleanup(s.journal.close)
+        self.assertEqual(list(s.state.batches), [self.first])
+
+    def test_stale(self):
+        # somebody changed things after and didn't leave a new summary
+        s = store.StateStore(self.path)
+        s.mark(self.first, 'a.sh', 123, 'running')
+        s.journal.close()
+        m = api.Maestro(self.dir)
+        self.assertIsNone(m.add_cold('add_batch', 'b', ['b.sh'], None))
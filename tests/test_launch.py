@@ -0,0 +1,110 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from base import dispatcher, gpu, jobqueue
+
+class Store():
+    def __init__(self):
+        self.marks = []
+
+    def mark(self, bid, fname, pid, status, log_dir = None):
+        self.marks.append((bid, fname, status))
+
+class Gone():
+    """ a batch killed between syncing the queue and launching its jobs """
+    engine = dispatcher.Dispatcher
+
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        self.queue = os.path.join(root, 'queue')
+        run = os.path.join(root, 'run')
+        os.makedirs(run)
+        self.d = self.engine(run, self.queue, 30, 1, None, None,
+                             gpus = gpu.FakeProvider())
+        self.d.store = Store()
+        self.d.job_queue = jobqueue.JobQueue()
+        os.makedirs(os.path.join(self.queue, 'batch-0'))
+        self.jobs = []
+        for name in ['a.sh', 'b.sh']:
+            job = os.path.join(self.queue, 'batch-0', name)
+            with open(job, 'w') as f:
+                f.write('#!/bin/sh\ntrue\n')
+            os.chmod(job, 0o755)
+            self.d.batch_info[0] = ('b', {})
+            self.d.enqueue(self.d.job_queue, job)
+            self.jobs.append(job)
+        self.addCleanup(self.reap)
+
+    def reap(self):
+        for p in self.d.running.values():
+            p.wait()
+
+class TestGone(Gone, unittest.TestCase):
+    def test_launch(self):
+        os.remove(self.jobs[0])
+        self.assertFalse(self.d.launch(self.jobs[0], ['0'], self.d.running))
+        self.assertNotIn(self.jobs[0], self.d.queued_at)
+        self.assertNotIn(self.jobs[0], self.d.held)
+        # and the next one still goes
+        self.assertTrue(self.d.launch(self.jobs[1], ['1'], self.d.running))
+        self.assertEqual(list(self.d.running), [self.jobs[1]])
+        self.assertEqual(self.d.store.marks, [(0, 'b.sh', 'running')])
+
+class TestGoneAsync(Gone, unittest.TestCase):
+    engine = dispatcher.AsyncDispatcher
+
+    def test_schedule(self):
+        os.remove(self.jobs[0])
+
+        async def nothing(*args, **kwargs):
+            return None
+
+        spawned = []
+        def spawn(job, path, gpus, running_jobs, output):
+            spawned.append((job, path))
+            return True
+
+        placements = [(self.jobs[0], ['0']), (self.jobs[1], ['1'])]
+        with mock.patch.multiple(self.d, check_jobs = mock.DEFAULT,
+                                 sync_queue = mock.DEFAULT,
+                                 get_files = mock.Mock(return_value = []),
+                                 get_sweeps = mock.Mock(return_value = []),
+                                 known = mock.Mock(return_value = ([], [])),
+                                 off_loop = nothing, probe = mock.Mock(
+                                    side_effect = lambda: asyncio.sleep(0,
+                                                                        [])),
+                                 place = mock.Mock(return_value = placements),
+                                 spawn = spawn):
+            launched = asyncio.run(self.d.schedule_jobs(self.d.job_queue,
+                                                        self.d.running))
+        self.assertEqual(launched, 1)
+        self.assertEqual([job for job, _ in spawned], [self.jobs[1]])
+        self.assertNotIn(self.jobs[0], self.d.queued_at)
+
+class TestPinned(unittest.TestCase):
+    def test_pinned_from_the_start(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        queue = os.path.join(root, 'queue')
+        run = os.path.join(root, 'run')
+        os.makedirs(run)
+        os.makedirs(os.path.join(queue, 'batch-0'))
+        d = dispatcher.Dispatcher(run, queue, 30, 1, None, Store(),
+                                  gpus = gpu.FakeProvider())
+        cpu = min(os.sched_getaffinity(0))
+        d.batch_info[0] = ('b', {'cpus': [cpu]})
+        job = os.path.join(queue, 'batch-0', 'a.sh')
+        with open(job, 'w') as f:
+            # the very first thing the job does
+            f.write('#!/bin/sh\ngrep Cpus_allowed_list /proc/self/status\n')
+        os.chmod(job, 0o755)
+
+        self.assertTrue(d.launch(job, ['0'], d.running))
+        d.running[job].wait()
+        with open(os.path.join(d.job_log_dir(job), 'stdout')) as f:
+            self.assertEqual(f.read().split(), ['Cpus_allowed_list:', str(cpu)])
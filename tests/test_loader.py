@@ -0,0 +1,127 @@
+import errno
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from base import loader
+
+def refuse(code):
+    """ a way of placing files that this filesystem doesn't do """
+    def method(src, dst):
+        raise OSError(code, os.strerror(code))
+    return method
+
+class Store():
+    def __init__(self):
+        self.batches = []
+
+    def add_batch(self, label, files, options = None):
+        self.batches.append(files)
+        return len(self.batches) - 1
+
+    def delete_batch(self, bid):
+        self.batches[bid] = None
+
+class TestPlace(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.files = []
+        for i in range(3):
+            path = os.path.join(self.root, 'j%d.sh' % i)
+            with open(path, 'w') as f:
+                f.write('#!/bin/sh\necho %d\n' % i)
+            os.chmod(path, 0o755)
+            self.files.append(path)
+        self.dst = os.path.join(self.root, 'dst')
+        os.makedirs(self.dst)
+
+    def pairs(self):
+        return [(f, os.path.join(self.dst, os.path.basename(f)))
+                for f in self.files]
+
+    def place(self, mode = 'auto', **methods):
+        with mock.patch.dict(loader.METHODS, methods):
+            return loader.place(self.pairs(), mode)
+
+    def placed(self):
+        for src, dst in self.pairs():
+            self.placed_one(src, dst)
+
+    def placed_one(self, src, dst):
+        with open(src) as s, open(dst) as d:
+            self.assertEqual(s.read(), d.read())
+
+    def test_reflink_first(self):
+        calls = []
+        def reflink(src, dst):
+            calls.append(src)
+            shutil.copy(src, dst)
+        self.assertEqual(self.place(reflink = reflink), 'reflink')
+        self.assertEqual(calls, self.files)
+        self.placed()
+
+    def test_hardlink_next(self):
+        self.assertEqual(self.place(reflink = refuse(errno.EOPNOTSUPP)),
+                         'hardlink')
+        self.placed()
+        self.assertTrue(os.path.samefile(*self.pairs()[0]))
+
+    def test_copy_last(self):
+        self.assertEqual(self.place(reflink = refuse(errno.ENOTTY),
+                                    hardlink = refuse(errno.EXDEV)), 'copy')
+        self.placed()
+        self.assertFalse(os.path.samefile(*self.pairs()[0]))
+        # executable still
+        self.assertTrue(os.access(self.pairs()[0][1], os.X_OK))
+
+    def test_copy_what_wont_link(self):
+        # the first one linked, some other one can't be (too many links)
+        def hardlink(src, dst):
+            if src == self.files[1]:
+                raise OSError(errno.EMLINK, 'too many links')
+            os.link(src, dst)
+        self.assertEqual(self.place(reflink = refuse(errno.EXDEV),
+                                    hardlink = hardlink), 'hardlink')
+        self.placed()
+        self.assertFalse(os.path.samefile(*self.pairs()[1]))
+        self.assertTrue(os.path.samefile(*self.pairs()[2]))
+
+    def test_real_errors(self):
+        # only "can't do that here" falls back, anything else is an error
+        with self.assertRaises(OSError):
+            self.place(reflink = refuse(errno.ENOSPC))
+        self.assertEqual(os.listdir(self.dst), [])
+
+    def test_one_mode(self):
+        with self.assertRaises(OSError):
+            self.place('reflink', reflink = refuse(errno.EXDEV))
+        self.assertEqual(self.place('copy'), 'copy')
+        self.placed()
+
+    def test_load(self):
+        queue = os.path.join(self.root, 'queue')
+        os.makedirs(queue)
+        store = Store()
+        bid, count, skipped, method = loader.load(store, queue, self.files +
+                                                  self.files[:1], 'test')
+        self.assertEqual((count, skipped), (3, self.files[:1]))
+        self.assertEqual(sorted(os.listdir(os.path.join(queue,
+                                                        'batch-%d' % bid))),
+                         ['j0.sh', 'j1.sh', 'j2.sh'])
+        # no staging folder left behind
+        self.assertEqual(sorted(os.listdir(self.root)),
+                         ['dst', 'j0.sh', 'j1.sh', 'j2.sh', 'queue'])
+
+    def test_reflink_cleans_up(self):
+        # most filesystems can't clone, it mustn't leave an empty file then
+        src, dst = self.pairs()[0]
+        try:
+            loader.reflink(src, dst)
+        except OSError as err:
+            self.assertIn(err.errno, loader.UNSUPPORTED)
+            self.assertFalse(os.path.exists(dst))
+        else:
+            self.placed_one(src, dst)
@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from base import dispatcher, gpu, jobqueue
+
+def device(id, procs = 0, free = 16384, util = 0):
+    return gpu.Device(id, procs, 16384, free, util)
+
+class TestPack(unittest.TestCase):
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        self.queue = os.path.join(root, 'queue')
+        self.d = dispatcher.Dispatcher(os.path.join(root, 'run'), self.queue,
+                                       30, 1, None, None,
+                                       gpus = gpu.FakeProvider(),
+                                       schedule = 'pack')
+        self.job_queue = jobqueue.JobQueue()
+
+    def batch(self, bid, count, **options):
+        self.d.batch_info[bid] = ('b%d' % bid, options)
+        jobs = [os.path.join(self.queue, 'batch-%d' % bid, 'j%d.sh' % i)
+                for i in range(count)]
+        for job in jobs:
+            self.d.enqueue(self.job_queue, job)
+        return jobs
+
+    def place(self, devices):
+        return [(os.path.basename(job), gpus) for job, gpus in
+                self.d.place(self.job_queue, devices)]
+
+    def test_best_fit(self):
+        self.batch(0, 3, mem = 6000, per_gpu = 4)
+        placed = self.place([device('0', free = 16000),
+                             device('1', free = 7000)])
+        # the tight one first, then what's left on the big one
+        self.assertEqual(placed, [('j0.sh', ['1']), ('j1.sh', ['0']),
+                                  ('j2.sh', ['0'])])
+
+    def test_doesnt_fit_stays_queued(self):
+        self.batch(0, 2, mem = 10000, per_gpu = 4)
+        self.assertEqual(self.place([device('0')]), [('j0.sh', ['0'])])
+        self.assertEqual(len(self.job_queue), 1)
+
+    def test_busy_gpus(self):
+        # somebody else's job has it at 90%, plenty of memory left or not
+        self.batch(0, 1, mem = 1000)
+        self.assertEqual(self.place([device('0', procs = 1, util = 90)]), [])
+        self.assertEqual(self.place([device('0', procs = 1, util = 30)]),
+                         [('j0.sh', ['0'])])
+
+    def test_max_util(self):
+        self.batch(0, 1, mem = 1000, max_util = 95)
+        self.assertEqual(self.place([device('0', procs = 1, util = 90)]),
+                         [('j0.sh', ['0'])])
+
+    def test_no_mem_gets_an_idle_gpu(self):
+        self.batch(0, 3)
+        placed = self.place([device('0', procs = 1, free = 15000, util = 0),
+                             device('1'), device('2')])
+        self.assertEqual(placed, [('j0.sh', ['1']), ('j1.sh', ['2'])])
+
+    def test_ours_hold_their_memory(self):
+        # it hasn't allocated anything yet, but it will
+        self.d.batch_info[1] = ('b1', {'mem': 12000})
+        self.d.held[os.path.join(self.queue, 'batch-1', 'x.sh')] = ['0']
+        self.batch(0, 1, mem = 6000, per_gpu = 2)
+        self.assertEqual(self.place([device('0')]), [])
+
+    def test_ours_without_mem_hold_the_gpu(self):
+        self.d.batch_info[1] = ('b1', {})
+        self.d.held[os.path.join(self.queue, 'batch-1', 'x.sh')] = ['0']
+        self.batch(0, 1, mem = 1, per_gpu = 2)
+        self.assertEqual(self.place([device('0')]), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from base import capture, dispatcher, gpu, jobqueue, running
+
+class Store():
+    """ just enough of the state service for finish and retries """
+    def __init__(self):
+        self.statuses = {}
+        self.attempts_of = {}
+        self.marks = []
+
+    def mark(self, bid, fname, pid, status, log_dir = None):
+        self.statuses[fname] = status
+        self.marks.append((fname, status))
+
+    def status(self, bid, fname):
+        return self.statuses.get(fname)
+
+    def attempts(self, bid, fname):
+        return self.attempts_of.get(fname, 0)
+
+    def retry(self, bid, fname, attempt):
+        self.statuses[fname] = 'queued'
+        self.attempts_of[fname] = self.attempts_of.get(fname, 0) + 1
+
+class Exited():
+    def __init__(self, rc, pid = 4321):
+        self.pid = pid
+        self.returncode = rc
+
+    def poll(self):
+        return self.returncode
+
+class Retries(unittest.TestCase):
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        self.queue = os.path.join(root, 'queue')
+        self.run = os.path.join(root, 'run')
+        os.makedirs(self.run)
+        self.d = dispatcher.Dispatcher(self.run, self.queue, 30, 1, None,
+                                       Store(), gpus = gpu.FakeProvider())
+        self.d.job_queue = jobqueue.JobQueue()
+        os.makedirs(os.path.join(self.queue, 'batch-0'))
+        self.job = os.path.join(self.queue, 'batch-0', 'a.sh')
+
+    def options(self, **options):
+        self.d.batch_info[0] = ('b', options)
+
+    def ran(self, stderr = ''):
+        """ the script is in the run directory, with its output """
+        with open(os.path.join(self.run, 'a.sh'), 'w') as f:
+            f.write('#!/bin/sh\n')
+        log_dir = self.d.job_log_dir(self.job)
+        os.makedirs(log_dir, exist_ok = True)
+        for name, text in [('stdout', 'out'), ('stderr', stderr)]:
+            with open(os.path.join(log_dir, name), 'w') as f:
+                f.write(text)
+
+class TestLost(Retries):
+    def test_lost_in_a_crash(self):
+        # picked up after a restart, and gone without leaving its exit status
+        self.options(max_attempts = 3)
+        self.ran()
+        self.d.store.statuses['a.sh'] = 'running'
+        lost = running.Adopted({'pid': 4321, 'started': None,
+                                'rc_file': os.path.join(self.run, 'none')})
+        lost.returncode, lost.lost = -9, True
+        self.assertEqual(self.d.outcome(self.job, lost), ('failed', None))
+        self.assertNotIn(self.job, self.d.job_queue)
+
+class TestCapped(Retries):
+    def test_end_of_capped_stderr(self):
+        # only the head of stderr makes it to the file, the error's at the end
+        self.options(max_attempts = 2, retry_patterns = ['out of memory'])
+        self.ran()
+        r, w = os.pipe()
+        stderr = os.path.join(self.d.job_log_dir(self.job), 'stderr')
+        self.d.outputs[self.job] = [capture.Capture(r, stderr, 1000, 'head',
+                                                    dispatcher.STDERR_TAIL)]
+        os.write(w, b'x' * 50000 + b'\nCUDA out of memory\n')
+        os.close(w)
+        with mock.patch.object(self.d, 'unwatch_output'):
+            self.d.close_output(self.job)
+        with open(stderr, 'rb') as f:
+            self.assertNotIn(b'memory', f.read())
+
+        self.assertEqual(self.d.retry_reason(self.job, 1, self.d.options(
+                            self.job)), "stderr matched 'out of memory'")
+
+class TestReason(Retries):
+    def reason(self, rc, stderr = '', **options):
+        self.ran(stderr)
+        return self.d.retry_reason(self.job, rc, options)
+
+    def test_any_failure(self):
+        self.assertEqual(self.reason(3), 'exit code 3')
+
+    def test_codes(self):
+        self.assertEqual(self.reason(3, retry_codes = [3, 4]), 'exit code 3')
+        self.assertIsNone(self.reason(5, retry_codes = [3, 4]))
+
+    def test_patterns(self):
+        self.assertEqual(self.reason(1, 'boom\nCUDA out of memory\n',
+                                     retry_patterns = ['out of memory']),
+                         "stderr matched 'out of memory'")
+        self.assertIsNone(self.reason(1, 'Segmentation fault\n',
+                                      retry_patterns = ['out of memory']))
+
+    def test_either_one(self):
+        options = dict(retry_codes = [3], retry_patterns = ['NCCL'])
+        self.assertEqual(self.reason(3, **options), 'exit code 3')
+        self.assertEqual(self.reason(1, 'NCCL error', **options),
+                         "stderr matched 'NCCL'")
+        self.assertIsNone(self.reason(1, 'nope', **options))
+
+    def test_bad_pattern(self):
+        with self.assertLogs(level = 'WARNING'):
+            self.assertEqual(self.reason(1, 'x(', retry_patterns = ['(',
+                                                                     r'x\(']),
+                             "stderr matched 'x\\\\('")
+
+class TestRetry(Retries):
+    def exits(self, rc = 1, pid = 4321):
+        """ run it (as far as finish can tell) and have it exit with [rc] """
+        self.ran('attempt %d' % self.d.store.attempts(0, 'a.sh'))
+        self.d.running[self.job] = Exited(rc, pid)
+        self.d.finish(self.job, self.d.running)
+
+    def test_backoff_doubles_up_to_its_max(self):
+        self.options(max_attempts = 6, backoff = 10, backoff_max = 50)
+        delays = []
+        with mock.patch.object(self.d, 'defer',
+                               lambda job, delay: delays.append(delay)):
+            for _ in range(6):
+                self.exits()
+                if os.path.exists(self.job):
+                    os.remove(self.job)
+        self.assertEqual(delays, [10, 20, 40, 50, 50])
+        # the last one is out of attempts
+        self.assertEqual(self.d.store.statuses['a.sh'], 'failed')
+
+    def test_deferred_then_released(self):
+        self.options(max_attempts = 2, backoff = 0)
+        self.exits()
+        self.assertEqual(self.d.store.statuses['a.sh'], 'queued')
+        self.assertTrue(os.path.exists(self.job))
+        self.assertIn(self.job, self.d.job_queue)
+        self.assertFalse(self.d.job_queue)
+        self.d.release(self.d.job_queue)
+        self.assertEqual(self.d.job_queue.pop(), self.job)
+
+    def test_attempts_kept(self):
+        self.options(max_attempts = 3, backoff = 0)
+        for _ in range(2):
+            self.exits()
+            os.remove(self.job)
+        log_dir = self.d.job_log_dir(self.job)
+        for n in [1, 2]:
+            with open(os.path.join(log_dir, 'attempt-%d' % n, 'stderr')) as f:
+                self.assertEqual(f.read(), 'attempt %d' % (n - 1))
+        self.assertEqual(self.d.store.attempts(0, 'a.sh'), 2)
+
+    def test_killed_never_retried(self):
+        self.options(max_attempts = 3)
+        self.ran()
+        self.d.store.statuses['a.sh'] = 'killed'
+        self.d.running[self.job] = Exited(-9)
+        self.d.finish(self.job, self.d.running)
+        self.assertNotIn(self.job, self.d.job_queue)
+        self.assertFalse(os.path.exists(self.job))
+        self.assertEqual(self.d.store.attempts(0, 'a.sh'), 0)
+        self.assertFalse(os.path.isdir(os.path.join(
+                            self.d.job_log_dir(self.job), 'attempt-1')))
@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from base import dispatcher, gpu
+
+class Exited():
+    def __init__(self, pid, rc):
+        self.pid = pid
+        self.returncode = rc
+
+    def poll(self):
+        return self.returncode
+
+class Store():
+    def __init__(self, down = False):
+        self.down = down
+        self.marks = []
+
+    def mark(self, bid, fname, pid, status, log_dir = None):
+        if self.down:
+            raise EOFError('state service went away')
+        self.marks.append((bid, fname, pid, status))
+
+class TestRunningTable(unittest.TestCase):
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        queue = os.path.join(root, 'queue')
+        self.d = dispatcher.Dispatcher(os.path.join(root, 'run'), queue,
+                                       30, 1, None, None,
+                                       gpus = gpu.FakeProvider())
+        self.job = os.path.join(queue, 'batch-0', 'a.sh')
+        self.d.table.add(self.job, os.getpid(), ['0'], self.job, root)
+
+    def settle(self):
+        running = {self.job: Exited(os.getpid(), 0)}
+        self.d.settle(self.job, running, ('completed', None))
+
+    def recorded(self):
+        return [r['job'] for r in self.d.table.load()]
+
+    def test_forgotten_once_marked(self):
+        self.d.store = Store()
+        self.settle()
+        self.assertEqual(self.d.store.marks,
+                         [(0, 'a.sh', os.getpid(), 'completed')])
+        self.assertEqual(self.recorded(), [])
+
+    def test_kept_if_the_mark_fails(self):
+        self.d.store = Store(down = True)
+        with self.assertRaises(EOFError):
+            self.settle()
+        # the next dispatcher marks it from there
+        self.assertEqual(self.recorded(), [self.job])
+
+    def test_launched_again(self):
+        self.d.table.add(self.job, os.getpid() + 1, ['0'], self.job, '')
+        self.d.table.remove(self.job, os.getpid())
+        self.assertEqual(self.recorded(), [self.job])
+        self.d.table.remove(self.job, os.getpid() + 1)
+        self.assertEqual(self.recorded(), [])
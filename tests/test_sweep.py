@@ -0,0 +1,124 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from base import dispatcher, gpu, jobqueue, loader, sweep
+
+class Store():
+    """ just enough of the state service for sweeps """
+    def __init__(self):
+        self.launched = []
+        self.sweeps = []
+
+    def batch(self, bid):
+        return 'sweep', {}
+
+    def started(self, bid):
+        return self.launched
+
+    def add_sweep(self, label, template, size, options):
+        self.sweeps.append((label, template, size))
+        return len(self.sweeps) - 1
+
+class Sweeps(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.queue = os.path.join(self.root, 'queue')
+        os.makedirs(self.queue)
+        self.template = os.path.join(self.root, 'train.sh')
+        with open(self.template, 'w') as f:
+            f.write('#!/bin/sh\n')
+        self.store = Store()
+
+    def load(self, params, via = 'env'):
+        bid, size, _ = loader.load_sweep(self.store, self.queue, self.template,
+                                         params, 'sweep', via = via)
+        return os.path.join(self.queue, 'batch-%d' % bid)
+
+class TestPoints(Sweeps):
+    def test_grid(self):
+        points = sweep.Points(self.load({'lr': [0.1, 0.01], 'seed': [1, 2]}))
+        self.assertEqual(len(points), 4)
+        # the last one changes fastest
+        self.assertEqual(list(points), [{'lr': 0.1, 'seed': 1},
+                                        {'lr': 0.1, 'seed': 2},
+                                        {'lr': 0.01, 'seed': 1},
+                                        {'lr': 0.01, 'seed': 2}])
+
+    def test_list(self):
+        points = sweep.Points(self.load([{'a': 1}, {'a': 'x', 'b': True}]))
+        self.assertEqual(list(points), [{'a': 1}, {'a': 'x', 'b': True}])
+
+    def test_jsonl(self):
+        path = os.path.join(self.root, 'points.jsonl')
+        with open(path, 'w') as f:
+            f.write('{"a": 1}\n\n{"a": 2}\n')
+        folder = self.load(path)
+        self.assertEqual(sorted(os.listdir(folder)), sorted([sweep.MANIFEST,
+                                                    sweep.PARAMS,
+                                                    sweep.TEMPLATE]))
+        self.assertEqual(list(sweep.Points(folder)), [{'a': 1}, {'a': 2}])
+
+    def test_bad_jsonl(self):
+        path = os.path.join(self.root, 'points.jsonl')
+        with open(path, 'w') as f:
+            f.write('{"a": 1}\n[1, 2]\n')
+        with self.assertRaises(ValueError):
+            self.load(path)
+
+    def test_env_and_args(self):
+        points = sweep.Points(self.load([{'lr': 0.1, 'name': 'x'}]))
+        params = next(iter(points))
+        env = points.env(3, params)
+        self.assertEqual((env['MAESTRO_POINT'], env['lr'], env['name']),
+                         ('3', '0.1', 'x'))
+        self.assertEqual(json.loads(env['MAESTRO_PARAMS']), params)
+        self.assertEqual(points.args(params), [])
+
+        points = sweep.Points(self.load([{'lr': 0.1}], via = 'args'))
+        self.assertNotIn('lr', points.env(0, {'lr': 0.1}))
+        self.assertEqual(points.args({'lr': 0.1}), ['--lr', '0.1'])
+
+class TestExpansion(Sweeps):
+    """ the dispatcher makes the points as they're popped, not up front """
+    def setUp(self):
+        super().setUp()
+        self.d = dispatcher.Dispatcher(os.path.join(self.root, 'run'),
+                                       self.queue, 30, 1, None, self.store,
+                                       gpus = gpu.FakeProvider())
+        self.job_queue = jobqueue.JobQueue()
+
+    def test_lazy(self):
+        # a million points, only a manifest on disk
+        folder = self.load({'a': list(range(1000)), 'b': list(range(1000))})
+        self.assertEqual(sorted(os.listdir(folder)),
+                         [sweep.MANIFEST, sweep.TEMPLATE])
+        self.d.add_sweep(self.job_queue, folder)
+        self.assertEqual(len(self.job_queue), 10**6)
+        self.assertEqual(self.d.points, {})
+
+        popped = [self.job_queue.pop() for _ in range(3)]
+        self.assertEqual([os.path.basename(j) for j in popped],
+                         ['train_0.sh', 'train_1.sh', 'train_2.sh'])
+        self.assertEqual(len(self.d.points), 3)
+        self.assertEqual(self.d.points[popped[2]][2], {'a': 0, 'b': 2})
+        self.assertEqual(len(self.job_queue), 10**6 - 3)
+
+    def test_launched_before(self):
+        # after a restart, the points that ran already are skipped
+        self.store.launched = ['train_1.sh']
+        self.d.add_sweep(self.job_queue, self.load({'a': [1, 2, 3]}))
+        self.assertEqual(len(self.job_queue), 2)
+        self.assertEqual([os.path.basename(self.job_queue.pop())
+                          for _ in range(2)], ['train_0.sh', 'train_2.sh'])
+
+    def test_dropped(self):
+        folder = self.load({'a': list(range(10))})
+        self.d.add_sweep(self.job_queue, folder)
+        self.job_queue.pop()
+        self.d.drop_sweep(self.job_queue, 0)
+        self.assertEqual(len(self.job_queue), 0)
+        self.assertNotIn(0, self.d.sweeps)
@@ -0,0 +1,78 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from base import sweep, watcher
+
+class TestInotifyWatcher(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.queue = os.path.join(self.dir, 'queue')
+        self.batch = os.path.join(self.queue, 'batch-0')
+        os.makedirs(self.batch)
+        try:
+            self.watcher = watcher.InotifyWatcher(self.queue)
+        except (OSError, AttributeError, TypeError):
+            self.skipTest('no inotify here')
+        self.addCleanup(self.watcher.close)
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\n')
+        return path
+
+    def files(self):
+        self.watcher.read()
+        return sorted(os.path.basename(f) for f in self.watcher.files())
+
+    def test_written(self):
+        path = os.path.join(self.batch, 'a.sh')
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\n')
+            f.flush()
+            # not until it's closed
+            self.assertEqual(self.files(), [])
+        self.assertEqual(self.files(), ['a.sh'])
+
+    def test_moved_in_and_out(self):
+        src = self.write(os.path.join(self.dir, 'a.sh'))
+        os.rename(src, os.path.join(self.batch, 'a.sh'))
+        self.assertEqual(self.files(), ['a.sh'])
+        os.rename(os.path.join(self.batch, 'a.sh'), src)
+        self.assertEqual(self.files(), [])
+
+    def test_links(self):
+        src = self.write(os.path.join(self.dir, 'a.sh'))
+        os.link(src, os.path.join(self.batch, 'a.sh'))
+        os.symlink(src, os.path.join(self.batch, 'b.sh'))
+        self.assertEqual(self.files(), ['a.sh', 'b.sh'])
+        os.remove(os.path.join(self.batch, 'a.sh'))
+        self.assertEqual(self.files(), ['b.sh'])
+
+    def test_batches(self):
+        self.write(os.path.join(self.batch, 'a.sh'))
+        staging = os.path.join(self.dir, 'staging')
+        os.makedirs(staging)
+        self.write(os.path.join(staging, 'b.sh'))
+        self.write(os.path.join(staging, sweep.MANIFEST))
+        os.rename(staging, os.path.join(self.queue, 'batch-1'))
+        self.assertEqual(self.files(), ['a.sh', 'b.sh'])
+        self.assertEqual(self.watcher.sweeps(),
+                         [os.path.join(self.queue, 'batch-1')])
+
+        shutil.rmtree(self.batch)
+        self.assertEqual(self.files(), ['b.sh'])
+
+    def test_same_as_polling(self):
+        for name in ['a.sh', 'b.sh', 'notes.txt']:
+            self.write(os.path.join(self.batch, name))
+        os.link(os.path.join(self.batch, 'a.sh'),
+                os.path.join(self.batch, 'c.sh'))
+        poll = watcher.PollWatcher(self.queue)
+        self.assertEqual(self.files(),
+                         sorted(os.path.basename(f) for f in poll.files()))
+
+if __name__ == '__main__':
+    unittest.main()